@@ -0,0 +1,236 @@
+import datetime, sqlite3, threading, time
+
+# 開始／終了を押して「何分やったか」を記録する台帳
+# ・events は追記のみ（押した記録をそのまま残す）
+# ・開始中のものは open_sessions、終わったものは sessions（Notion未送信フラグ付き）
+# ・日別・週別の合計は totals に足し込んでおくので、「今週どれだけ読書した？」は1行引くだけ
+# ・押し忘れに寛容：二重の開始はそのまま継続、終了の押し忘れは max_session で打ち切り、
+#   開始の無い終了は記録だけ残して無視する
+# ・Notion への送信は claimed_until（期限つきの予約）を付けてから行うので、複数プロセスで同じDBを
+#   使っても同じ記録を二重に送らない（送信中に落ちたら期限切れで他のプロセスが送り直す）
+
+
+def period_keys(at):
+    d = datetime.datetime.fromtimestamp(at)
+    year, week, _ = d.isocalendar()
+    return f"d:{d:%Y-%m-%d}", f"w:{year}-W{week:02d}"
+
+
+def split_by_day(start, end):
+    # 日をまたぐ記録は0時で区切って、それぞれの日に足す
+    while start < end:
+        d = datetime.datetime.fromtimestamp(start)
+        midnight = (d.replace(hour=0, minute=0, second=0, microsecond=0)
+                    + datetime.timedelta(days=1)).timestamp()
+        stop = min(end, midnight)
+        yield start, stop
+        start = stop
+
+
+class ActivityLedger:
+    def __init__(self, path=":memory:", max_session=6 * 3600):
+        self.max_session = max_session
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS activity_events ("
+            " id INTEGER PRIMARY KEY, uid TEXT NOT NULL, task TEXT NOT NULL,"
+            " kind TEXT NOT NULL, at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS activity_open ("
+            " uid TEXT NOT NULL, task TEXT NOT NULL, started_at REAL NOT NULL, PRIMARY KEY (uid, task));"
+            "CREATE TABLE IF NOT EXISTS activity_sessions ("
+            " id INTEGER PRIMARY KEY, uid TEXT NOT NULL, task TEXT NOT NULL,"
+            " started_at REAL NOT NULL, ended_at REAL NOT NULL, seconds REAL NOT NULL,"
+            " capped INTEGER NOT NULL DEFAULT 0, synced INTEGER NOT NULL DEFAULT 0);"
+            "CREATE INDEX IF NOT EXISTS activity_sessions_unsynced ON activity_sessions (synced, id);"
+            "CREATE TABLE IF NOT EXISTS activity_totals ("
+            " uid TEXT NOT NULL, task TEXT NOT NULL, period TEXT NOT NULL, seconds REAL NOT NULL,"
+            " PRIMARY KEY (uid, task, period));"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(activity_sessions)")}
+        if "claimed_until" not in columns:
+            self._db.execute("ALTER TABLE activity_sessions ADD COLUMN claimed_until REAL NOT NULL DEFAULT 0")
+        self.starts = 0
+        self.stops = 0
+        self.orphan_stops = 0
+        self.double_starts = 0
+        self.capped = 0
+
+    # ---------- 記録 ----------
+    def start(self, uid, task, at=None):
+        # 戻り値: "started" / "running"（すでに開始中） / "restarted"（押し忘れを打ち切って開始し直し）
+        at = at or time.time()
+        with self._lock, self._tx():
+            self._event(uid, task, "start", at)
+            self.starts += 1
+            row = self._db.execute("SELECT started_at FROM activity_open WHERE uid = ? AND task = ?",
+                                   (uid, task)).fetchone()
+            if row is not None and at - row[0] <= self.max_session:
+                self.double_starts += 1
+                return "running"
+            status = "started"
+            if row is not None:
+                self._close(uid, task, row[0], row[0] + self.max_session, capped=True)
+                status = "restarted"
+            self._db.execute("INSERT INTO activity_open (uid, task, started_at) VALUES (?, ?, ?)",
+                             (uid, task, at))
+            return status
+
+    def stop(self, uid, task=None, at=None):
+        # 戻り値: 終わった記録の dict（開始が見つからなければ None）
+        at = at or time.time()
+        with self._lock, self._tx():
+            self.stops += 1
+            if task is None:
+                rows = self._db.execute("SELECT task FROM activity_open WHERE uid = ?", (uid,)).fetchall()
+                task = rows[0][0] if len(rows) == 1 else None
+            self._event(uid, task or "", "stop", at)
+            row = None if task is None else self._db.execute(
+                "SELECT started_at FROM activity_open WHERE uid = ? AND task = ?", (uid, task)).fetchone()
+            if row is None:
+                self.orphan_stops += 1
+                return None
+            started_at = row[0]
+            capped = at - started_at > self.max_session
+            ended_at = started_at + self.max_session if capped else at
+            return self._close(uid, task, started_at, ended_at, capped=capped)
+
+    def _close(self, uid, task, started_at, ended_at, capped=False):
+        seconds = max(0.0, ended_at - started_at)
+        self._db.execute("DELETE FROM activity_open WHERE uid = ? AND task = ?", (uid, task))
+        self._db.execute(
+            "INSERT INTO activity_sessions (uid, task, started_at, ended_at, seconds, capped)"
+            " VALUES (?, ?, ?, ?, ?, ?)", (uid, task, started_at, ended_at, seconds, int(capped)))
+        for s, e in split_by_day(started_at, ended_at):
+            for period in period_keys(s):
+                self._db.execute(
+                    "INSERT INTO activity_totals (uid, task, period, seconds) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (uid, task, period) DO UPDATE SET seconds = seconds + excluded.seconds",
+                    (uid, task, period, e - s))
+        if capped:
+            self.capped += 1
+        return {"task": task, "started_at": started_at, "ended_at": ended_at,
+                "seconds": seconds, "capped": capped}
+
+    def _event(self, uid, task, kind, at):
+        self._db.execute("INSERT INTO activity_events (uid, task, kind, at) VALUES (?, ?, ?, ?)",
+                         (uid, task, kind, at))
+
+    def _tx(self):
+        return _Transaction(self._db)
+
+    # ---------- 参照 ----------
+    def running(self, uid):
+        with self._lock:
+            return [{"task": task, "started_at": at} for task, at in self._db.execute(
+                "SELECT task, started_at FROM activity_open WHERE uid = ? ORDER BY started_at", (uid,))]
+
+    def total(self, uid, task, at=None):
+        # 戻り値: (今日の秒数, 今週の秒数)
+        day, week = period_keys(at or time.time())
+        with self._lock:
+            rows = dict(self._db.execute(
+                "SELECT period, seconds FROM activity_totals WHERE uid = ? AND task = ? AND period IN (?, ?)",
+                (uid, task, day, week)).fetchall())
+        return rows.get(day, 0.0), rows.get(week, 0.0)
+
+    # ---------- Notion 同期 ----------
+    def claim(self, limit=100, lease=120.0):
+        # 未送信で誰も予約していない記録を、lease 秒の予約を付けて取り出す（取り出しと予約は1文で）
+        now = time.time()
+        with self._lock:
+            rows = self._db.execute(
+                "UPDATE activity_sessions SET claimed_until = ? WHERE id IN ("
+                " SELECT id FROM activity_sessions WHERE synced = 0 AND claimed_until < ? ORDER BY id LIMIT ?)"
+                " RETURNING id, uid, task, started_at, ended_at, seconds, capped",
+                (now + lease, now, limit)).fetchall()
+        return [{"id": r[0], "uid": r[1], "task": r[2], "started_at": r[3], "ended_at": r[4],
+                 "seconds": r[5], "capped": bool(r[6])} for r in sorted(rows)]
+
+    def mark_synced(self, ids):
+        with self._lock:
+            self._db.executemany("UPDATE activity_sessions SET synced = 1 WHERE id = ?",
+                                 [(i,) for i in ids])
+
+    def release(self, ids):
+        # 送れなかった記録の予約を外す（次の周期で誰かが送り直す）
+        with self._lock:
+            self._db.executemany("UPDATE activity_sessions SET claimed_until = 0 WHERE id = ?",
+                                 [(i,) for i in ids])
+
+    def stats(self):
+        with self._lock:
+            open_count = self._db.execute("SELECT COUNT(*) FROM activity_open").fetchone()[0]
+            unsynced = self._db.execute(
+                "SELECT COUNT(*) FROM activity_sessions WHERE synced = 0").fetchone()[0]
+            return {
+                "running": open_count,
+                "unsynced": unsynced,
+                "starts": self.starts,
+                "stops": self.stops,
+                "double_starts": self.double_starts,
+                "orphan_stops": self.orphan_stops,
+                "capped": self.capped,
+            }
+
+
+class _Transaction:
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN")
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+class LedgerSync:
+    # 終わった記録を interval 秒ごとにまとめて Notion に送る（1回の呼び出しで最大 batch 件）
+    def __init__(self, ledger, send, interval=60.0, batch=50, lease=120.0):
+        self.ledger = ledger
+        self.send = send                    # send([session, ...]) → 成功なら True
+        self.interval = interval
+        self.batch = batch
+        self.lease = lease
+        self._wake = threading.Event()
+        self._thread = None
+        self.synced = 0
+        self.calls = 0
+        self.failures = 0
+
+    def start(self):
+        # fork されたプロセスでは親のスレッドは動いていないので、もう一度起動する
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="ledger-sync", daemon=True)
+            self._thread.start()
+
+    def kick(self):
+        # すぐ送りたいとき（件数が溜まったときなど）
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        while True:
+            sessions = self.ledger.claim(self.batch, self.lease)
+            if not sessions:
+                return True
+            self.calls += 1
+            try:
+                ok = self.send(sessions)
+            except Exception as e:
+                print("[ledger-sync] 送信エラー:", e)
+                ok = False
+            if not ok:
+                self.failures += 1
+                self.ledger.release([s["id"] for s in sessions])
+                return False  # 次の周期でもう一度
+            self.ledger.mark_synced([s["id"] for s in sessions])
+            self.synced += len(sessions)
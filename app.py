@@ -1,25 +1,71 @@
-from flask import Flask, request, abort
+import time
+IMPORT_STARTED = time.perf_counter()  # 起動時間の計測の起点
+
+from flask import Flask, request, abort, jsonify, Response
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import (
     MessageEvent, TextMessage, AudioMessage, TextSendMessage,
-    QuickReply, QuickReplyButton, MessageAction
+    QuickReply, QuickReplyButton, MessageAction, ImageSendMessage
 )
-import os, tempfile, datetime, requests, random
+import os, re, json, hmac, datetime, threading
+import click
+import requests
 from dotenv import load_dotenv
-from openai import OpenAI
 
-from notion_client import Client
+from jobqueue import JobQueue
+from dedupe import EventDeduper, event_key
+from notion_gateway import NotionGateway, NOTION_API_BASE
+from notion_outbox import NotionOutbox
+from audio_ingest import ingest_audio, transcribe, TranscriptionStats, AudioTooLarge
+from state_store import StateStore, SQLiteStateBackend, MemoryStateBackend
+from summary_cache import SummaryCache, cache_key
+from summarizer import extractive_summary, trim_sentences, TierStats
+from hint_pool import HintPool
+from llm_gateway import LLMGateway
+import value_ranking
+from state_machine import StateMachine
+from memo_index import MemoIndex, parse_query
+from timer_scheduler import TimerScheduler, parse_timer, format_duration
+from activity_ledger import ActivityLedger, LedgerSync
+from review_stats import ReviewStats
+from charts import ChartService
+from exporter import Exporter
+from metrics import Registry
+from lazy import Lazy
 
 load_dotenv()
 
 NOTION_MEMO_SECRET = os.getenv("NOTION_MEMO_SECRET")  # .envで管理してOK
 NOTION_MEMO_PAGE_ID = os.getenv("NOTION_MEMO_PAGE_ID")  # .envで管理してOK
-notion_memo = Client(auth=NOTION_MEMO_SECRET)
 
 app = Flask(__name__)
 
-memo_state = {}  # user_id → 進捗状態
+# ---------- メトリクス（/metrics で Prometheus 形式） ----------
+metrics = Registry(prefix="life5_")
+llm_seconds     = metrics.histogram("llm_seconds", "OpenAI呼び出しの時間（待ち時間込み）", ("kind", "outcome"))
+notion_seconds  = metrics.histogram("notion_request_seconds", "Notion API呼び出しの時間（リトライ込み）",
+                                    ("method", "route", "status"))
+line_seconds    = metrics.histogram("line_api_seconds", "LINE API呼び出しの時間", ("call",))
+line_errors     = metrics.counter("line_api_errors_total", "LINE API呼び出しのエラー数", ("call",))
+summary_seconds = metrics.histogram("summarize_seconds", "summarize() の時間（段ごと）", ("tier",))
+audio_seconds   = metrics.histogram("audio_seconds", "音声の取り込み時間（ダウンロード／文字起こし）", ("stage",))
+step_seconds    = metrics.histogram("flow_step_seconds", "フローの各ステップの処理時間", ("flow", "step"))
+step_errors     = metrics.counter("flow_step_errors_total", "フローの各ステップで出た例外の数", ("flow", "step"))
+
+def observe_step(flow, step, seconds, failed):
+    step_seconds.observe(seconds, flow, step)
+    if failed:
+        step_errors.inc(flow, step)
+
+# 進行状態の保存先（STATE_DB を指定するとSQLiteで複数プロセス共有・再起動後も継続）
+STATE_DB  = os.getenv("STATE_DB")
+state_store = StateStore(
+    SQLiteStateBackend(STATE_DB) if STATE_DB else MemoryStateBackend(),
+    ttl=int(os.getenv("STATE_TTL", str(6 * 3600))),  # 放置されたフローはこの秒数で破棄
+    ttls={"value_prior": None},
+)
+memo_state = state_store.map("memo")  # user_id → 進捗状態
 
 def add_memo_to_notion(category, content, subcategory=None):
     if category == "アイデア":
@@ -38,8 +84,9 @@ def add_memo_to_notion(category, content, subcategory=None):
         print(f"未知のカテゴリ: {category} {subcategory}")
         return
     text = content  # 「【カテゴリ】」は不要
-    notion_memo.blocks.children.append(
-        block_id=block_id,
+    block_ids = outbox.append_children(
+        block_id,
+        token=NOTION_MEMO_SECRET,
         children=[
             {
                 "object": "block",
@@ -52,8 +99,8 @@ def add_memo_to_notion(category, content, subcategory=None):
             }
         ]
     )
-
-print("[NOTION_REVIEW_DBID]", os.getenv("NOTION_REVIEW_DBID"))  # ←ここ！
+    # 「呼び出し」用にローカルの索引にも入れる（送信前は仮ID。Notionに書けたら本物のIDに付け替える）
+    memo_index.add(category, text, subcategory, block_id=block_ids[0] if block_ids else None)
 
 
 # --- Flaskエンドポイント（404対策＋デバッグ） ---
@@ -66,19 +113,217 @@ def callback():
     print("[/callback] POST accessed")
     signature = request.headers.get("X-Line-Signature", "")
     body = request.get_data(as_text=True)
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+    if not handler.parser.signature_validator.validate(body, signature):
         print("[/callback] InvalidSignatureError")
         abort(400)
+    for raw in json.loads(body).get("events", []):
+        # 再送などで一度見たイベントは外部APIを呼ぶ前に捨てる
+        key = event_key(raw)
+        redelivery = (raw.get("deliveryContext") or {}).get("isRedelivery", False)
+        if key and not event_dedupe.first_seen(key, redelivery=redelivery):
+            print("[/callback] 重複イベントを破棄:", key)
+            continue
+        if CALLBACK_MODE == "async":
+            # キューに積んですぐ200を返す（処理はワーカー側）
+            job_queue.put(raw)
+            continue
+        try:
+            process_job(raw)
+        except Exception:
+            if key:
+                event_dedupe.forget(key)  # 500で返るのでLINEの再送で処理し直す
+            raise
     return "OK"
 
+@app.route("/queue/stats", methods=["GET"])
+def queue_stats():
+    return jsonify(job_queue.stats() if job_queue else {"mode": CALLBACK_MODE})
+
+@app.route("/timers/stats", methods=["GET"])
+def timer_stats():
+    return jsonify(timers.stats())
+
+@app.route("/activity/stats", methods=["GET"])
+def activity_stats():
+    return jsonify(ledger=activity.stats(), sync={"synced": activity_sync.synced, "calls": activity_sync.calls,
+                                                  "failures": activity_sync.failures})
+
+@app.route("/review/stats", methods=["GET"])
+def review_stats_route():
+    return jsonify(review_stats.stats())
+
+@app.route("/dedupe/stats", methods=["GET"])
+def dedupe_stats():
+    return jsonify(event_dedupe.stats())
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify(summary=summary_cache.stats(), summary_tiers=summary_tiers.stats(), state=state_store.stats(), hints=hint_pool.stats(),
+                   memos=memo_index.stats(), charts=charts.stats())
+
+@app.route("/charts/<key>.png", methods=["GET"])
+def chart_image(key):
+    # 中身はキー（＝データのversion込み）で決まるので、ずっとキャッシュしてよい
+    if request.if_none_match and key in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{key}"'})
+    png = charts.get(key)
+    if png is None:
+        abort(404)
+    return Response(png, mimetype="image/png", headers={
+        "ETag": f'"{key}"',
+        "Cache-Control": "public, max-age=31536000, immutable",
+    })
+
+@app.route("/export/<source>", methods=["GET"])
+def export_route(source):
+    # ?format=ndjson|csv&since=2025-01-01T00:00:00Z ： 取りながらそのまま流す
+    # EXPORT_TOKEN は Authorization: Bearer ヘッダーでだけ受け取る（URLに載せるとアクセスログに残る）
+    auth = request.headers.get("Authorization", "")
+    token = auth[len("Bearer "):] if auth.startswith("Bearer ") else ""
+    if not EXPORT_TOKEN or not hmac.compare_digest(token.encode("utf-8"), EXPORT_TOKEN.encode("utf-8")):
+        abort(403)
+    if source not in exporter.sources:
+        abort(404)
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in ("ndjson", "csv"):
+        abort(400)
+    mimetype = "application/x-ndjson" if fmt == "ndjson" else "text/csv"
+    return Response(exporter.stream(source, fmt, since=request.args.get("since")),
+                    mimetype=f"{mimetype}; charset=utf-8",
+                    headers={"Content-Disposition": f'attachment; filename="{source}.{fmt}"'})
+
+@app.route("/outbox/stats", methods=["GET"])
+def outbox_stats():
+    return jsonify(outbox.stats())
+
+@app.route("/llm/stats", methods=["GET"])
+def llm_stats():
+    return jsonify({**llm.stats(), "audio": audio_stats.stats()})
+
+@app.route("/metrics", methods=["GET"])
+def metrics_route():
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route("/flows/stats", methods=["GET"])
+def flow_stats():
+    return jsonify(flows.stats())
+
 # --- LINE/OPENAI/NOTION各種セットアップ ---
-line_bot_api = LineBotApi(os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
+class TimedLineBotApi(LineBotApi):
+    # 返信・プッシュにかかった時間をメトリクスに記録する
+    def reply_message(self, *args, **kwargs):
+        with line_seconds.time("reply_message", errors=line_errors):
+            return super().reply_message(*args, **kwargs)
+
+    def push_message(self, *args, **kwargs):
+        with line_seconds.time("push_message", errors=line_errors):
+            return super().push_message(*args, **kwargs)
+
+class SessionHttpClient(RequestsHttpClient):
+    # SDK の標準は毎回 requests.get/post で接続を張り直すので、Session で keep-alive して使い回す
+    def __init__(self, timeout=RequestsHttpClient.DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.session = requests.Session()
+
+    def _send(self, method, url, timeout=None, **kwargs):
+        return RequestsHttpResponse(self.session.request(method, url, timeout=timeout or self.timeout, **kwargs))
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._send("GET", url, timeout, headers=headers, params=params, stream=stream)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._send("POST", url, timeout, headers=headers, data=data)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._send("DELETE", url, timeout, headers=headers, data=data)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._send("PUT", url, timeout, headers=headers, data=data)
+
+def openai_client():
+    # openai の import は重い（0.5秒ほど）ので、最初に使うときまで読み込まない
+    from openai import OpenAI
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# 接続先は環境変数で差し替えられる（loadtest.py が手元のダミーサーバーに向けるときなど）
+# OpenAI は OPENAI_BASE_URL を SDK がそのまま読む
+# クライアントは最初に使うときに作る（Lazy）。起動直後に作っておきたいときは warm_up()
+line_bot_api = Lazy(lambda: TimedLineBotApi(os.getenv("LINE_CHANNEL_ACCESS_TOKEN"),
+                                            endpoint=os.getenv("LINE_API_ENDPOINT", "https://api.line.me"),
+                                            data_endpoint=os.getenv("LINE_API_DATA_ENDPOINT", "https://api-data.line.me"),
+                                            http_client=SessionHttpClient),
+                    name="line")
 handler      = WebhookHandler(os.getenv("LINE_CHANNEL_SECRET"))
-client       = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+client       = Lazy(openai_client, name="openai")
+# OpenAI 呼び出しはすべてここを通す（同時実行数の上限・時間の上限・ブレーカー）
+llm = LLMGateway(
+    client,
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "8")),
+    per_user=int(os.getenv("LLM_PER_USER", "2")),
+    queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", "2")),
+    # 長い音声の文字起こしは区間ごとに枠を取り合うので、空くまで長めに待つ
+    queue_timeouts={"transcription": float(os.getenv("LLM_TRANSCRIBE_QUEUE_TIMEOUT", "30"))},
+    # 文字起こしの区間は要約・ヒントとは別枠で数える（LLM_PER_USER を使い切らない）
+    per_user_kinds={"transcription": int(os.getenv("LLM_PER_USER_TRANSCRIBE", "3"))},
+    budgets={
+        "summary":       float(os.getenv("LLM_SUMMARY_TIMEOUT", "15")),
+        "hint":          float(os.getenv("LLM_HINT_TIMEOUT", "10")),
+        "transcription": float(os.getenv("LLM_TRANSCRIBE_TIMEOUT", "60")),
+    },
+    breaker_options={
+        "failure_rate": float(os.getenv("LLM_BREAKER_FAILURE_RATE", "0.5")),
+        "cooldown":     float(os.getenv("LLM_BREAKER_COOLDOWN", "30")),
+    },
+    observer=lambda kind, seconds, outcome: llm_seconds.observe(seconds, kind, outcome),
+)
 NOTION_TOKEN = os.getenv("NOTION_TOKEN")
 NOTION_DBID  = os.getenv("NOTION_DBID")
+# Notion呼び出しはすべてここを通す（keep-alive・レート制限・リトライ・タイムアウト）
+notion = Lazy(lambda: NotionGateway(
+    NOTION_TOKEN,
+    base_url=os.getenv("NOTION_API_BASE", NOTION_API_BASE),
+    rate=float(os.getenv("NOTION_RATE", "3")),
+    timeout=float(os.getenv("NOTION_TIMEOUT", "10")),
+    observer=lambda method, route, status, seconds: notion_seconds.observe(seconds, method, route, status),
+), name="notion")
+# 書き込みはすべて送信箱に積んでから送る（Notionが遅い・落ちていても回答を失わない）
+outbox = NotionOutbox(
+    notion,
+    path=os.getenv("NOTION_OUTBOX_DB", "notion_outbox.db"),
+    tokens={"memo": NOTION_MEMO_SECRET},
+    max_backoff=float(os.getenv("NOTION_OUTBOX_MAX_BACKOFF", "300")),
+    id_retention=float(os.getenv("NOTION_OUTBOX_ID_RETENTION_DAYS", "7")) * 86400,
+    on_resolved=lambda temp_id, real_id: memo_index.rename_block(temp_id, real_id),
+)
+# Reviewの回答は1件ずつすぐ送信箱に積み、この秒数のあいだに続いた回答と1回のPATCHにまとめて送る
+REVIEW_WRITE_HOLD = float(os.getenv("REVIEW_FLUSH_DEBOUNCE", "20"))
+# Reviewの週次・月次集計（回答のたびに差分更新）
+review_stats = ReviewStats(os.getenv("REVIEW_STATS_DB", "review_stats.db"))
+# ダッシュボードのグラフ（別プロセスで描画してPNGをキャッシュ）
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")  # 画像URLの頭（例: https://xxx.onrender.com）
+charts = ChartService(
+    cache_dir=os.getenv("CHART_CACHE_DIR", "chart_cache"),
+    workers=int(os.getenv("CHART_WORKERS", "1")),
+)
+CHART_PERIODS = {
+    "週": ("w", 8, "Value / Mission (weekly)"),
+    "月": ("m", 6, "Value / Mission (monthly)"),
+}
+
+# /callback の処理方式: "sync"=その場で処理（従来通り） / "async"=キューに積んでワーカーで処理
+CALLBACK_MODE    = os.getenv("CALLBACK_MODE", "sync")
+CALLBACK_WORKERS = int(os.getenv("CALLBACK_WORKERS", "4"))
+JOB_QUEUE_DB     = os.getenv("JOB_QUEUE_DB")  # 指定するとSQLiteに永続化（再起動後に再処理）
+# 同じWebhookイベントを二重に処理しない（DEDUPE_DB で複数プロセス・再起動後も共有）
+event_dedupe = EventDeduper(
+    window=int(os.getenv("DEDUPE_WINDOW", "600")),
+    max_entries=int(os.getenv("DEDUPE_MAX_ENTRIES", "10000")),
+    path=os.getenv("DEDUPE_DB"),
+)
+AUDIO_MAX_BYTES  = int(os.getenv("AUDIO_MAX_BYTES", str(25 * 1024 * 1024)))
+# 長い音声は区切って並行に文字起こし（文字起こし用の枠 LLM_PER_USER_TRANSCRIBE の中で）
+AUDIO_PARALLEL   = min(int(os.getenv("AUDIO_PARALLEL", "3")), llm.per_user_limit("transcription"))
+audio_stats      = TranscriptionStats()
 
 CATEGORY_BLOCK_IDS = {
     "アイデア": {
@@ -92,6 +337,43 @@ CATEGORY_BLOCK_IDS = {
     "買い物リスト": "215476859b95803fa180e1aab0b99d42",
     "リンク":       "215476859b95808b8cadd1eb44789038",
 }
+MEMO_SUBCATEGORIES = [sub for v in CATEGORY_BLOCK_IDS.values() if isinstance(v, dict) for sub in v]
+# メモの検索用索引（「呼び出し」で使う）
+memo_index = MemoIndex(os.getenv("MEMO_INDEX_DB", "memo_index.db"))
+MEMO_RECALL_LIMIT = int(os.getenv("MEMO_RECALL_LIMIT", "10"))
+
+# 「タイマー」：期限が来たらプッシュで知らせる（同じタイミングのものは1通にまとめる）
+TIMER_MAX_SEC = int(os.getenv("TIMER_MAX_SEC", str(24 * 3600)))
+
+def notify_timers(uid, items):
+    lines = [f"・{t['label'] or 'タイマー'}（{format_duration(t['seconds'])}）" for t in items]
+    line_bot_api.push_message(uid, TextSendMessage(text="⏰ 時間です！\n" + "\n".join(lines)))
+
+timers = TimerScheduler(
+    notify_timers,
+    path=os.getenv("TIMER_DB", "timers.db"),
+    batch_window=float(os.getenv("TIMER_BATCH_WINDOW", "1.0")),
+    retry_backoff=float(os.getenv("TIMER_RETRY_BACKOFF", "30")),
+    max_attempts=int(os.getenv("TIMER_MAX_ATTEMPTS", "5")),
+)
+
+# 時間指定なしの「開始」〜「終了」の記録（Notionの「タスク」へはまとめて送る）
+activity = ActivityLedger(os.getenv("ACTIVITY_DB", "activity.db"),
+                          max_session=int(os.getenv("ACTIVITY_MAX_SEC", str(6 * 3600))))
+
+def send_activity_to_notion(sessions):
+    children = []
+    for s in sessions:
+        start = datetime.datetime.fromtimestamp(s["started_at"])
+        end = datetime.datetime.fromtimestamp(s["ended_at"])
+        note = "（終了押し忘れ）" if s["capped"] else ""
+        text = f"{start:%Y-%m-%d %H:%M}〜{end:%H:%M} {s['task']}（{format_duration(round(s['seconds']))}）{note}"
+        children.append({"object": "block", "type": "paragraph",
+                         "paragraph": {"rich_text": [{"type": "text", "text": {"content": text}}]}})
+    return outbox.append_children(CATEGORY_BLOCK_IDS["タスク"], children, token=NOTION_MEMO_SECRET) is not None
+
+activity_sync = LedgerSync(activity, send_activity_to_notion,
+                           interval=float(os.getenv("ACTIVITY_SYNC_INTERVAL", "60")))
 
 CLUSTERS = {
     "成長系":   ["誠実さ", "学び", "創造性", "自己成長", "探究心", "向上心", "努力"],
@@ -102,7 +384,8 @@ CLUSTERS = {
     "健康系":   ["健康", "体力", "活力", "バランス", "長寿", "自己管理", "ウェルネス"],
 }
 CLUSTER_LABELS = list(CLUSTERS.keys())
-MAX_PAIRWISE   = 9
+MAX_PAIRWISE   = 9   # 2択の最大回数（上位が安定すればもっと早く終わる）
+CARDSORT_SIZE  = 9   # カードソートに残す価値観の数
 
 PROP_MAP = {
     "ValueStar":     "Value★",
@@ -127,109 +410,116 @@ LIFE5_QUESTIONS = [
     "❓【Deep-Why】叶った時に満たされる感情 or 叶わなかった時に失うものを、感情で1行で教えてください。",
     "🎯【今日のミッション】2時間以内に、誰に対して、どんな貢献ができそうですか？"
 ]
-progress = {}  # uid → state dict
+progress = state_store.map("life5")  # uid → state dict
+value_prior = state_store.map("value_prior")  # uid → 価値観ごとのレーティング（履歴、期限なし）
 
 # ---------- ユーティリティ ----------
-def summarize(text: str) -> str:
-    prompt = f"以下を200字以内で要約してください。\n\n{text}"
+SUMMARY_MODEL          = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")  # 長文（音声の文字起こしなど）だけに使う
+SUMMARY_MAX_CHARS      = 200
+SUMMARY_LOCAL_MAX      = int(os.getenv("SUMMARY_LOCAL_MAX_CHARS", "600"))  # これ以下はLLMを呼ばずに手元で要約
+SUMMARY_PROMPT_VERSION = "v2"  # プロンプトを変えたら上げる（古いキャッシュを使わない）
+summary_tiers = TierStats()
+summary_cache = SummaryCache(
+    path=os.getenv("SUMMARY_CACHE_DB"),
+    memory_size=int(os.getenv("SUMMARY_CACHE_SIZE", "512")),
+    disk_max_bytes=int(os.getenv("SUMMARY_CACHE_MAX_BYTES", str(50 * 1024 * 1024))),
+)
+
+def summarize(text: str, uid=None, max_chars=SUMMARY_MAX_CHARS) -> str:
+    # 段（tier）：そのまま → 手元で要約（短文） → キャッシュ → LLM（長文のみ）
+    t0 = time.perf_counter()
+    text = text.strip()
+    if len(text) <= max_chars:
+        summary_cache.count_passthrough()
+        return _summary_done("passthrough", t0, text)
+    if len(text) <= SUMMARY_LOCAL_MAX:
+        return _summary_done("local", t0, extractive_summary(text, max_chars))
+    key = cache_key(text, f"{SUMMARY_PROMPT_VERSION}:{max_chars}", SUMMARY_MODEL)
+    cached = summary_cache.get(key)
+    if cached is not None:
+        return _summary_done("cache", t0, cached)
+    prompt = f"以下を{max_chars}字以内で要約してください。\n\n{text}"
     try:
-        res = client.chat.completions.create(
-            model="gpt-4o",
+        summary = llm.chat(
+            "summary", uid=uid,
+            model=SUMMARY_MODEL,
             messages=[
                 {"role": "system", "content": "あなたは日本語の要約AIです。"},
                 {"role": "user",   "content": prompt}
             ]
         )
-        return res.choices[0].message.content.strip()
     except Exception as e:
         print("[要約エラー]", e)
-        return text[:200]
+        return _summary_done("llm_fallback", t0, extractive_summary(text, max_chars))
+    summary = trim_sentences(summary, max_chars)  # 字数を守らない返事もあるので念のため
+    summary_cache.put(key, summary)
+    return _summary_done("llm", t0, summary)
+
+def _summary_done(tier, t0, summary):
+    elapsed = time.perf_counter() - t0
+    summary_tiers.record(tier, elapsed * 1000)
+    summary_seconds.observe(elapsed, tier)
+    return summary
 
 def create_notion_row(user_id, q1_summary):
     now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
-    data = {
-        "parent": {"database_id": NOTION_DBID},
-        "properties": {
-            "Date":        {"title":[{"text":{"content":now}}]},
-            "UserID":      {"rich_text":[{"text":{"content":user_id}}]},
-            "Q1_Summary":  {"rich_text":[{"text":{"content":q1_summary}}]},
-            "Q2_Summary":  {"rich_text":[]},
-            "Q3_Summary":  {"rich_text":[]},
-            "Q4_Summary":  {"rich_text":[]},
-            "Q5_Summary":  {"rich_text":[]},
-        }
-    }
-    r = requests.post("https://api.notion.com/v1/pages",
-                      headers={
-                          "Authorization":f"Bearer {NOTION_TOKEN}",
-                          "Content-Type":"application/json",
-                          "Notion-Version":"2022-06-28"
-                      },
-                      json=data)
-    print("[Notion create]", r.status_code)
-    return r.json().get("id") if r.ok else None
+    page_id = outbox.create_page(NOTION_DBID, {
+        "Date":        {"title":[{"text":{"content":now}}]},
+        "UserID":      {"rich_text":[{"text":{"content":user_id}}]},
+        "Q1_Summary":  {"rich_text":[{"text":{"content":q1_summary}}]},
+        "Q2_Summary":  {"rich_text":[]},
+        "Q3_Summary":  {"rich_text":[]},
+        "Q4_Summary":  {"rich_text":[]},
+        "Q5_Summary":  {"rich_text":[]},
+    })
+    print("[Notion create]", page_id)
+    return page_id
 
 def update_notion_row(page_id, key, value):
     notion_key = PROP_MAP.get(key, key)          # Python で使うキー → Notion 列名
-    r = requests.patch(
-        f"https://api.notion.com/v1/pages/{page_id}",
-        headers={
-            "Authorization": f"Bearer {NOTION_TOKEN}",
-            "Content-Type":  "application/json",
-            "Notion-Version":"2022-06-28",
-        },
-        json={
-            "properties": {
-                notion_key: {                 # ← ここを修正
-                    "rich_text": [
-                        { "text": { "content": value } }
-                    ]
-                }
-            }
-        }
-    )
-    print("[Notion update]", notion_key, r.status_code, r.text)
-
-def create_review_page(user_id, now):
-    data = {
-        "parent": {"database_id": os.getenv("NOTION_REVIEW_DBID")},
-        "properties": {
-            "Date":          {"title": [{"text": {"content": now}}]},
-            "UserID":        {"rich_text": [{"text": {"content": user_id}}]},
-            "Value★":        {"rich_text": []},
-            "Value reason":  {"rich_text": []},
-            "Mission★":      {"rich_text": []},
-            "Mission reason":{"rich_text": []},
-            "Win":           {"rich_text": []},
-            "If-Then":       {"rich_text": []},
-            "Pride":         {"rich_text": []},
-            "Gratitude":     {"rich_text": []},
-            "EmotionTag":    {"rich_text": []},
-            "EmotionNote":   {"rich_text": []},
-            "Insight":       {"rich_text": []},
-            "TomorrowMIT":   {"rich_text": []},
+    ok = outbox.update_page(page_id, {
+        notion_key: {                 # ← ここを修正
+            "rich_text": [
+                { "text": { "content": value } }
+            ]
         }
-    }
-    r = requests.post(
-        "https://api.notion.com/v1/pages",
-        headers={
-            "Authorization": f"Bearer {NOTION_TOKEN}",
-            "Content-Type": "application/json",
-            "Notion-Version": "2022-06-28",
-        },
-        json=data,
+    })
+    print("[Notion update]", notion_key, ok)
+
+def rich_text(value):
+    return {"rich_text": [{"text": {"content": value}}] if value else []}
+
+def create_review_page(user_id, now, props=None):
+    page_id = outbox.create_page(os.getenv("NOTION_REVIEW_DBID"), {
+        "Date":          {"title": [{"text": {"content": now}}]},
+        "UserID":        {"rich_text": [{"text": {"content": user_id}}]},
+        "Value★":        {"rich_text": []},
+        "Value reason":  {"rich_text": []},
+        "Mission★":      {"rich_text": []},
+        "Mission reason":{"rich_text": []},
+        "Win":           {"rich_text": []},
+        "If-Then":       {"rich_text": []},
+        "Pride":         {"rich_text": []},
+        "Gratitude":     {"rich_text": []},
+        "EmotionTag":    {"rich_text": []},
+        "EmotionNote":   {"rich_text": []},
+        "Insight":       {"rich_text": []},
+        "TomorrowMIT":   {"rich_text": []},
+        **(props or {}),
+    })
+    print("[Notion review page create]", page_id)
+    return page_id
+
+def pair_message(a, b):
+    return TextSendMessage(
+        text=f"どちらがより大事？\nA: {a}\nB: {b}",
+        quick_reply=QuickReply(items=[
+            QuickReplyButton(action=MessageAction(label=f"A:{a}", text=f"ペア:{a}")),
+            QuickReplyButton(action=MessageAction(label=f"B:{b}", text=f"ペア:{b}")),
+        ])
     )
-    print("[Notion review page create]", r.status_code, r.text)
-    return r.json().get("id") if r.ok else None
-
-def build_pairs(values: list, n_pairs: int):
-    random.shuffle(values)
-    idx = list(range(len(values)))
-    pairs = [(i, j) for i in idx for j in idx if i < j]
-    random.shuffle(pairs)
-    return pairs[:n_pairs]
 
-def generate_ai_hint(theme, prev_inputs=None, prev_hints=None):
+def generate_ai_hint(theme, prev_inputs=None, prev_hints=None, uid=None):
     # テーマ別のヒント生成プロンプト設計
     if theme == "挑戦経験":
         prompt = (
@@ -263,7 +553,8 @@ def generate_ai_hint(theme, prev_inputs=None, prev_hints=None):
             "これらと重複しない、ユーザーが深く考えるきっかけになるようなヒントや問いを日本語で1つだけ、1行で出してください。"
         )
     try:
-        res = client.chat.completions.create(
+        hint = llm.chat(
+            "hint", uid=uid,
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": "あなたは人生の問いや気づきを与えるプロの質問家です。"},
@@ -271,354 +562,20 @@ def generate_ai_hint(theme, prev_inputs=None, prev_hints=None):
             ]
         )
         # 1行だけ
-        return [res.choices[0].message.content.strip().split("\n")[0]]
+        return [hint.split("\n")[0]]
     except Exception as e:
         print("[ヒント生成エラー]", e)
         return ["（ヒント生成に失敗しました）"]
 
-# ---------- メインロジック ----------
-def life5_flow(uid, text, event, is_audio=False):
-    st = progress.setdefault(uid, {})
-    # 0) /life5 スタート ---------------------------------
-    if text.lower() == "/life5":
-        st.clear(); st["mode"]="theme"
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(
-                text=("人生＝時間（生まれてから死ぬまで）\n"
-                      "満足した人生で終わりたい？後悔したまま？\n"
-                      "死ぬ間際の後悔トップ３は ①健康 ②挑戦経験 ③人間関係\n\n"
-                      "今日はどのテーマを考える？"),
-                quick_reply=QuickReply(items=[
-                    QuickReplyButton(action=MessageAction(label=k, text=f"テーマ:{k}"))
-                    for k in Q1_QUESTIONS.keys()
-                ])
-            )
-        )
-        return True
-    # 1) テーマ選択 --------------------------------------
-    if text.startswith("テーマ:"):
-        theme = text.replace("テーマ:", "")
-        st.clear()
-        st.update(theme=theme, mode="q1", q1_text="", page_id=None, hints=[])
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=Q1_QUESTIONS[theme]))
-        return True
-
-    # Q1ヒント（AI生成、重複防止付き）
-    if text.strip() == "ヒント" and st.get("mode") == "q1":
-        theme = st.get("theme")
-        prev_inputs = [st.get("q1_text", "")]
-        prev_hints  = st.get("hints", [])
-        new_hint = generate_ai_hint(theme, prev_inputs, prev_hints)[0]
-        # 履歴に追加
-        st.setdefault("hints", []).append(new_hint)
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=f"ヒント：\n・{new_hint}")
-        )
-        return True
-
-    # 2) Q1: 後悔シナリオ入力 ----------------------------
-    if st.get("mode") == "q1":
-        st["q1_text"] = text
-        q1_summary   = summarize(text)
-        page_id      = create_notion_row(uid, q1_summary)
-        st.update(page_id=page_id, mode="cluster", selected_clusters=[])
-        # 要約表示
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(
-                text=f"🔹あなたの要約：\n{q1_summary}\n\n"
-                     "後悔しないために重要だと思う価値観を選んでください（2つまで）",
-                quick_reply=QuickReply(items=[
-                    QuickReplyButton(action=MessageAction(label=cl, text=f"クラスタ:{cl}"))
-                    for cl in CLUSTER_LABELS
-                ])
-            )
-        )
-        return True
-
-    # 3) クラスタ選択（フィルタ）--------------------------
-    if text.startswith("クラスタ:") and st.get("mode") == "cluster":
-        sel = text.replace("クラスタ:", "")
-        if sel not in CLUSTER_LABELS or sel in st["selected_clusters"]:
-            return True
-        st["selected_clusters"].append(sel)
-        if len(st["selected_clusters"]) < 2:
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(
-                    text=f"もう1つ選んでください（{','.join(st['selected_clusters'])}）",
-                    quick_reply=QuickReply(items=[
-                        QuickReplyButton(action=MessageAction(label=cl, text=f"クラスタ:{cl}"))
-                        for cl in CLUSTER_LABELS if cl not in st["selected_clusters"]
-                    ])
-                )
-            )
-            return True
-        values = sum([CLUSTERS[c] for c in st["selected_clusters"]], [])
-        st.update(pair_vals=values, pair_scores={v:0 for v in values},
-                  pairs=build_pairs(values, MAX_PAIRWISE), p_idx=0, mode="pairwise")
-        i, j = st["pairs"][0]
-        a, b = values[i], values[j]
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(
-                text=f"どちらがより大事？\nA: {a}\nB: {b}",
-                quick_reply=QuickReply(items=[
-                    QuickReplyButton(action=MessageAction(label=f"A:{a}", text=f"ペア:{a}")),
-                    QuickReplyButton(action=MessageAction(label=f"B:{b}", text=f"ペア:{b}")),
-                ])
-            )
-        )
-        return True
-
-    # ブロック音声入力
-    if st.get("mode") in ["cluster", "pairwise", "cardsort"]:
-        if is_audio:
-            line_bot_api.reply_message(event.reply_token,
-                TextSendMessage("このステップはボタンで選んでください。"))
-            return True
-
-    # 4) ペアワイズ回答 ----------------------------------
-    if text.startswith("ペア:") and st.get("mode") == "pairwise":
-        val = text.replace("ペア:", "")
-        if val in st["pair_scores"]:
-            st["pair_scores"][val] += 1
-        st["p_idx"] += 1
-        if st["p_idx"] < len(st["pairs"]):
-            i, j = st["pairs"][st["p_idx"]]
-            a, b = st["pair_vals"][i], st["pair_vals"][j]
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(
-                    text=f"どちらがより大事？\nA: {a}\nB: {b}",
-                    quick_reply=QuickReply(items=[
-                        QuickReplyButton(action=MessageAction(label=f"A:{a}", text=f"ペア:{a}")),
-                        QuickReplyButton(action=MessageAction(label=f"B:{b}", text=f"ペア:{b}")),
-                    ])
-                )
-            )
-        else:
-            top9 = sorted(st["pair_scores"], key=st["pair_scores"].get, reverse=True)[:9]
-            st.update(cards=top9, mode="cardsort")
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(
-                    text="一番大事だと思う価値観を1つ選んでください",
-                    quick_reply=QuickReply(items=[
-                        QuickReplyButton(action=MessageAction(label=card, text=f"カード:{card}"))
-                        for card in top9
-                    ])
-                )
-            )
-        return True
-
-    # 5) カードソート（1枚タップ）------------------------
-    if text.startswith("カード:") and st.get("mode") == "cardsort":
-        card = text.replace("カード:", "")
-        if card not in st["cards"]:
-            return True
-
-        progress[uid]["latest_value"] = card
-        st.update(most=card, mode="q2_reason")
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=f"なぜ「{card}」を選びましたか？理由を教えてください。")
-        )
-        return True
-
-    # 6) 理由入力 → Notion Q2 保存 ------------------------
-    if st.get("mode") == "q2_reason":
-        summary = summarize(f"{st['most']}（理由：{text}）")
-        if st.get("page_id"):
-            update_notion_row(st["page_id"], "Q2_Summary", summary)
-        st.update(mode="after", step=2)
-        # 要約表示
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(
-                text=f"🔹あなたの要約：\n{summary}\n\nあなたの最重要価値観は「{st['most']}」です！\n\n次へ進みます\n\n{LIFE5_QUESTIONS[2]}"
-            )
-        )
-        return True
-
-    # 7) Q3〜Q5 ------------------------------------------
-    if st.get("mode") == "after":
-        step = st["step"]
-        if st.get("page_id"):
-            summary = summarize(text)
-            update_notion_row(st["page_id"], f"Q{step+1}_Summary", summary)
-        else:
-            summary = summarize(text)
-        if step + 1 == 5:
-            progress[uid]["latest_mission"] = text
-        if step + 1 < len(LIFE5_QUESTIONS):
-            st["step"] += 1
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(
-                    text=f"🔹あなたの要約：\n{summary}\n\n{LIFE5_QUESTIONS[step+1]}"
-                )
-            )
-        else:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(
-                text=f"🔹あなたの要約：\n{summary}\n\n✅ すべて回答しました。ありがとう！"))
-        return True
-
-    return False  # 未処理
-
-# ---------- LINE ハンドラ ----------
-@handler.add(MessageEvent, message=TextMessage)
-def handle_text(event):
-    uid  = event.source.user_id
-    text = event.message.text.strip()
-
-    # ----- ここからmemoフロー -----
-    # 1. memoボタン
-    if text == "memo":
-        memo_state[uid] = {"step": "mode_select"}
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(
-                text="何をしますか？",
-                quick_reply=QuickReply(
-                    items=[
-                        QuickReplyButton(action=MessageAction(label="メモ", text="メモ")),
-                        QuickReplyButton(action=MessageAction(label="呼び出し", text="呼び出し")),
-                        QuickReplyButton(action=MessageAction(label="タイマー", text="タイマー")),
-                    ]
-                )
-            )
-        )
-        return
-
-    # 2. 「メモ」選択
-    if memo_state.get(uid, {}).get("step") == "mode_select" and text == "メモ":
-        memo_state[uid]["step"] = "category_select"
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(
-                text="カテゴリを選んでください",
-                quick_reply=QuickReply(
-                    items=[
-                        QuickReplyButton(action=MessageAction(label=cat, text=cat))
-                        for cat in CATEGORY_BLOCK_IDS.keys()
-                    ]
-                )
-            )
-        )
-        return
-
-    # 3. カテゴリ選択
-    if memo_state.get(uid, {}).get("step") == "category_select":
-        category = text
-        memo_state[uid]["category"] = category
-
-        # 「アイデア」の場合はサブカテゴリ選択
-        if category == "アイデア":
-            memo_state[uid]["step"] = "subcategory_select"
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(
-                    text="どちらのアイデアですか？",
-                    quick_reply=QuickReply(
-                        items=[
-                            QuickReplyButton(action=MessageAction(label="仕事", text="仕事")),
-                            QuickReplyButton(action=MessageAction(label="プライベート", text="プライベート")),
-                        ]
-                    )
-                )
-            )
-            return
-
-        # それ以外のカテゴリはそのまま内容入力
-        memo_state[uid]["step"] = "content_input"
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage("内容を入力してください")
-        )
-        return
-
-    # サブカテゴリ選択
-    if memo_state.get(uid, {}).get("step") == "subcategory_select":
-        subcategory = text
-        memo_state[uid]["subcategory"] = subcategory
-        memo_state[uid]["step"] = "content_input"
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage("内容を入力してください")
-        )
-        return
-
-    # 内容入力
-    if memo_state.get(uid, {}).get("step") == "content_input":
-        category = memo_state[uid].get("category")
-        subcategory = memo_state[uid].get("subcategory")
-        content = text
-        add_memo_to_notion(category, content, subcategory)
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage("メモを保存しました！")
-        )
-        memo_state.pop(uid, None)
-        return
-    # ----- ここまでmemoフロー -----
-
-    # Reviewフロー優先
-    if review_flow(uid, text, event, is_audio=False):
-        return
-    # Life5フロー
-    if not life5_flow(uid, text, event, is_audio=False):
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("その操作は現在のステップでは使えません。"))
-
-@handler.add(MessageEvent, message=AudioMessage)
-def handle_audio(event):
-    uid = event.source.user_id
-    try:
-        mid = event.message.id
-        audio = line_bot_api.get_message_content(mid)
-        with tempfile.NamedTemporaryFile(suffix=".m4a", delete=False) as tmp:
-            for c in audio.iter_content(): tmp.write(c); tmp.flush()
-            with open(tmp.name, "rb") as f:
-                txt = client.audio.transcriptions.create(model="whisper-1", file=f).text.strip()
-
-        if memo_state.get(uid):
-            # memoの進行状況によって分岐させる
-            # たとえば「内容入力待ち」なら音声テキストをそのまま入れる
-            if memo_state[uid].get("step") == "content_input":
-                category = memo_state[uid].get("category", "未分類")
-                subcategory = memo_state[uid].get("subcategory")
-                content = txt
-                add_memo_to_notion(category, content, subcategory)
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage("メモを保存しました！（音声入力）")
-                )
-                memo_state.pop(uid, None)
-                return
-            else:
-                # それ以外のステップでは未対応
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage("音声は内容入力のタイミングでのみ使えます。")
-                )
-                return
-
-        # --- ここで review_flowを先に通す！ ---
-        if review_flow(uid, txt, event, is_audio=True):
-            return
-        # Life5フローも通す
-        if not life5_flow(uid, txt, event, is_audio=True):
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("その操作は現在のステップでは使えません。"))
-    except Exception as e:
-        print("Whisper error:", e)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("⚠️ 音声の文字起こしに失敗しました。"))
-
-import re
+# 「ヒント」を即答するための事前生成プール（HINT_POOL_HIGH=0 で無効）
+hint_pool = HintPool(
+    generate_ai_hint, Q1_QUESTIONS.keys(),
+    low=int(os.getenv("HINT_POOL_LOW", "2")),
+    high=int(os.getenv("HINT_POOL_HIGH", "5")),
+)
 
 # Reviewの状態管理（ユーザーごとに進捗を記録）
-review_progress = {}  # uid → state dict
+review_progress = state_store.map("review")  # uid → state dict
 
 REVIEW_QUESTIONS = [
     {
@@ -695,156 +652,619 @@ REVIEW_QUESTIONS = [
     },
 ]
 
-def review_flow(uid, text, event, is_audio=False):
-    st = review_progress.setdefault(uid, {})
-    print(f"[review_flow] uid={uid}, step={st.get('step')}, text='{text}'")
-    # --- レビュー開始で他フローの状態を消去 ---
-    if text.lower() == "/review":
-        st.clear()
-        st["step"] = 0
-        st["answers"] = {}
-
-        st["latest_value"] = progress.get(uid, {}).get("latest_value", "")
-        st["latest_mission"] = progress.get(uid, {}).get("latest_mission", "")
-
-        progress.pop(uid, None)
-        # 新規ページをNotionに作成
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
-        page_id = create_review_page(uid, now)
-        st["page_id"] = page_id
-        ask_review_question(uid, event, 0)
-        return True
-
-    if "step" not in st:
-        print("[review_flow] step not in st!", st)
-        return False  # このフロー外
+# ---------- クイックリプライ（起動時に1回だけ作る） ----------
+def quick_reply(pairs):
+    return QuickReply(items=[
+        QuickReplyButton(action=MessageAction(label=label, text=text)) for label, text in pairs
+    ])
+
+QR_MEMO_MENU       = quick_reply([("メモ", "メモ"), ("呼び出し", "呼び出し"), ("タイマー", "タイマー")])
+QR_MEMO_CATEGORIES = quick_reply([(cat, cat) for cat in CATEGORY_BLOCK_IDS.keys()])
+QR_IDEA_SUB        = quick_reply([("仕事", "仕事"), ("プライベート", "プライベート")])
+QR_TIMER           = quick_reply([("5分", "5分"), ("15分", "15分"), ("25分", "25分"), ("1時間", "1時間")])
+QR_RECALL          = quick_reply([("すべて", "すべて"), ("今週", "今週")]
+                                 + [(cat, cat) for cat in CATEGORY_BLOCK_IDS.keys()])
+QR_THEMES          = quick_reply([(k, f"テーマ:{k}") for k in Q1_QUESTIONS.keys()])
+QR_CLUSTERS        = quick_reply([(cl, f"クラスタ:{cl}") for cl in CLUSTER_LABELS])
+QR_CLUSTERS_EXCEPT = {
+    sel: quick_reply([(cl, f"クラスタ:{cl}") for cl in CLUSTER_LABELS if cl != sel])
+    for sel in CLUSTER_LABELS
+}
+QR_STARS           = quick_reply([(f"{'★'*n}{'☆'*(5-n)}", str(n)) for n in range(1, 6)])
+QR_SKIP            = quick_reply([("スキップ", "スキップ")])
+QR_CHARTS          = quick_reply([(f"{p}のグラフ", f"グラフ:{p}") for p in CHART_PERIODS] + [("傾向を見る", "/insight")])
+QR_REVIEW_CHOICES  = {q["key"]: quick_reply([(c, c) for c in q["choices"]])
+                      for q in REVIEW_QUESTIONS if "choices" in q}
+STAR_LABELS        = {f"{'★'*n}{'☆'*(5-n)}": str(n) for n in range(1, 6)}
+
+# ---------- メッセージの振り分け ----------
+flows = StateMachine(
+    words={"memo": "memo", "/life5": "life5", "/review": "review", "/stats": "dashboard", "/insight": "insight",
+           "メモ": "memo_write", "呼び出し": "recall", "タイマー": "timer", "ヒント": "hint",
+           "終了": "stop"},
+    prefixes={"開始": "start", "終了": "stop", "グラフ": "chart", "テーマ": "theme", "クラスタ": "cluster", "ペア": "pair", "カード": "card"},
+    observer=observe_step,
+)
 
-    step = st["step"]
-    q = REVIEW_QUESTIONS[step]
+def memo_step(uid):
+    return memo_state.get(uid, {}).get("step")
+
+def review_step(uid):
+    st = review_progress.get(uid)
+    if not st or "step" not in st or st["step"] >= len(REVIEW_QUESTIONS):
+        return None  # このフロー外
+    q = REVIEW_QUESTIONS[st["step"]]
+    if q["type"] == "emotion" and "EmotionTag_main" in st:
+        return "emotion_note"
+    return q["type"]
+
+def life5_step(uid):
+    return progress.get(uid, {}).get("mode") or ""
+
+# 優先順: memo → review → life5
+flows.flow("memo", memo_step)
+flows.flow("review", review_step)
+flows.flow("life5", life5_step)
+
+# ---------- memoフロー ----------
+# 1. memoボタン
+@flows.command("memo")
+def memo_start(ctx):
+    memo_state[ctx.uid] = {"step": "mode_select"}
+    line_bot_api.reply_message(ctx.event.reply_token, TextSendMessage(text="何をしますか？", quick_reply=QR_MEMO_MENU))
+
+# 2. 「メモ」選択
+@flows.route("memo", "mode_select", "memo_write")
+def memo_mode_select(ctx):
+    memo_state[ctx.uid]["step"] = "category_select"
+    line_bot_api.reply_message(
+        ctx.event.reply_token,
+        TextSendMessage(text="カテゴリを選んでください", quick_reply=QR_MEMO_CATEGORIES)
+    )
 
-    # 音声入力の許可判定（star_reasonとemotionも許可）
-    if is_audio and q["type"] not in ("text", "star_reason", "emotion"):
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("このステップはボタンで選んでください。"))
-        return True
-
-    # star型（★選択）
-    if q["type"] == "star":
-        if re.fullmatch(r"[★☆]{1,5}", text) or (text.isdigit() and 1 <= int(text) <= 5):
-            val = str(text.count("★")) if "★" in text else str(text)
-            st["answers"][q["key"]] = val
-
-            # ★ ValueStarのときだけNotionページ新規作成
-            if q["key"] == "ValueStar" and "page_id" not in st:
-                now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
-                page_id = create_review_page(uid, now)
-                st["page_id"] = page_id
-
-            # --- ここで即時保存 ---
-            if "page_id" in st and st["page_id"]:
-                update_notion_row(st["page_id"], q["key"], val)
-
-            st["step"] += 1
-            ask_review_question(uid, event, st["step"], prev_star=val)
-            return True
-        # QuickReply以外は弾く
-        star_labels = [f"{'★'*n}{'☆'*(5-n)}" for n in range(1,6)]
-        if text not in star_labels and text not in [str(n) for n in range(1,6)]:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("1〜5 の★で選んでください。"))
-            return True
-
-    # star_reason型
-    elif q["type"] == "star_reason":
-        # 音声時は要約・100字制限
-        if is_audio:
-            text = summarize(text)[:100]
-        if text in q["choices"]:
-            st["answers"][q["key"]] = text
-        elif len(text) <= 100:
-            st["answers"][q["key"]] = text
-        else:
-            # 自動要約＆100字以内で保存
-            text = summarize(text)[:100]
-            st["answers"][q["key"]] = text
-        if "page_id" in st and st["page_id"]:
-            update_notion_row(st["page_id"], q["key"], text)
+# 3. カテゴリ選択
+@flows.route("memo", "category_select")
+def memo_category_select(ctx):
+    st = memo_state[ctx.uid]
+    category = ctx.text
+    st["category"] = category
+
+    # 「アイデア」の場合はサブカテゴリ選択
+    if category == "アイデア":
+        st["step"] = "subcategory_select"
+        line_bot_api.reply_message(
+            ctx.event.reply_token,
+            TextSendMessage(text="どちらのアイデアですか？", quick_reply=QR_IDEA_SUB)
+        )
+        return
+
+    # それ以外のカテゴリはそのまま内容入力
+    st["step"] = "content_input"
+    line_bot_api.reply_message(ctx.event.reply_token, TextSendMessage("内容を入力してください"))
+
+# サブカテゴリ選択
+@flows.route("memo", "subcategory_select")
+def memo_subcategory_select(ctx):
+    st = memo_state[ctx.uid]
+    st["subcategory"] = ctx.text
+    st["step"] = "content_input"
+    line_bot_api.reply_message(ctx.event.reply_token, TextSendMessage("内容を入力してください"))
+
+# 内容入力（音声はテキストをそのまま入れる）
+@flows.route("memo", "content_input", ("text", "audio"))
+def memo_content_input(ctx):
+    st = memo_state[ctx.uid]
+    add_memo_to_notion(st.get("category"), ctx.text, st.get("subcategory"))
+    line_bot_api.reply_message(
+        ctx.event.reply_token,
+        TextSendMessage("メモを保存しました！（音声入力）" if ctx.is_audio else "メモを保存しました！")
+    )
+    memo_state.pop(ctx.uid, None)
+
+# 「呼び出し」選択
+@flows.route("memo", "mode_select", "recall")
+def memo_recall_select(ctx):
+    memo_state[ctx.uid]["step"] = "recall"
+    line_bot_api.reply_message(
+        ctx.event.reply_token,
+        TextSendMessage(
+            text="キーワード・カテゴリ・期間（今日/昨日/今週/7日 など）をスペース区切りで入力してください",
+            quick_reply=QR_RECALL
+        )
+    )
+
+# 検索条件の入力 → ローカル索引から最新順に返す（音声でキーワードを言ってもOK）
+@flows.route("memo", "recall", ("text", "audio"))
+def memo_recall(ctx):
+    query = parse_query(ctx.text, CATEGORY_BLOCK_IDS, MEMO_SUBCATEGORIES)
+    hits = memo_index.search(limit=MEMO_RECALL_LIMIT, **query)
+    memo_state.pop(ctx.uid, None)
+    if not hits:
+        line_bot_api.reply_message(ctx.event.reply_token, TextSendMessage("該当するメモはありませんでした。"))
+        return
+    lines = []
+    for h in hits:
+        day = datetime.datetime.fromtimestamp(h["created_at"]).strftime("%m/%d")
+        label = f"{h['category']}/{h['subcategory']}" if h["subcategory"] else h["category"]
+        lines.append(f"・{day}［{label}］{h['content']}")
+    line_bot_api.reply_message(
+        ctx.event.reply_token,
+        TextSendMessage(text=f"🔎 {len(hits)}件\n" + "\n".join(lines)[:4900])
+    )
+
+# 「タイマー」選択
+@flows.route("memo", "mode_select", "timer")
+def memo_timer_select(ctx):
+    memo_state[ctx.uid]["step"] = "timer"
+    line_bot_api.reply_message(
+        ctx.event.reply_token,
+        TextSendMessage(text="「読書15分」のように、やること＋時間を送ってください\n"
+                             "「読書」だけなら、開始〜終了までの時間を記録します", quick_reply=QR_TIMER)
+    )
+
+# 時間の入力 → タイマー登録（音声で「読書15分」でもOK）
+@flows.route("memo", "timer", ("text", "audio"))
+def memo_timer(ctx):
+    parsed = parse_timer(ctx.text)
+    if not parsed and ctx.text and len(ctx.text) <= 20 and not any(ch.isdigit() for ch in ctx.text):
+        # 時間指定なし → 開始〜終了の記録
+        memo_state.pop(ctx.uid, None)
+        return activity_start(ctx, ctx.text)
+    if not parsed or parsed[1] > TIMER_MAX_SEC:
+        line_bot_api.reply_message(
+            ctx.event.reply_token,
+            TextSendMessage(text="時間が読み取れませんでした。「読書15分」「散歩1時間」のように送ってください",
+                            quick_reply=QR_TIMER)
+        )
+        return
+    label, seconds = parsed
+    _, due_at = timers.add(ctx.uid, label, seconds)
+    memo_state.pop(ctx.uid, None)
+    at = datetime.datetime.fromtimestamp(due_at).strftime("%H:%M")
+    line_bot_api.reply_message(
+        ctx.event.reply_token,
+        TextSendMessage(f"⏰ {label + ' ' if label else ''}{format_duration(seconds)}のタイマーをセットしました（{at}ごろ通知）")
+    )
+
+# 開始（「開始:読書」はフローの途中でなければどこからでも。メモ本文や振り返りの自由入力が
+# 「開始:…」「終了」だったときは、そちらの入力として扱う）
+@flows.command("start", after_flows=True)
+def activity_start(ctx, task=None):
+    task = (task or ctx.arg or "").strip()
+    if not task:
+        line_bot_api.reply_message(ctx.event.reply_token, TextSendMessage("何を始めるか教えてください（例：開始:読書）"))
+        return
+    status = activity.start(ctx.uid, task)
+    text = f"▶ {task} を開始しました。終わったら「終了」を押してください"
+    if status == "running":
+        started = next((r["started_at"] for r in activity.running(ctx.uid) if r["task"] == task), None)
+        text = f"▶ {task} はすでに開始しています（{datetime.datetime.fromtimestamp(started):%H:%M}〜）"
+    elif status == "restarted":
+        text += "\n（前回の終了が押されていなかったので打ち切りました）"
+    line_bot_api.reply_message(
+        ctx.event.reply_token,
+        TextSendMessage(text=text, quick_reply=quick_reply([("終了", f"終了:{task}")]))
+    )
+
+# 終了（タスク名なしの「終了」は、開始中が1つだけならそれを止める）
+@flows.command("stop", after_flows=True)
+def activity_stop(ctx):
+    task = ctx.arg.strip() if ctx.arg else None
+    running = activity.running(ctx.uid)
+    if task is None and len(running) > 1:
+        line_bot_api.reply_message(
+            ctx.event.reply_token,
+            TextSendMessage(text="どれを終了しますか？",
+                            quick_reply=quick_reply([(r["task"], f"終了:{r['task']}") for r in running]))
+        )
+        return
+    done = activity.stop(ctx.uid, task)
+    if done is None:
+        line_bot_api.reply_message(ctx.event.reply_token, TextSendMessage("開始中の記録が見つかりませんでした。"))
+        return
+    today, week = activity.total(ctx.uid, done["task"])
+    note = "\n（終了が押されていなかったので打ち切りました）" if done["capped"] else ""
+    line_bot_api.reply_message(
+        ctx.event.reply_token,
+        TextSendMessage(f"⏹ {done['task']} {format_duration(round(done['seconds']))} を記録しました{note}\n"
+                        f"今日の合計 {format_duration(round(today))} ／ 今週 {format_duration(round(week))}")
+    )
+
+# それ以外のステップでは音声は未対応
+@flows.route("memo", "*", "audio")
+def memo_audio_not_supported(ctx):
+    line_bot_api.reply_message(ctx.event.reply_token, TextSendMessage("音声は内容入力のタイミングでのみ使えます。"))
+
+# ---------- Life5フロー ----------
+# 0) /life5 スタート ---------------------------------
+@flows.command("life5")
+def life5_start(ctx):
+    # 他フローの途中状態は破棄
+    memo_state.pop(ctx.uid, None)
+    review_progress.pop(ctx.uid, None)
+    st = progress.setdefault(ctx.uid, {})
+    st.clear(); st["mode"]="theme"
+    hint_pool.start()
+    line_bot_api.reply_message(
+        ctx.event.reply_token,
+        TextSendMessage(
+            text=("人生＝時間（生まれてから死ぬまで）\n"
+                  "満足した人生で終わりたい？後悔したまま？\n"
+                  "死ぬ間際の後悔トップ３は ①健康 ②挑戦経験 ③人間関係\n\n"
+                  "今日はどのテーマを考える？"),
+            quick_reply=QR_THEMES
+        )
+    )
+
+# 1) テーマ選択 --------------------------------------
+@flows.route("life5", "*", "theme")
+def life5_theme(ctx):
+    theme = ctx.arg
+    if theme not in Q1_QUESTIONS:
+        return False
+    st = progress.setdefault(ctx.uid, {})
+    st.clear()
+    st.update(theme=theme, mode="q1", q1_text="", page_id=None, hints=[])
+    line_bot_api.reply_message(ctx.event.reply_token, TextSendMessage(text=Q1_QUESTIONS[theme]))
+    # 「ヒント」が押されたときのために、このユーザー向けのヒントを先に作っておく
+    hint_pool.speculate(ctx.uid, theme)
+
+# Q1ヒント（AI生成、重複防止付き）
+@flows.route("life5", "q1", "hint")
+def life5_hint(ctx):
+    st = progress[ctx.uid]
+    theme = st.get("theme")
+    prev_inputs = [st.get("q1_text", "")]
+    prev_hints  = st.get("hints", [])
+    # 先読み・プールにあればそれを使い、無ければその場で生成
+    new_hint = hint_pool.take(ctx.uid, theme, prev_hints) or generate_ai_hint(theme, prev_inputs, prev_hints, uid=ctx.uid)[0]
+    # 履歴に追加
+    st.setdefault("hints", []).append(new_hint)
+    hint_pool.speculate(ctx.uid, theme, prev_inputs, st["hints"])
+    line_bot_api.reply_message(ctx.event.reply_token, TextSendMessage(text=f"ヒント：\n・{new_hint}"))
+
+# 2) Q1: 後悔シナリオ入力 ----------------------------
+@flows.route("life5", "q1", ("text", "audio"))
+def life5_q1(ctx):
+    st = progress[ctx.uid]
+    st["q1_text"] = ctx.text
+    q1_summary = summarize(ctx.text, ctx.uid)
+    # ページ作成は送信箱に積むだけ（仮IDがすぐ返る。以降の更新もこのIDに積む）
+    st["page_id"] = create_notion_row(ctx.uid, q1_summary)
+    st.update(mode="cluster", selected_clusters=[])
+    # 要約表示
+    line_bot_api.reply_message(
+        ctx.event.reply_token,
+        TextSendMessage(
+            text=f"🔹あなたの要約：\n{q1_summary}\n\n"
+                 "後悔しないために重要だと思う価値観を選んでください（2つまで）",
+            quick_reply=QR_CLUSTERS
+        )
+    )
+
+# 3) クラスタ選択（フィルタ）--------------------------
+@flows.route("life5", "cluster", "cluster")
+def life5_cluster(ctx):
+    st = progress[ctx.uid]
+    sel = ctx.arg
+    if sel not in CLUSTER_LABELS or sel in st["selected_clusters"]:
+        return
+    st["selected_clusters"].append(sel)
+    if len(st["selected_clusters"]) < 2:
+        line_bot_api.reply_message(
+            ctx.event.reply_token,
+            TextSendMessage(
+                text=f"もう1つ選んでください（{','.join(st['selected_clusters'])}）",
+                quick_reply=QR_CLUSTERS_EXCEPT[sel]
+            )
+        )
+        return
+    values = sum([CLUSTERS[c] for c in st["selected_clusters"]], [])
+    # 過去のセッションの結果を事前知識として使う
+    ranking = value_ranking.new_session(values, prior=value_prior.get(ctx.uid),
+                                        top_k=CARDSORT_SIZE, budget=MAX_PAIRWISE)
+    a, b = value_ranking.next_pair(ranking)
+    st.update(ranking=ranking, pair=[a, b], mode="pairwise")
+    line_bot_api.reply_message(ctx.event.reply_token, pair_message(a, b))
+
+# ブロック音声入力
+@flows.route("life5", ("cluster", "pairwise", "cardsort"), "audio")
+def life5_buttons_only(ctx):
+    line_bot_api.reply_message(ctx.event.reply_token, TextSendMessage("このステップはボタンで選んでください。"))
+
+# 4) ペアワイズ回答 ----------------------------------
+@flows.route("life5", "pairwise", "pair")
+def life5_pairwise(ctx):
+    st = progress[ctx.uid]
+    val = ctx.arg
+    ranking = st["ranking"]
+    a, b = st["pair"]
+    if val not in (a, b):
+        # 古いボタンが押された場合は今の2択を出し直す
+        line_bot_api.reply_message(ctx.event.reply_token, pair_message(a, b))
+        return
+    value_ranking.record(ranking, val, b if val == a else a)
+    nxt = None if value_ranking.is_done(ranking) else value_ranking.next_pair(ranking)
+    if nxt:
+        st["pair"] = list(nxt)
+        line_bot_api.reply_message(ctx.event.reply_token, pair_message(*nxt))
+        return
+    top9 = value_ranking.top_k(ranking)
+    st.update(cards=top9, mode="cardsort")
+    line_bot_api.reply_message(
+        ctx.event.reply_token,
+        TextSendMessage(
+            text="一番大事だと思う価値観を1つ選んでください",
+            quick_reply=quick_reply([(card, f"カード:{card}") for card in top9])
+        )
+    )
+
+# 5) カードソート（1枚タップ）------------------------
+@flows.route("life5", "cardsort", "card")
+def life5_cardsort(ctx):
+    st = progress[ctx.uid]
+    card = ctx.arg
+    if card not in st["cards"]:
+        return
+
+    st["latest_value"] = card
+    st.update(most=card, mode="q2_reason")
+    if st.get("ranking"):
+        value_prior[ctx.uid] = value_ranking.update_prior(value_prior.get(ctx.uid), st["ranking"], chosen=card)
+    line_bot_api.reply_message(
+        ctx.event.reply_token,
+        TextSendMessage(text=f"なぜ「{card}」を選びましたか？理由を教えてください。")
+    )
+
+# 6) 理由入力 → Notion Q2 保存 ------------------------
+@flows.route("life5", "q2_reason", ("text", "audio"))
+def life5_q2_reason(ctx):
+    st = progress[ctx.uid]
+    summary = summarize(f"{st['most']}（理由：{ctx.text}）", ctx.uid)
+    if st.get("page_id"):
+        update_notion_row(st["page_id"], "Q2_Summary", summary)
+    st.update(mode="after", step=2)
+    # 要約表示
+    line_bot_api.reply_message(
+        ctx.event.reply_token,
+        TextSendMessage(
+            text=f"🔹あなたの要約：\n{summary}\n\nあなたの最重要価値観は「{st['most']}」です！\n\n次へ進みます\n\n{LIFE5_QUESTIONS[2]}"
+        )
+    )
+
+# 7) Q3〜Q5 ------------------------------------------
+@flows.route("life5", "after", ("text", "audio"))
+def life5_after(ctx):
+    st = progress[ctx.uid]
+    step = st["step"]
+    summary = summarize(ctx.text, ctx.uid)
+    if st.get("page_id"):
+        update_notion_row(st["page_id"], f"Q{step+1}_Summary", summary)
+    if step + 1 == 5:
+        st["latest_mission"] = ctx.text
+    if step + 1 < len(LIFE5_QUESTIONS):
         st["step"] += 1
-        ask_review_question(uid, event, st["step"])
-        return True
+        line_bot_api.reply_message(
+            ctx.event.reply_token,
+            TextSendMessage(text=f"🔹あなたの要約：\n{summary}\n\n{LIFE5_QUESTIONS[step+1]}")
+        )
+    else:
+        line_bot_api.reply_message(ctx.event.reply_token, TextSendMessage(
+            text=f"🔹あなたの要約：\n{summary}\n\n✅ すべて回答しました。ありがとう！"))
+
+# ---------- Reviewフロー ----------
+# --- レビュー開始で他フローの状態を消去 ---
+@flows.command("review")
+def review_start(ctx):
+    uid = ctx.uid
+    st = review_progress.setdefault(uid, {})
+    st.clear()
+    st["step"] = 0
+    st["answers"] = {}
+
+    st["latest_value"] = progress.get(uid, {}).get("latest_value", "")
+    st["latest_mission"] = progress.get(uid, {}).get("latest_mission", "")
+
+    progress.pop(uid, None)
+    memo_state.pop(uid, None)
+    # Notionページはここで1回だけ作る（送信箱の仮IDがすぐ返る）。IDは進行状態に保存するので、
+    # 続きを別ワーカーや再起動後に受けても同じページに書く
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+    st["started"] = now  # 集計でこのReviewを見分けるキー（NotionのDate列と同じ）
+    st["page_id"] = create_review_page(uid, now)
+    ask_review_question(uid, ctx.event, 0)
+
+# --- 週次・月次のふりかえり（集計済みの値を引くだけ） ---
+@flows.command("dashboard")
+def review_dashboard(ctx):
+    summary = review_stats.summary(ctx.uid)
+
+    def line(label, p):
+        stars = " / ".join(f"{PROP_MAP.get(k, k)} {p[k] if p[k] is not None else '-'}" for k in ("ValueStar", "MissionStar"))
+        emotions = "、".join(f"{e}{n}" for e, n in sorted(p["emotions"].items(), key=lambda x: -x[1])) or "-"
+        return f"【{label}】{p['reviews']}回\n{stars}\n感情：{emotions}"
+
+    line_bot_api.reply_message(
+        ctx.event.reply_token,
+        TextSendMessage(text="📊 Reviewのまとめ\n"
+                             f"{line('今週', summary['week'])}\n{line('今月', summary['month'])}\n"
+                             f"🔥 連続 {summary['streak']}日（最長 {summary['best_streak']}日）",
+                        quick_reply=QR_CHARTS)
+    )
+
+@flows.command("insight")
+def review_insight(ctx):
+    # 履歴を NumPy に載せて、良い日と一緒に多いもの・前日の影響を相関で出す
+    from insights import analyze, insight_text  # NumPy は使うときに読み込む
+    line_bot_api.reply_message(ctx.event.reply_token,
+                               TextSendMessage(insight_text(analyze(review_stats.history(ctx.uid)))))
+
+def prerender_charts(uid):
+    # 集計が変わったときだけ描き直す（version が同じならキャッシュのキーを返すだけ）
+    # 描画は裏で進むので、ここは待たない
+    version = review_stats.version(uid)
+    keys = {}
+    for name, (kind, n, title) in CHART_PERIODS.items():
+        keys[name] = charts.prerender(uid, kind, version, title,
+                                      lambda kind=kind, n=n: review_stats.series(uid, kind, n))
+    return keys
+
+@flows.command("chart")
+def review_chart(ctx):
+    period = ctx.arg if ctx.arg in CHART_PERIODS else "週"
+    if not PUBLIC_BASE_URL:
+        line_bot_api.reply_message(ctx.event.reply_token, TextSendMessage("グラフを送るには PUBLIC_BASE_URL の設定が必要です。"))
+        return
+    url = f"{PUBLIC_BASE_URL}/charts/{prerender_charts(ctx.uid)[period]}.png"
+    line_bot_api.reply_message(ctx.event.reply_token, ImageSendMessage(original_content_url=url, preview_image_url=url))
+
+# 音声入力の許可判定（star_reasonとemotionは許可）
+@flows.route("review", "star", "audio")
+def review_buttons_only(ctx):
+    line_bot_api.reply_message(ctx.event.reply_token, TextSendMessage("このステップはボタンで選んでください。"))
+
+# star型（★選択）
+@flows.route("review", "star")
+def review_star(ctx):
+    st = review_progress[ctx.uid]
+    q = REVIEW_QUESTIONS[st["step"]]
+    text = ctx.text
+    if text in STAR_LABELS or re.fullmatch(r"[★☆]{1,5}", text) or (text.isdigit() and 1 <= int(text) <= 5):
+        val = str(text.count("★")) if "★" in text else str(text)
+        st["answers"][q["key"]] = val
+        record_review_answer(ctx.uid, {q["key"]: val})
 
-    # emotion型（選択＋任意補足）
-    elif q["type"] == "emotion":
-        if "EmotionTag_main" not in st:
-            if text in q["choices"]:
-                st["EmotionTag_main"] = text
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(
-                        text="必要なら100字以内で感情の補足を入力してください（スキップ可）",
-                        quick_reply=QuickReply(items=[
-                            QuickReplyButton(action=MessageAction(label="スキップ", text="スキップ"))
-                        ])
-                    )
-                )
-                if "page_id" in st and st["page_id"]:
-                    update_notion_row(st["page_id"], q["key"], text)
-                return True
-            else:
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(
-                        text="感情タグを１つ選んでください。",
-                        quick_reply=QuickReply(items=[
-                            QuickReplyButton(action=MessageAction(label=tag, text=tag))
-                            for tag in q["choices"]
-                        ])
-                    )
-                )
-                return True
-        # 補足説明（スキップor自由入力）ここも音声・100字制限
-        if text == "スキップ":
-            st["answers"][q["key"]] = st.pop("EmotionTag_main")
-            st["answers"]["EmotionNote"] = ""
-            if "page_id" in st and st["page_id"]:
-                update_notion_row(st["page_id"], q["key"], st["answers"][q["key"]])
-                update_notion_row(st["page_id"], "EmotionNote", "")
-            st["step"] += 1
-            ask_review_question(uid, event, st["step"])
-            return True
-        # ここで音声入力や長文も要約100字
-        note = summarize(text)[:100] if (is_audio or len(text) > 100) else text
-        st["answers"][q["key"]] = st.pop("EmotionTag_main")
-        st["answers"]["EmotionNote"] = note
-        if "page_id" in st and st["page_id"]:
-            update_notion_row(st["page_id"], q["key"], st["answers"][q["key"]])
-            update_notion_row(st["page_id"], "EmotionNote", note)
         st["step"] += 1
-        ask_review_question(uid, event, st["step"])
-        return True
-
-    # text型
-    elif q["type"] == "text":
-        # 音声または100字超→自動要約
-        if is_audio or len(text) > q["max_length"]:
-            text = summarize(text)[:q["max_length"]]
+        ask_review_question(ctx.uid, ctx.event, st["step"], prev_star=val)
+        return
+    # QuickReply以外は弾く
+    line_bot_api.reply_message(ctx.event.reply_token, TextSendMessage("1〜5 の★で選んでください。"))
+
+# star_reason型
+@flows.route("review", "star_reason", ("text", "audio"))
+def review_star_reason(ctx):
+    st = review_progress[ctx.uid]
+    q = REVIEW_QUESTIONS[st["step"]]
+    text = ctx.text
+    # 音声時は要約・100字制限
+    if ctx.is_audio:
+        text = summarize(text, ctx.uid, max_chars=100)
+    if text in q["choices"]:
         st["answers"][q["key"]] = text
-        if "page_id" in st and st["page_id"]:
-            update_notion_row(st["page_id"], q["key"], text)
-        st["step"] += 1
-        if st["step"] >= len(REVIEW_QUESTIONS):
-            review_progress.pop(uid, None)
-            line_bot_api.reply_message(event.reply_token, TextSendMessage("✅ Reviewの入力が完了しました。ありがとう！"))
-            return True
-        ask_review_question(uid, event, st["step"])
-        return True
+    elif len(text) <= 100:
+        st["answers"][q["key"]] = text
+    else:
+        # 自動要約＆100字以内で保存
+        text = summarize(text, ctx.uid, max_chars=100)
+        st["answers"][q["key"]] = text
+    record_review_answer(ctx.uid, {q["key"]: text})
+    st["step"] += 1
+    ask_review_question(ctx.uid, ctx.event, st["step"])
+
+# emotion型（選択＋任意補足）
+@flows.route("review", "emotion", ("text", "audio"))
+def review_emotion_tag(ctx):
+    st = review_progress[ctx.uid]
+    q = REVIEW_QUESTIONS[st["step"]]
+    if ctx.text in q["choices"]:
+        st["EmotionTag_main"] = ctx.text
+        line_bot_api.reply_message(
+            ctx.event.reply_token,
+            TextSendMessage(
+                text="必要なら100字以内で感情の補足を入力してください（スキップ可）",
+                quick_reply=QR_SKIP
+            )
+        )
+        record_review_answer(ctx.uid, {q["key"]: ctx.text})
+        return
+    line_bot_api.reply_message(
+        ctx.event.reply_token,
+        TextSendMessage(text="感情タグを１つ選んでください。", quick_reply=QR_REVIEW_CHOICES[q["key"]])
+    )
 
+# 補足説明（スキップor自由入力）ここも音声・100字制限
+@flows.route("review", "emotion_note", ("text", "audio"))
+def review_emotion_note(ctx):
+    st = review_progress[ctx.uid]
+    q = REVIEW_QUESTIONS[st["step"]]
+    text = ctx.text
+    if text == "スキップ":
+        note = ""
+    else:
+        # ここで音声入力や長文も要約100字
+        note = summarize(text, ctx.uid, max_chars=100) if (ctx.is_audio or len(text) > 100) else text
+    st["answers"][q["key"]] = st.pop("EmotionTag_main")
+    st["answers"]["EmotionNote"] = note
+    record_review_answer(ctx.uid, {q["key"]: st["answers"][q["key"]], "EmotionNote": note})
+    st["step"] += 1
+    ask_review_question(ctx.uid, ctx.event, st["step"])
+
+# text型
+@flows.route("review", "text", ("text", "audio"))
+def review_text(ctx):
+    uid = ctx.uid
+    st = review_progress[uid]
+    q = REVIEW_QUESTIONS[st["step"]]
+    text = ctx.text
+    # 音声または100字超→自動要約
+    if ctx.is_audio or len(text) > q["max_length"]:
+        text = summarize(text, uid, max_chars=q["max_length"])
+    st["answers"][q["key"]] = text
+    record_review_answer(uid, {q["key"]: text})
+    st["step"] += 1
     # 終了判定
     if st["step"] >= len(REVIEW_QUESTIONS):
-        save_review_to_notion(uid, st["answers"])
         review_progress.pop(uid, None)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("✅ Reviewの入力が完了しました。ありがとう！"))
-        return True
+        line_bot_api.reply_message(ctx.event.reply_token, TextSendMessage("✅ Reviewの入力が完了しました。ありがとう！"))
+        save_review_to_notion(uid, st["answers"], page_id=st.get("page_id"))
+        # 次にグラフを開いたときすぐ返せるよう、新しいデータで先に描いておく（依頼するだけですぐ戻る）
+        prerender_charts(uid)
+        return
+    ask_review_question(uid, ctx.event, st["step"])
+
+# ---------- LINE ハンドラ ----------
+@handler.add(MessageEvent, message=TextMessage)
+@state_store.user_session
+def handle_text(event):
+    uid  = event.source.user_id
+    text = event.message.text.strip()
+    if not flows.dispatch(uid, text, event):
+        line_bot_api.reply_message(event.reply_token, TextSendMessage("その操作は現在のステップでは使えません。"))
+
+@handler.add(MessageEvent, message=AudioMessage)
+@state_store.user_session
+def handle_audio(event):
+    uid = event.source.user_id
+    try:
+        mid = event.message.id
+        txt, audio = ingest_audio(
+            line_bot_api,
+            lambda buf, filename: llm.call("transcription", lambda c: transcribe(c, buf, filename=filename), uid=uid),
+            mid, duration_ms=getattr(event.message, "duration", None), parallel=AUDIO_PARALLEL,
+            stats=audio_stats, max_bytes=AUDIO_MAX_BYTES)
+        audio_seconds.observe(audio["download_ms"] / 1000, "download")
+        audio_seconds.observe(audio["transcribe_ms"] / 1000, "transcribe")
+        if not flows.dispatch(uid, txt, event, is_audio=True):
+            line_bot_api.reply_message(event.reply_token, TextSendMessage("その操作は現在のステップでは使えません。"))
+    except AudioTooLarge as e:
+        print("Audio too large:", e)
+        line_bot_api.reply_message(event.reply_token, TextSendMessage("⚠️ 音声が長すぎます。短く分けて送ってください。"))
+    except Exception as e:
+        print("Whisper error:", e)
+        line_bot_api.reply_message(event.reply_token, TextSendMessage("⚠️ 音声の文字起こしに失敗しました。"))
 
-    return False
+def record_review_answer(uid, answers):
+    # 回答はすぐ送信箱に積む（Notionへは続く回答とまとめて送る）。ページIDは進行状態にあるので、
+    # 再起動後や別ワーカーで続きを受けても同じページに書く
+    st = review_progress.get(uid, {})
+    outbox.update_page(review_page_id(uid, st), {PROP_MAP.get(k, k): rich_text(v) for k, v in answers.items()},
+                       hold=REVIEW_WRITE_HOLD)
+    # 週次・月次の集計も差分で更新
+    started = st.get("started") or datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+    if st.get("latest_value"):
+        answers = {**answers, "CoreValue": st["latest_value"]}  # 分析用（その日に選んだ価値観）
+    review_stats.record(uid, f"{uid}:{started}", answers,
+                        at=datetime.datetime.strptime(started, "%Y-%m-%d %H:%M"))
 
 def ask_review_question(uid, event, step, prev_star=None):
     if step >= len(REVIEW_QUESTIONS):
@@ -865,10 +1285,7 @@ def ask_review_question(uid, event, step, prev_star=None):
             event.reply_token,
             TextSendMessage(
                 text=label,
-                quick_reply=QuickReply(items=[
-                    QuickReplyButton(action=MessageAction(
-                        label=f"{'★'*n}{'☆'*(5-n)}", text=str(n))) for n in q["stars"]
-                ])
+                quick_reply=QR_STARS
             )
         )
         return
@@ -883,10 +1300,7 @@ def ask_review_question(uid, event, step, prev_star=None):
             event.reply_token,
             TextSendMessage(
                 text=label,
-                quick_reply=QuickReply(items=[
-                    QuickReplyButton(action=MessageAction(
-                        label=f"{'★'*n}{'☆'*(5-n)}", text=str(n))) for n in q["stars"]
-                ])
+                quick_reply=QR_STARS
             )
         )
         return
@@ -900,10 +1314,7 @@ def ask_review_question(uid, event, step, prev_star=None):
             event.reply_token,
             TextSendMessage(
                 text=label,
-                quick_reply=QuickReply(items=[
-                    QuickReplyButton(action=MessageAction(label=choice, text=choice))
-                    for choice in q["choices"]
-                ])
+                quick_reply=QR_REVIEW_CHOICES[q["key"]]
             )
         )
         return
@@ -913,9 +1324,7 @@ def ask_review_question(uid, event, step, prev_star=None):
             event.reply_token,
             TextSendMessage(
                 text=q["label"],
-                quick_reply=QuickReply(items=[
-                    QuickReplyButton(action=MessageAction(label=tag, text=tag)) for tag in q["choices"]
-                ])
+                quick_reply=QR_REVIEW_CHOICES[q["key"]]
             )
         )
         return
@@ -923,39 +1332,200 @@ def ask_review_question(uid, event, step, prev_star=None):
     else:
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text=q["label"]))
 
-def save_review_to_notion(uid, answers):
-    print("[save_review_to_notion] DBID:", os.getenv("NOTION_REVIEW_DBID", "Review_Log"))
-    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
-    data = {
-        "parent": {"database_id": os.getenv("NOTION_REVIEW_DBID", "Review_Log")},
-        "properties": {
-            "Date":          {"title": [{"text": {"content": now}}]},
-            "UserID":        {"rich_text": [{"text": {"content": uid}}]},
-            "Value★":        {"rich_text": [{"text": {"content": answers.get("ValueStar", "")}}]},
-            "Value reason":  {"rich_text": [{"text": {"content": answers.get("ValueReason", "")}}]},
-            "Mission★":      {"rich_text": [{"text": {"content": answers.get("MissionStar", "")}}]},
-            "Mission reason":{"rich_text": [{"text": {"content": answers.get("MissionReason", "")}}]},
-            "Win":           {"rich_text": [{"text": {"content": answers.get("Win", "")}}]},
-            "If-Then":       {"rich_text": [{"text": {"content": answers.get("IfThen", "")}}]},
-            "Pride":         {"rich_text": [{"text": {"content": answers.get("Pride", "")}}]},
-            "Gratitude":     {"rich_text": [{"text": {"content": answers.get("Gratitude", "")}}]},
-            "EmotionTag":    {"rich_text": [{"text": {"content": answers.get("EmotionTag", "")}}]},
-            "EmotionNote":   {"rich_text": [{"text": {"content": answers.get("EmotionNote", "")}}]},
-            "Insight":       {"rich_text": [{"text": {"content": answers.get("Insight", "")}}]},
-            "TomorrowMIT":   {"rich_text": [{"text": {"content": answers.get("Tomorrow", "")}}]},
-        }
-    }
-    r = requests.post(
-        "https://api.notion.com/v1/pages",
-        headers={
-            "Authorization": f"Bearer {NOTION_TOKEN}",
-            "Content-Type": "application/json",
-            "Notion-Version": "2022-06-28",
-        },
-        json=data,
-    )
-    print("[Notion review create]", r.status_code, r.text)
+def review_page_id(uid, st):
+    # 開始時に作ったページのID。開始時の状態に無い（更新前から続いているReview）ときだけここで作る
+    if not st.get("page_id"):
+        started = st.get("started") or datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+        st["page_id"] = create_review_page(uid, started)
+    return st["page_id"]
+
+def save_review_to_notion(uid, answers, page_id=None):
+    # 最終フラッシュ：回答は record_review_answer で積み済みなので、待たせている分をまとめてすぐ送る
+    n = outbox.flush_target(page_id) if page_id else 0
+    print("[save_review_to_notion]", page_id, f"waiting={n}")
+
+# ---------- メモ索引の取り込み（初回のみ） ----------
+@app.cli.command("memo-backfill")
+def memo_backfill():
+    # flask --app app memo-backfill ： Notion の既存メモを索引に流し込む（何度実行しても重複しない）
+    added = memo_index.backfill(notion, CATEGORY_BLOCK_IDS, token=NOTION_MEMO_SECRET)
+    print(f"[memo-backfill] 追加 {sum(added.values())}件", memo_index.stats())
+
+@app.cli.command("outbox-retry")
+def outbox_retry():
+    # flask --app app outbox-retry ： 送れずに保留（dead）になった書き込みを送り直す
+    n = outbox.retry_dead()
+    outbox.stop()
+    print(f"[outbox-retry] {n}件を再送待ちに戻しました", outbox.stats())
+
+# ---------- Review集計の作り直し ----------
+def notion_plain_text(prop):
+    items = (prop or {}).get("title") or (prop or {}).get("rich_text") or []
+    return "".join(t.get("plain_text") or t.get("text", {}).get("content", "") for t in items)
+
+@app.cli.command("review-rebuild")
+def review_rebuild():
+    # flask --app app review-rebuild ： NotionのReview DBを全件読み直して集計を作り直す
+    keys = {PROP_MAP.get(k, k): k for k in ("ValueStar", "MissionStar", "EmotionTag")}
+    review_stats.reset()
+    n = 0
+    for page in notion.iter_query(os.getenv("NOTION_REVIEW_DBID")):
+        props = page.get("properties", {})
+        uid = notion_plain_text(props.get("UserID"))
+        date = notion_plain_text(props.get("Date"))
+        try:
+            at = datetime.datetime.strptime(date, "%Y-%m-%d %H:%M")
+        except ValueError:
+            continue
+        answers = {key: notion_plain_text(props.get(name)) for name, key in keys.items()}
+        review_stats.record(uid, f"{uid}:{date}", {k: v for k, v in answers.items() if v}, at=at)
+        n += 1
+    print(f"[review-rebuild] {n}件", review_stats.stats())
+
+# ---------- エクスポート／バックアップ ----------
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")  # /export/<source> 用。未設定ならエンドポイントは無効
+exporter = Exporter(notion, {
+    "life5": {"database": NOTION_DBID},
+    "review": {"database": os.getenv("NOTION_REVIEW_DBID")},
+    "memo": {"blocks": [(cat, sub, block_id) for cat, v in CATEGORY_BLOCK_IDS.items()
+                        for sub, block_id in (v.items() if isinstance(v, dict) else [(None, v)])],
+             "token": NOTION_MEMO_SECRET},
+}, out_dir=os.getenv("EXPORT_DIR", "exports"))
+
+@app.cli.command("export")
+@click.argument("source", type=click.Choice(["life5", "review", "memo", "all"]))
+@click.option("--format", "fmt", type=click.Choice(["ndjson", "csv"]), default="ndjson")
+@click.option("--gzip/--no-gzip", "compress", default=True)
+@click.option("--incremental", is_flag=True, help="前回のエクスポート以降に更新された行だけ")
+def export_command(source, fmt, compress, incremental):
+    # flask --app app export all --incremental ： 途中で止まっても、もう一度実行すれば続きから
+    for name in (["life5", "review", "memo"] if source == "all" else [source]):
+        result = exporter.run(name, fmt=fmt, compress=compress, incremental=incremental)
+        print(f"[export] {name}: {result['rows']}行 → {result['output']}")
+
+# ---------- 非同期モード（ジョブキュー） ----------
+def dispatch_event(event):
+    # WebhookHandler.handle と同じくメッセージ種別で振り分け
+    if not isinstance(event, MessageEvent):
+        return
+    if isinstance(event.message, TextMessage):
+        handle_text(event)
+    elif isinstance(event.message, AudioMessage):
+        handle_audio(event)
+
+def process_job(payload):
+    if payload.get("type") != "message":
+        return
+    dispatch_event(MessageEvent.new_from_json_dict(payload))
+
+job_queue = None
+if CALLBACK_MODE == "async":
+    job_queue = JobQueue(process_job, workers=CALLBACK_WORKERS, path=JOB_QUEUE_DB, name="callback",
+                         key_func=lambda ev: (ev.get("source") or {}).get("userId"),
+                         lease=float(os.getenv("JOB_QUEUE_LEASE", "60")))
+
+# ---------- 各機能の統計（/xxx/stats と同じ値）もメトリクスに出す ----------
+metrics.gauge("job_queue_depth", "コールバックのジョブキューに溜まっている数",
+              lambda: job_queue.depth() if job_queue else 0)
+metrics.gauge("outbox_rows", "Notion送信箱の未送信（pending）・保留（dead）の数",
+              lambda: {status: n for status, n in outbox.stats().items() if status in ("pending", "dead")}, ("status",))
+metrics.gauge("outbox_oldest_pending_seconds", "Notion送信箱で一番古い未送信の経過秒",
+              lambda: outbox.stats()["oldest_pending_sec"])
+metrics.gauge("llm_in_flight", "実行中のOpenAI呼び出しの数", lambda: llm.in_flight)
+metrics.gauge("llm_breaker_open", "ブレーカーが閉じていなければ1",
+              lambda: {kind: int(v["breaker"] != "closed") for kind, v in llm.stats()["kinds"].items()}, ("kind",))
+metrics.gauge("summary_cache_lookups_total", "要約キャッシュの参照数",
+              lambda: {result: summary_cache.stats()[key] for result, key in
+                       (("hit_memory", "hits_memory"), ("hit_disk", "hits_disk"), ("miss", "misses"))},
+              ("result",), kind="counter")
+metrics.gauge("timers_pending", "待機中のタイマーの数", lambda: timers.stats()["pending"])
+metrics.gauge("chart_render_pending", "描画中のグラフの数", lambda: charts.stats()["pending"])
+metrics.gauge("flow_unhandled_total", "どのステップでも扱えなかったメッセージの数",
+              lambda: flows.unhandled, kind="counter")
+
+# ---------- 起動（create_app） ----------
+# gunicorn 'app:create_app()' ／ python app.py で起動する
+# ・import では設定を読んで部品を作るだけ。外部サービスのクライアントは最初に使うときに作る（Lazy）
+# ・スレッド（送信箱・タイマー・作業記録の同期・ジョブキュー）は start_background() で動かす
+#   動かしたプロセスの pid を覚えておき、fork された別のプロセス（gunicorn --preload のワーカー）では
+#   動かし直す。create_app() では動かさない（--preload だと gunicorn の親プロセスで呼ばれるため）
+# ・ポートを bind した後、プロセスごとに1回 on_worker_start() でスレッドとウォームアップを始める
+#   （gunicorn は gunicorn.conf.py の post_worker_init、それ以外は最初のリクエストで）
+#   flask のコマンドでは動かさない
+# ・WARM_UP=1 なら、バックグラウンドでクライアントを作って接続を1本ずつ開けておく
+# ・import の開始から / と /callback が初めて 200 を返すまでの秒数をログと /metrics（startup_seconds）に出す
+startup_times = {"import": time.perf_counter() - IMPORT_STARTED}
+_background_lock = threading.Lock()
+_background_pid = None
+_warm_up_pid = None
+
+def start_background():
+    global _background_pid
+    if _background_pid == os.getpid():
+        return
+    with _background_lock:
+        if _background_pid == os.getpid():
+            return
+        outbox.start()
+        timers.start()
+        activity_sync.start()
+        if job_queue:
+            job_queue.start()
+        charts.start()  # グラフ描画のプールも先に立ち上げる（最初の描画で Webhook を待たせない）
+        _background_pid = os.getpid()
+
+def warm_up():
+    # 最初の Webhook で import・TLS 接続を待たせないよう、軽い呼び出しで先に済ませておく
+    t0 = time.perf_counter()
+    for name, call in (
+        ("line",   lambda: line_bot_api.get_bot_info(timeout=5)),
+        ("notion", lambda: notion.request("GET", "users/me", timeout=5)),
+        ("openai", lambda: client.with_options(timeout=5, max_retries=0).models.list()),
+    ):
+        try:
+            call()
+        except Exception as e:
+            print(f"[warm_up] {name}:", e)
+    startup_times["warm_up"] = time.perf_counter() - t0
+    print(f"[warm_up] {startup_times['warm_up']:.2f}秒")
+
+def start_warm_up():
+    global _warm_up_pid
+    if os.getenv("WARM_UP", "1") != "1" or _warm_up_pid == os.getpid():
+        return
+    with _background_lock:
+        if _warm_up_pid == os.getpid():
+            return
+        _warm_up_pid = os.getpid()
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+def on_worker_start():
+    start_background()
+    start_warm_up()
+
+@app.before_request
+def _ensure_background():
+    on_worker_start()
+
+@app.after_request
+def _record_first_ok(response):
+    key = f"first_ok:{request.path}"
+    if response.status_code == 200 and request.path in ("/", "/callback") and key not in startup_times:
+        startup_times[key] = time.perf_counter() - IMPORT_STARTED
+        print(f"[startup] {request.path} が初めて200を返すまで {startup_times[key]:.2f}秒")
+    return response
+
+metrics.gauge("startup_seconds", "import の開始からの秒数（import完了・create_app完了・warm_up・初回200）",
+              lambda: {stage: round(sec, 3) for stage, sec in startup_times.items()}, ("stage",))
+
+def create_app():
+    startup_times["create_app"] = time.perf_counter() - IMPORT_STARTED
+    print(f"[startup] import {startup_times['import']:.2f}秒 / create_app {startup_times['create_app']:.2f}秒")
+    return app
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))  # Renderが提供するPORTを使う
-    app.run(host="0.0.0.0", port=port)
\ No newline at end of file
+    # 開発用サーバーは fork しないので、タイマーなどはすぐ動かす（ウォームアップは最初のリクエストで）
+    flask_app = create_app()
+    start_background()
+    flask_app.run(host="0.0.0.0", port=port)
\ No newline at end of file
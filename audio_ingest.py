@@ -0,0 +1,216 @@
+import os, re, shutil, subprocess, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_gateway import LLMUnavailable
+
+# LINEの音声メッセージを取り込んで Whisper に渡す
+# ・大きめのチャンクでストリーム受信（1バイトずつ write/flush しない）
+# ・小さい音声はメモリ上、大きくなったら自動でディスクに逃がす SpooledTemporaryFile
+# ・サイズ上限を超えたら打ち切り、バッファは必ず閉じる（/tmp に残さない）
+# ・長い音声は無音の位置で区切り、区間ごとに並行して文字起こしして順番どおりにつなぐ
+#   （ffmpeg が無い環境や、短い音声は今まで通り1回で送る）
+#   混雑で断られた区間は1回だけ送り直す（1区間のために音声全体を捨てない）
+
+AUDIO_CHUNK_SIZE = 64 * 1024
+AUDIO_SPOOL_SIZE = 4 * 1024 * 1024     # これを超えたらディスクへ
+AUDIO_MAX_BYTES  = 25 * 1024 * 1024    # Whisper API の上限
+FAST_PATH_SEC    = 45                  # これ以下の音声は分割しない
+SEGMENT_SEC      = 30                  # 区間の目安の長さ
+SEGMENT_MAX_SEC  = 45                  # 無音が見つからなくてもこれで切る
+SILENCE_NOISE    = "-35dB"
+SILENCE_MIN_SEC  = 0.4
+
+
+class AudioTooLarge(Exception):
+    pass
+
+
+def fetch_audio(line_bot_api, message_id, chunk_size=AUDIO_CHUNK_SIZE,
+                spool_size=AUDIO_SPOOL_SIZE, max_bytes=AUDIO_MAX_BYTES):
+    buf = tempfile.SpooledTemporaryFile(max_size=spool_size, suffix=".m4a")
+    size = 0
+    try:
+        content = line_bot_api.get_message_content(message_id)
+        for chunk in content.iter_content(chunk_size=chunk_size):
+            size += len(chunk)
+            if size > max_bytes:
+                raise AudioTooLarge(f"{size} bytes > {max_bytes}")
+            buf.write(chunk)
+        buf.seek(0)
+        return buf, size
+    except Exception:
+        buf.close()
+        raise
+
+
+def ffmpeg_path():
+    return shutil.which("ffmpeg")
+
+
+def detect_silences(ffmpeg, path, noise=SILENCE_NOISE, min_sec=SILENCE_MIN_SEC):
+    # (音声の長さ秒, [無音区間の真ん中の秒, ...])
+    r = subprocess.run([ffmpeg, "-hide_banner", "-nostats", "-i", path,
+                        "-af", f"silencedetect=noise={noise}:d={min_sec}", "-f", "null", "-"],
+                       capture_output=True, text=True, timeout=60)
+    return parse_silences(r.stderr)
+
+
+def parse_silences(log):
+    duration = None
+    m = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", log)
+    if m:
+        duration = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+    starts = [float(x) for x in re.findall(r"silence_start: (-?[\d.]+)", log)]
+    ends = [float(x) for x in re.findall(r"silence_end: ([\d.]+)", log)]
+    return duration, [(max(0.0, a) + b) / 2 for a, b in zip(starts, ends)]
+
+
+def plan_segments(duration, silences, target=SEGMENT_SEC, max_len=SEGMENT_MAX_SEC):
+    # [(開始秒, 終了秒), ...]。目安の長さに近い無音で切る（目安の半分より前では切らない）
+    segments, start = [], 0.0
+    while duration - start > max_len:
+        candidates = [m for m in silences if start + target / 2 <= m <= start + max_len]
+        cut = min(candidates, key=lambda m: abs(m - (start + target))) if candidates else start + max_len
+        segments.append((start, cut))
+        start = cut
+    segments.append((start, duration))
+    return segments
+
+
+def cut_segment(ffmpeg, src, start, end, dst):
+    subprocess.run([ffmpeg, "-hide_banner", "-loglevel", "error", "-y", "-ss", f"{start:.2f}",
+                    "-t", f"{end - start:.2f}", "-i", src, "-vn", "-c", "copy", dst],
+                   check=True, capture_output=True, timeout=60)
+
+
+def join_texts(texts):
+    # 英数字どうしがくっつくときだけ空白を入れる（日本語はそのままつなぐ）
+    out = ""
+    for t in texts:
+        t = t.strip()
+        if not t:
+            continue
+        if out and out[-1].isascii() and out[-1].isalnum() and t[0].isascii() and t[0].isalnum():
+            out += " "
+        out += t
+    return out
+
+
+class TranscriptionStats:
+    # 区間の長さごとの処理時間（区間の長さの調整用）
+    BUCKETS = ((15, "~15s"), (30, "15-30s"), (45, "30-45s"), (float("inf"), "45s~"))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self.single = 0
+        self.chunked = 0
+
+    def record(self, audio_sec, ms):
+        label = next(name for limit, name in self.BUCKETS if (audio_sec or 0) <= limit)
+        with self._lock:
+            b = self._buckets.setdefault(label, [0, 0.0, 0.0, 0.0])
+            b[0] += 1
+            b[1] += audio_sec or 0
+            b[2] += ms
+            b[3] = max(b[3], ms)
+
+    def count(self, chunked):
+        with self._lock:
+            if chunked:
+                self.chunked += 1
+            else:
+                self.single += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "single": self.single,
+                "chunked": self.chunked,
+                "segments": {label: {"count": n, "avg_ms": round(ms / n, 1), "max_ms": round(mx, 1),
+                                     "ms_per_audio_sec": round(ms / sec, 1) if sec else None}
+                             for label, (n, sec, ms, mx) in self._buckets.items()},
+            }
+
+
+def transcribe(client, buf, model="whisper-1", filename="audio.m4a"):
+    # ファイル名の拡張子で形式が判定されるので名前付きで渡す
+    return client.audio.transcriptions.create(model=model, file=(filename, buf)).text.strip()
+
+
+def transcribe_chunked(transcriber, buf, ffmpeg, duration=None, parallel=2,
+                       segment_sec=SEGMENT_SEC, max_segment_sec=SEGMENT_MAX_SEC):
+    # 区切って並行に文字起こし。(テキスト, 区間ごとの記録) を返す（分割不要なら None, None）
+    with tempfile.TemporaryDirectory(prefix="audio-") as work:
+        src = os.path.join(work, "in.m4a")
+        with open(src, "wb") as f:
+            shutil.copyfileobj(buf, f)
+        buf.seek(0)
+        probed, silences = detect_silences(ffmpeg, src)
+        duration = probed or duration
+        if not duration or duration <= max_segment_sec:
+            return None, None
+        plan = plan_segments(duration, silences, segment_sec, max_segment_sec)
+
+        def run(i, start, end):
+            t0 = time.perf_counter()
+            path = os.path.join(work, f"seg{i:03d}.m4a")
+            cut_segment(ffmpeg, src, start, end, path)
+            with open(path, "rb") as f:
+                try:
+                    text = transcriber(f, f"seg{i:03d}.m4a")
+                except LLMUnavailable as e:
+                    if e.reason != "busy":
+                        raise
+                    print(f"[audio] seg{i:03d} 混雑のため送り直します:", e)
+                    f.seek(0)
+                    text = transcriber(f, f"seg{i:03d}.m4a")
+            return text, {"index": i, "start": round(start, 2), "sec": round(end - start, 2),
+                          "bytes": os.path.getsize(path), "ms": round((time.perf_counter() - t0) * 1000, 1)}
+
+        with ThreadPoolExecutor(max_workers=max(1, parallel), thread_name_prefix="whisper") as pool:
+            results = list(pool.map(lambda seg: run(seg[0], *seg[1]), enumerate(plan)))
+    return join_texts(t for t, _ in results), [r for _, r in results]
+
+
+def ingest_audio(line_bot_api, transcriber, message_id, duration_ms=None, parallel=2,
+                 fast_path_sec=FAST_PATH_SEC, segment_sec=SEGMENT_SEC, max_segment_sec=SEGMENT_MAX_SEC,
+                 stats=None, **options):
+    # transcriber(buf, filename) → 文字起こし結果（OpenAI の呼び出し方は呼び出し側で決める）
+    # duration_ms は LINE のイベントに入っている長さ（短いものは ffmpeg を通さない）
+    t0 = time.perf_counter()
+    buf, size = fetch_audio(line_bot_api, message_id, **options)
+    t1 = time.perf_counter()
+    duration = duration_ms / 1000 if duration_ms else None
+    segments = None
+    try:
+        ffmpeg = ffmpeg_path()
+        if ffmpeg and not (duration and duration <= fast_path_sec):
+            try:
+                text, segments = transcribe_chunked(transcriber, buf, ffmpeg, duration, parallel,
+                                                    segment_sec, max_segment_sec)
+            except (OSError, subprocess.SubprocessError) as e:
+                # ffmpeg で区切れなかったときは1回で送る
+                print("[audio] 分割に失敗:", e)
+                buf.seek(0)
+        if segments is None:
+            text = transcriber(buf, "audio.m4a")
+    finally:
+        buf.close()
+    t2 = time.perf_counter()
+    result = {
+        "bytes": size,
+        "download_ms": round((t1 - t0) * 1000, 1),
+        "transcribe_ms": round((t2 - t1) * 1000, 1),
+        "segments": segments or [],
+    }
+    if stats is not None:
+        stats.count(bool(segments))
+        if segments:
+            for seg in segments:
+                stats.record(seg["sec"], seg["ms"])
+        else:
+            stats.record(duration, result["transcribe_ms"])
+    print(f"[audio] id={message_id} bytes={size} download={result['download_ms']}ms "
+          f"transcribe={result['transcribe_ms']}ms segments={len(segments or []) or 1}")
+    return text, result
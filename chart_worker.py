@@ -0,0 +1,81 @@
+import io
+
+# グラフ描画のワーカー（ChartService のプロセスプールの子プロセスで動く）
+# ・子プロセスは forkserver（無ければ spawn）で作るので、ここは標準ライブラリと matplotlib だけで完結させる
+#   （Flask や DB 接続・スレッドを抱えた親プロセスを fork しない）
+# ・matplotlib は最初の描画のときに読み込む（親プロセスがこのモジュールを import しても重くならない）
+
+JP_FONTS = ["Noto Sans CJK JP", "IPAexGothic", "IPAGothic", "Hiragino Sans", "Yu Gothic", "Meiryo", "DejaVu Sans"]
+EMOTION_COLORS = {"喜び": "#f4b400", "怒り": "#db4437", "悲しみ": "#4285f4", "驚き": "#0f9d58", "不安": "#9e69af"}
+
+
+def render_chart(title, series):
+    # series = [(ラベル, {"ValueStar": 平均, "MissionStar": 平均, "emotions": {...}, "reviews": n}), ...]
+    import warnings
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib import font_manager
+    # 入っている日本語フォントだけを指定する（無いフォント名を渡すと毎回警告が出る）
+    installed = {f.name for f in font_manager.fontManager.ttflist}
+    fonts = [name for name in JP_FONTS if name in installed]
+    if fonts:
+        matplotlib.rcParams["font.family"] = fonts
+    warnings.filterwarnings("ignore", message="Glyph .* missing")
+
+    labels = [label for label, _ in series]
+    xs = list(range(len(series)))
+    fig, (top, bottom) = plt.subplots(2, 1, figsize=(8, 6), dpi=100, sharex=True,
+                                      gridspec_kw={"height_ratios": [3, 2]})
+    for key, color in (("ValueStar", "#1a73e8"), ("MissionStar", "#e8710a")):
+        ys = [p[key] for _, p in series]
+        top.plot(xs, [y if y is not None else float("nan") for y in ys],
+                 marker="o", color=color, label=key.replace("Star", "★"))
+    top.set_ylim(0.5, 5.5)
+    top.set_yticks([1, 2, 3, 4, 5])
+    top.grid(alpha=0.3)
+    top.legend(loc="upper left")
+    top.set_title(title)
+
+    emotions = sorted({e for _, p in series for e in p["emotions"]},
+                      key=lambda e: list(EMOTION_COLORS).index(e) if e in EMOTION_COLORS else 99)
+    base = [0] * len(series)
+    for e in emotions:
+        counts = [p["emotions"].get(e, 0) for _, p in series]
+        bottom.bar(xs, counts, bottom=base, color=EMOTION_COLORS.get(e), label=e)
+        base = [b + c for b, c in zip(base, counts)]
+    if emotions:
+        bottom.legend(loc="upper left", ncol=len(emotions), fontsize=8)
+    bottom.set_xticks(xs)
+    bottom.set_xticklabels(labels, rotation=30, fontsize=8)
+    bottom.grid(axis="y", alpha=0.3)
+
+    fig.tight_layout()
+    out = io.BytesIO()
+    fig.savefig(out, format="png")
+    plt.close(fig)
+    return out.getvalue()
+
+
+def warm_up():
+    # プールの起動時に1回だけ呼ぶ：子プロセスで matplotlib を先に読み込んでおく
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot  # noqa: F401
+    return True
+
+
+def watch_parent(pid, interval=1.0):
+    # プールの子プロセスの初期化で呼ぶ：親（Webワーカー）が終了したら自分も終わる
+    # （forkserver から作った子は親が SIGTERM などで落ちても残ってしまうため）
+    import os, threading, time
+
+    def watch():
+        while True:
+            time.sleep(interval)
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                os._exit(0)
+
+    threading.Thread(target=watch, name="watch-parent", daemon=True).start()
@@ -0,0 +1,210 @@
+import hashlib, multiprocessing, os, threading, time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from chart_worker import render_chart, warm_up, watch_parent
+
+# ダッシュボードのグラフ（★の推移＋感情タグの分布）
+# ・描画は別プロセスのプールで行う（matplotlib の import も描画も Webhook の処理に乗せない）
+#   子プロセスは forkserver（無ければ spawn）で作り、chart_worker だけを読み込ませる
+# ・PNG は (ユーザー, 期間, 集計の version) をキーにキャッシュ。新しい回答が来て version が
+#   変わったときだけ描き直す（古い画像はその時点で消す）
+# ・URL にはキーのハッシュだけを使う（ユーザーIDを出さない）。中身は変わらないので ETag もこれ
+# ・プールはワーカー起動時に start() で立ち上げる。prerender() はキーを返すだけで、集計の読み出しと
+#   描画の依頼は裏のスレッドで行う（Webhook やセッションのロックを待たせない）
+# ・描画中は cache_dir に <key>.pending を置く。別のワーカーに /charts/<key>.png が来ても、
+#   それを見て PNG がディスクに出るまで待つ
+
+CHART_STYLE = "v1"  # 見た目を変えたら上げる（古いキャッシュを使わない）
+
+
+def chart_key(uid, period, version):
+    raw = f"{CHART_STYLE}\x00{uid}\x00{period}\x00{version}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+class ChartService:
+    def __init__(self, cache_dir=None, workers=1, memory_size=64, mp_context=None, timeout=20.0):
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.memory_size = memory_size
+        self.timeout = timeout
+        self.mp_context = mp_context or ("forkserver" if "forkserver" in multiprocessing.get_all_start_methods()
+                                         else "spawn")
+        self._pool = None
+        self._pool_pid = None
+        self._submitter = None
+        self._lock = threading.Lock()
+        self._mem = OrderedDict()     # key → PNG bytes
+        self._pending = {}            # key → future
+        self._latest = {}             # (uid, period) → key
+        self.rendered = 0
+        self.render_ms_total = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _executor(self):
+        # fork されたワーカーでは親のプールは使えないので、プロセスごとに作る
+        if self._pool is None or self._pool_pid != os.getpid():
+            ctx = multiprocessing.get_context(self.mp_context)
+            if self.mp_context == "forkserver":
+                ctx.set_forkserver_preload(["chart_worker"])
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx,
+                                             initializer=watch_parent, initargs=(os.getpid(),))
+            self._submitter = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chart-submit")
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def start(self):
+        # ワーカー起動時に呼ぶ：forkserver と子プロセスを裏で立ち上げておく（最初の描画を待たせない）
+        with self._lock:
+            pool = self._executor()
+        t0 = time.perf_counter()
+
+        def ready(f):
+            if f.exception() is not None:
+                print("[charts] プールの起動に失敗:", f.exception())
+            else:
+                print(f"[charts] プール起動 {time.perf_counter() - t0:.2f}秒")
+
+        self._submitter.submit(lambda: pool.submit(warm_up).add_done_callback(ready))
+
+    def _path(self, key, suffix=".png"):
+        return os.path.join(self.cache_dir, f"{key}{suffix}") if self.cache_dir else None
+
+    # ---------- 描画の依頼 ----------
+    def prerender(self, uid, period, version, title, series_func):
+        # キーを返す。キャッシュ済みならそのまま、無ければ裏で描画を始める
+        key = chart_key(uid, period, version)
+        with self._lock:
+            old = self._latest.get((uid, period))
+            self._latest[(uid, period)] = key
+            if old and old != key:
+                self._drop(old)
+            if key in self._mem or key in self._pending or self._on_disk(key):
+                return key
+            self._executor()
+            future = self._pending[key] = Future()
+            self._mark_pending(key)
+        t0 = time.perf_counter()
+        future.add_done_callback(lambda f: self._done(key, f, t0))
+        self._submitter.submit(self._submit, future, title, series_func)
+        return key
+
+    def _submit(self, future, title, series_func):
+        # 裏のスレッドで集計を読み、描画をプールに依頼する（結果は future に移す）
+        try:
+            rendered = self._executor().submit(render_chart, title, series_func())
+        except Exception as e:
+            future.set_exception(e)
+            return
+        rendered.add_done_callback(lambda f: future.set_exception(f.exception()) if f.exception() is not None
+                                   else future.set_result(f.result()))
+
+    def _mark_pending(self, key):
+        path = self._path(key, ".pending")
+        if path:
+            with open(path, "w"):
+                pass
+
+    def _done(self, key, future, t0):
+        with self._lock:
+            self._pending.pop(key, None)
+            if future.exception() is not None:
+                self.failures += 1
+                print("[charts] 描画エラー:", future.exception())
+                png = None
+            else:
+                png = future.result()
+                self.rendered += 1
+                self.render_ms_total += (time.perf_counter() - t0) * 1000
+                self._remember(key, png)
+        path = self._path(key)
+        if path:
+            if png is not None:
+                with open(path + ".tmp", "wb") as f:
+                    f.write(png)
+                os.replace(path + ".tmp", path)
+            try:
+                os.remove(self._path(key, ".pending"))
+            except OSError:
+                pass
+
+    def _remember(self, key, png):
+        self._mem[key] = png
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.memory_size:
+            self._mem.popitem(last=False)
+
+    def _on_disk(self, key):
+        path = self._path(key)
+        return bool(path) and os.path.exists(path)
+
+    def _drop(self, key):
+        # データが更新されて使わなくなった画像を消す
+        self._mem.pop(key, None)
+        path = self._path(key)
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # ---------- 取り出し ----------
+    def get(self, key):
+        # PNG の bytes（描画中なら終わるまで待つ。別のワーカーが描画中ならディスクに出るまで待つ）。
+        # 知らないキーなら None
+        with self._lock:
+            png = self._mem.get(key)
+            if png is not None:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return png
+            future = self._pending.get(key)
+        if future is not None:
+            try:
+                png = future.result(timeout=self.timeout)
+            except Exception:
+                return None
+            with self._lock:
+                self.misses += 1
+            return png
+        path = self._path(key)
+        if not path:
+            return None
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        while not os.path.exists(path):
+            if not os.path.exists(self._path(key, ".pending")) or time.monotonic() >= deadline:
+                return None
+            waited = True
+            time.sleep(0.05)
+        try:
+            with open(path, "rb") as f:
+                png = f.read()
+        except OSError:
+            return None
+        with self._lock:
+            if waited:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self._remember(key, png)
+        return png
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rendered": self.rendered,
+                "avg_render_ms": round(self.render_ms_total / self.rendered, 1) if self.rendered else 0.0,
+                "pending": len(self._pending),
+                "memory_entries": len(self._mem),
+                "hits": self.hits,
+                "misses": self.misses,
+                "failures": self.failures,
+                "workers": self.workers,
+                "mp_context": self.mp_context,
+            }
@@ -0,0 +1,95 @@
+import sqlite3, threading, time
+from collections import OrderedDict
+
+# Webhookイベントの重複排除（LINEの再送で同じ処理を二重に走らせない）
+# ・window 秒以内に見たキーは重複として捨てる
+# ・メモリ上は max_entries 件までのLRU、path を渡すとSQLiteにも記録（複数プロセス・再起動に対応）
+
+
+def event_key(raw_event):
+    # webhookEventId が基本。無い古い形式はメッセージIDで代用
+    if raw_event.get("webhookEventId"):
+        return raw_event["webhookEventId"]
+    message = raw_event.get("message") or {}
+    if message.get("id"):
+        return f"message:{message['id']}"
+    return None
+
+
+class EventDeduper:
+    def __init__(self, window=600, max_entries=10000, path=None, prune_every=500):
+        self.window = window
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._inserts = 0
+        self.checked = 0
+        self.duplicates = 0
+        self.redeliveries = 0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS seen_events (key TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS seen_events_at ON seen_events (seen_at)")
+
+    def first_seen(self, key, redelivery=False):
+        now = time.time()
+        with self._lock:
+            self.checked += 1
+            if redelivery:
+                self.redeliveries += 1
+            self._expire(now)
+            if key in self._seen:
+                self.duplicates += 1
+                return False
+            if self._db is not None and not self._claim(key, now):
+                self.duplicates += 1
+                self._remember(key, now)
+                return False
+            self._remember(key, now)
+            return True
+
+    def forget(self, key):
+        # 処理に失敗したイベントは再送で処理し直せるように記録を消す
+        with self._lock:
+            self._seen.pop(key, None)
+            if self._db is not None:
+                self._db.execute("DELETE FROM seen_events WHERE key = ?", (key,))
+
+    def _claim(self, key, now):
+        cur = self._db.execute(
+            "INSERT INTO seen_events (key, seen_at) VALUES (?, ?)"
+            " ON CONFLICT (key) DO UPDATE SET seen_at = excluded.seen_at"
+            " WHERE seen_events.seen_at < ?",
+            (key, now, now - self.window))
+        self._inserts += 1
+        if self._inserts % self.prune_every == 0:
+            self._db.execute("DELETE FROM seen_events WHERE seen_at < ?", (now - self.window,))
+        return cur.rowcount == 1
+
+    def _remember(self, key, now):
+        self._seen[key] = now
+        while len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+
+    def _expire(self, now):
+        limit = now - self.window
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if seen_at >= limit:
+                break
+            self._seen.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "checked": self.checked,
+                "duplicates": self.duplicates,
+                "redeliveries": self.redeliveries,
+                "entries": len(self._seen),
+                "window_sec": self.window,
+                "persistent": self._db is not None,
+            }
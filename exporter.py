@@ -0,0 +1,186 @@
+import csv, datetime, gzip, io, json, os, time
+
+# Notion のデータ（Life5・Review の DB、メモのブロック）のエクスポート／バックアップ
+# ・ページ送り（cursor）で少しずつ取りに行き、1ページ分ずつファイルに書く（全件をメモリに載せない）
+# ・形式は NDJSON か CSV。gzip にするときは1ページ＝1つの gzip メンバーとして追記する
+# ・1ページ書くたびに「次の cursor」と「ファイルの長さ」をチェックポイントに保存。
+#   途中で止まっても、次回はファイルをその長さに切り詰めてから続きを取りに行く（重複しない）
+# ・incremental=True なら前回の完了時刻以降に更新された行だけを書く
+
+BASE_COLUMNS = ["id", "created_time", "last_edited_time"]
+MEMO_COLUMNS = BASE_COLUMNS + ["category", "subcategory", "text"]
+
+
+def rich_plain(items):
+    return "".join(t.get("plain_text") or t.get("text", {}).get("content", "") for t in items or [])
+
+
+def prop_value(prop):
+    # Notion のプロパティを文字列・数値などの素の値にする
+    kind = prop.get("type")
+    value = prop.get(kind)
+    if kind in ("title", "rich_text"):
+        return rich_plain(value)
+    if kind in ("select", "status"):
+        return (value or {}).get("name")
+    if kind == "multi_select":
+        return ",".join(v.get("name", "") for v in value or [])
+    if kind == "date":
+        return (value or {}).get("start")
+    if kind == "people":
+        return ",".join(p.get("id", "") for p in value or [])
+    if kind in ("formula", "rollup"):
+        return (value or {}).get((value or {}).get("type"))
+    return value
+
+
+def flatten_page(page):
+    row = {k: page.get(k) for k in BASE_COLUMNS}
+    for name, prop in (page.get("properties") or {}).items():
+        row[name] = prop_value(prop)
+    return row
+
+
+def flatten_block(block, category, subcategory):
+    body = block.get(block.get("type"), {}) or {}
+    return {
+        "id": block.get("id"),
+        "created_time": block.get("created_time"),
+        "last_edited_time": block.get("last_edited_time"),
+        "category": category,
+        "subcategory": subcategory,
+        "text": rich_plain(body.get("rich_text")),
+    }
+
+
+def iso_minutes_ago(ts, minutes=1):
+    # Notion の last_edited_time は分単位なので、少し前から取り直す
+    at = datetime.datetime.fromtimestamp(ts, datetime.timezone.utc) - datetime.timedelta(minutes=minutes)
+    return at.replace(second=0, microsecond=0).isoformat().replace("+00:00", "Z")
+
+
+class Exporter:
+    def __init__(self, gateway, sources, out_dir="exports"):
+        # sources = {"life5": {"database": id, "token": ...}, "memo": {"blocks": [(cat, sub, id)], ...}}
+        self.gateway = gateway
+        self.sources = sources
+        self.out_dir = out_dir
+
+    # ---------- 読み出し ----------
+    def columns(self, source):
+        spec = self.sources[source]
+        if "blocks" in spec:
+            return list(MEMO_COLUMNS)
+        r = self.gateway.request("GET", f"databases/{spec['database']}", token=spec.get("token"))
+        if r is None or not r.ok:
+            raise RuntimeError(f"{source}: データベースの列を取得できませんでした")
+        return BASE_COLUMNS + sorted(r.json().get("properties", {}).keys())
+
+    def pages(self, source, since=None, stream=0, cursor=None):
+        # (行のリスト, 次の位置) を1ページずつ。位置 = (何本目の一覧か, cursor)。一覧を読み切ると次の番号へ進む
+        spec = self.sources[source]
+        token = spec.get("token")
+        if "database" in spec:
+            if stream > 0:
+                return  # 最後のページまで書き終わっている
+            body = {"sorts": [{"timestamp": "created_time", "direction": "ascending"}]}
+            if since:
+                body["filter"] = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": since}}
+            for results, next_cursor in self.gateway.iter_pages(
+                    "POST", f"databases/{spec['database']}/query", body, token=token, cursor=cursor):
+                yield [flatten_page(p) for p in results], (0, next_cursor) if next_cursor else (1, None)
+            return
+        blocks = spec["blocks"]
+        for i in range(stream, len(blocks)):
+            category, subcategory, block_id = blocks[i]
+            for results, next_cursor in self.gateway.iter_pages(
+                    "GET", f"blocks/{block_id}/children", token=token, cursor=cursor if i == stream else None):
+                rows = [flatten_block(b, category, subcategory) for b in results if b.get("type") == "paragraph"]
+                if since:
+                    # ブロック一覧は更新日時で絞れないので、ここで落とす
+                    rows = [r for r in rows if (r["last_edited_time"] or "") >= since]
+                position = (i, next_cursor) if next_cursor else (i + 1, None)
+                yield rows, position
+
+    # ---------- 書き出し ----------
+    @staticmethod
+    def encode(rows, fmt, columns, header=False):
+        if fmt == "ndjson":
+            return "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in rows).encode("utf-8")
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=columns, extrasaction="ignore")
+        if header:
+            writer.writeheader()
+        writer.writerows(rows)
+        return buf.getvalue().encode("utf-8")
+
+    def _state_path(self, source):
+        return os.path.join(self.out_dir, f"{source}.export.json")
+
+    def load_state(self, source):
+        try:
+            with open(self._state_path(source), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_state(self, source, state):
+        path = self._state_path(source)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def run(self, source, fmt="ndjson", compress=True, incremental=False):
+        # 途中のチェックポイントがあれば続きから。戻り値は結果のまとめ
+        os.makedirs(self.out_dir, exist_ok=True)
+        state = self.load_state(source)
+        job = state.get("running")
+        if job is None:
+            started = time.time()
+            ext = ("ndjson" if fmt == "ndjson" else "csv") + (".gz" if compress else "")
+            kind = "incremental" if incremental and state.get("last_export") else "full"
+            job = {
+                "output": os.path.join(self.out_dir, f"{source}-{kind}-{time.strftime('%Y%m%d-%H%M%S')}.{ext}"),
+                "format": fmt, "compress": compress,
+                "since": state.get("last_export") if kind == "incremental" else None,
+                "columns": self.columns(source) if fmt == "csv" else None,
+                "started": started, "stream": 0, "cursor": None, "bytes": 0, "rows": 0, "pages": 0,
+            }
+            state["running"] = job
+            self._save_state(source, state)
+        else:
+            print(f"[export] {source}: 前回の続きから再開（{job['rows']}行, {job['pages']}ページ済み）")
+
+        with open(job["output"], "ab") as raw:
+            raw.truncate(job["bytes"])  # 前回チェックポイント後に書きかけた分を捨てる
+            raw.seek(job["bytes"])
+            for rows, (stream, cursor) in self.pages(source, job["since"], job["stream"], job["cursor"]):
+                data = self.encode(rows, job["format"], job["columns"], header=job["bytes"] == 0)
+                if data:
+                    if job["compress"]:
+                        with gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+                            gz.write(data)
+                    else:
+                        raw.write(data)
+                    raw.flush()
+                    os.fsync(raw.fileno())
+                job.update(stream=stream, cursor=cursor, bytes=raw.tell(),
+                           rows=job["rows"] + len(rows), pages=job["pages"] + 1)
+                self._save_state(source, state)
+
+        state.pop("running")
+        state["last_export"] = iso_minutes_ago(job["started"])
+        state["last_output"] = job["output"]
+        self._save_state(source, state)
+        return {"source": source, "output": job["output"], "rows": job["rows"], "pages": job["pages"],
+                "bytes": job["bytes"], "since": job["since"]}
+
+    def stream(self, source, fmt="ndjson", since=None):
+        # HTTP でそのまま流す用（チェックポイントなし）
+        columns = self.columns(source) if fmt == "csv" else None
+        header = True
+        for rows, _ in self.pages(source, since):
+            data = self.encode(rows, fmt, columns, header=header)
+            header = False
+            if data:
+                yield data
@@ -0,0 +1,243 @@
+import json, random, re, threading, time, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+
+# 負荷試験用のダミーサーバー（LINE の返信・プッシュ・音声取得 / Notion のページ・ブロック / OpenAI の chat・audio）
+# ・1つのポートでパスの頭で振り分ける：/line/...・/notion/v1/...・/openai/v1/...
+#   （app 側は LINE_API_ENDPOINT・LINE_API_DATA_ENDPOINT・NOTION_API_BASE・OPENAI_BASE_URL をここに向ける）
+# ・サービスごとに遅延（latency 秒 + 0〜jitter 秒）とエラー率を設定できる。エラーは各APIの 5xx の形で返す
+# ・LINE の返信は replyToken ごとに覚えておき、GET /line/_replies/<token> で取り出せる（会話を進める側が使う）
+# ・GET /_stats でサービス・ルート・ステータスごとの件数
+# 単体でも起動できる：python fake_services.py --port 8099 --latency notion=0.3 --error-rate openai=0.05
+
+SERVICES = ("line", "notion", "openai")
+HINTS = ["10年後の自分が今日を振り返ったら、何をしておけばよかったと思う？",
+         "最近、後回しにしている連絡はある？", "体が元気なうちにやっておきたいことは？",
+         "本当はやってみたいのに、理由をつけて避けていることは？", "一番感謝を伝えたい人は誰？"]
+_UUID = re.compile(r"/[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}|/tmp-[0-9a-f]+|/\d+(?=/)")
+
+
+class Profile:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    def wait(self):
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def fails(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+class FakeServices:
+    def __init__(self, profiles=None, host="127.0.0.1", port=0, audio_bytes=32 * 1024,
+                 transcript="今日は散歩をして気分がよかった。"):
+        self.profiles = {name: (profiles or {}).get(name) or Profile() for name in SERVICES}
+        self.audio_bytes = audio_bytes
+        self.transcript = transcript
+        self._replies = {}          # replyToken → messages
+        self._counts = {}           # (service, route, status) → 件数
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-services", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    # ---------- 記録 ----------
+    def count(self, service, route, status):
+        key = (service, route, status)
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def save_reply(self, token, messages):
+        with self._lock:
+            self._replies[token] = messages
+
+    def pop_reply(self, token):
+        with self._lock:
+            return self._replies.pop(token, None)
+
+    def stats(self):
+        with self._lock:
+            return [{"service": s, "route": r, "status": st, "count": n}
+                    for (s, r, st), n in sorted(self._counts.items())]
+
+    # ---------- 各サービスの応答 ----------
+    def line(self, method, path, body):
+        if method == "POST" and path == "/v2/bot/message/reply":
+            self.save_reply(body.get("replyToken"), body.get("messages") or [])
+            return 200, {}
+        if method == "POST" and path in ("/v2/bot/message/push", "/v2/bot/message/multicast"):
+            return 200, {}
+        if method == "GET" and path == "/v2/bot/info":
+            return 200, {"userId": "Uloadtest", "basicId": "@loadtest", "displayName": "loadtest", "chatMode": "bot"}
+        if method == "GET" and path.endswith("/content"):
+            return 200, b"\0" * self.audio_bytes
+        return 404, {"message": "Not found"}
+
+    def notion(self, method, path, body):
+        if method == "POST" and path == "/pages":
+            return 200, {"object": "page", "id": str(uuid.uuid4()), "properties": body.get("properties", {})}
+        if method == "PATCH" and path.startswith("/pages/"):
+            return 200, {"object": "page", "id": path.split("/")[2]}
+        if method == "PATCH" and path.endswith("/children"):
+            children = body.get("children") or [{}]
+            return 200, {"object": "list", "results": [{"object": "block", "id": str(uuid.uuid4())} for _ in children]}
+        if method == "GET" and path == "/users/me":
+            return 200, {"object": "user", "id": str(uuid.uuid4()), "type": "bot", "bot": {}}
+        if method == "GET" and path.startswith("/databases/"):
+            return 200, {"object": "database", "id": path.split("/")[2], "properties": {}}
+        if path.endswith("/children") or path.endswith("/query"):
+            return 200, {"object": "list", "results": [], "has_more": False, "next_cursor": None}
+        return 404, {"object": "error", "status": 404, "code": "object_not_found", "message": "Not found"}
+
+    def openai(self, method, path, body):
+        if path == "/chat/completions":
+            # ヒントのプールは同じ文を入れないので、毎回少しずつ違う返事にする
+            with self._lock:
+                self._seq += 1
+                seq = self._seq
+            text = f"{random.choice(HINTS)}（{seq}）"
+            return 200, {
+                "id": "chatcmpl-" + uuid.uuid4().hex, "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model", "gpt-4o-mini"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": text}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }
+        if path == "/models":
+            return 200, {"object": "list", "data": [{"id": "gpt-4o-mini", "object": "model", "created": 0,
+                                                     "owned_by": "system"}]}
+        if path == "/audio/transcriptions":
+            return 200, {"text": self.transcript}
+        return 404, {"error": {"message": "Not found", "type": "invalid_request_error"}}
+
+    def error(self, service):
+        if service == "line":
+            return 500, {"message": "fake error"}
+        if service == "notion":
+            return 503, {"object": "error", "status": 503, "code": "service_unavailable", "message": "fake error"}
+        return 500, {"error": {"message": "fake error", "type": "server_error"}}
+
+
+def _handler(services):
+    prefixes = (("/line", "line"), ("/notion/v1", "notion"), ("/openai/v1", "openai"))
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"     # keep-alive（app 側の Session を使い回させる）
+
+        def log_message(self, *args):
+            pass
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            if "json" not in (self.headers.get("Content-Type") or ""):
+                return {}
+            try:
+                return json.loads(raw or b"{}")
+            except ValueError:
+                return {}
+
+        def _send(self, status, payload):
+            data = payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/octet-stream" if isinstance(payload, bytes)
+                             else "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _handle(self, method):
+            path = self.path.split("?")[0]
+            body = self._body()
+            # 試験する側の補助（遅延・エラーはかけない）
+            if path == "/_stats":
+                return self._send(200, services.stats())
+            if path.startswith("/line/_replies/"):
+                messages = services.pop_reply(path.rsplit("/", 1)[1])
+                return self._send(200 if messages is not None else 404, {"messages": messages})
+            for prefix, service in prefixes:
+                if path.startswith(prefix + "/"):
+                    break
+            else:
+                return self._send(404, {"message": "unknown service"})
+            sub = path[len(prefix):]
+            route = _UUID.sub("/:id", sub)
+            profile = services.profiles[service]
+            profile.wait()
+            if profile.fails():
+                status, payload = services.error(service)
+            else:
+                status, payload = getattr(services, service)(method, sub, body)
+            services.count(service, f"{method} {route}", status)
+            self._send(status, payload)
+
+        def do_GET(self):
+            self._handle("GET")
+
+        def do_POST(self):
+            self._handle("POST")
+
+        def do_PATCH(self):
+            self._handle("PATCH")
+
+    return Handler
+
+
+def parse_settings(items, cast=float):
+    # ("notion=0.3", "openai=1") → {"notion": 0.3, "openai": 1.0}。名前なしは全サービスに
+    out = {}
+    for item in items:
+        name, _, value = item.rpartition("=")
+        for service in ([name] if name else SERVICES):
+            if service not in SERVICES:
+                raise click.BadParameter(f"{service}: {', '.join(SERVICES)} のどれかを指定してください")
+            out[service] = cast(value)
+    return out
+
+
+def build_profiles(latency=(), jitter=(), error_rate=()):
+    latency, jitter, error_rate = parse_settings(latency), parse_settings(jitter), parse_settings(error_rate)
+    return {name: Profile(latency.get(name, 0.0), jitter.get(name, 0.0), error_rate.get(name, 0.0))
+            for name in SERVICES}
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8099, show_default=True)
+@click.option("--latency", multiple=True, help="サービス=秒（例: notion=0.3）")
+@click.option("--jitter", multiple=True, help="サービス=秒（遅延に 0〜この秒数を足す）")
+@click.option("--error-rate", multiple=True, help="サービス=割合（例: openai=0.05）")
+def main(host, port, latency, jitter, error_rate):
+    services = FakeServices(build_profiles(latency, jitter, error_rate), host=host, port=port)
+    print(f"[fake] {services.url} で待ち受けます（Ctrl+C で終了）")
+    try:
+        services.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
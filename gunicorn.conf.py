@@ -0,0 +1,8 @@
+# gunicorn は起動ディレクトリのこのファイルを自動で読む（gunicorn 'app:create_app()'）
+# ワーカーの準備が終わったところ（ポートは親プロセスが bind 済み）で、そのワーカーのスレッドと
+# ウォームアップを始める。--preload で fork されたワーカーでも、ここでワーカーごとに動かし直す
+
+
+def post_worker_init(worker):
+    import app
+    app.on_worker_start()
@@ -0,0 +1,125 @@
+import threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# 「ヒント」ボタン用の事前生成プール
+# ・テーマごとに汎用ヒントを溜めておき、low を下回ったら high までバックグラウンドで補充
+# ・テーマ選択時にそのユーザー向けの次のヒントを先読み（speculate）しておく
+# ・出すときは prev_hints と同じものは出さない（従来の重複防止ルール）
+
+FAILED_HINT = "（ヒント生成に失敗しました）"
+
+
+class HintPool:
+    def __init__(self, generate, themes, low=2, high=5, max_speculative=256,
+                 speculative_ttl=1800, workers=2):
+        self.generate = generate
+        self.themes = list(themes)
+        self.low = low
+        self.high = high
+        self.max_speculative = max_speculative
+        self.speculative_ttl = speculative_ttl
+        self._pools = {t: deque() for t in self.themes}
+        self._refilling = set()
+        self._speculative = {}   # uid → (theme, future, 作成時刻)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hint")
+        self._started = False
+        self.served_pool = 0
+        self.served_speculative = 0
+        self.misses = 0
+        self.generated = 0
+
+    def start(self):
+        if self._started or self.high <= 0:
+            return
+        self._started = True
+        for theme in self.themes:
+            self._maybe_refill(theme)
+
+    # ---------- 補充 ----------
+    def _maybe_refill(self, theme):
+        if self.high <= 0 or theme not in self._pools:
+            return
+        with self._lock:
+            if len(self._pools[theme]) >= self.low or theme in self._refilling:
+                return
+            self._refilling.add(theme)
+        self._executor.submit(self._refill, theme)
+
+    def _refill(self, theme):
+        try:
+            while True:
+                with self._lock:
+                    pool = list(self._pools[theme])
+                if len(pool) >= self.high:
+                    return
+                hint = self._generate_one(theme, None, pool)
+                if hint is None:
+                    return  # 失敗したら今回はあきらめる（呼び出し回数を増やさない）
+                with self._lock:
+                    if hint not in self._pools[theme]:
+                        self._pools[theme].append(hint)
+        finally:
+            with self._lock:
+                self._refilling.discard(theme)
+
+    def _generate_one(self, theme, prev_inputs, prev_hints):
+        hint = self.generate(theme, prev_inputs, prev_hints)[0]
+        with self._lock:
+            self.generated += 1
+        return None if not hint or hint == FAILED_HINT else hint
+
+    # ---------- 先読み ----------
+    def speculate(self, uid, theme, prev_inputs=None, prev_hints=None):
+        if self.high <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            self._drop_stale(now)
+            if len(self._speculative) >= self.max_speculative and uid not in self._speculative:
+                return
+            future = self._executor.submit(self._generate_one, theme,
+                                           list(prev_inputs or []), list(prev_hints or []))
+            self._speculative[uid] = (theme, future, now)
+
+    def _drop_stale(self, now):
+        dead = [uid for uid, (_, _, t) in self._speculative.items() if now - t > self.speculative_ttl]
+        for uid in dead:
+            del self._speculative[uid]
+
+    # ---------- 取り出し ----------
+    def take(self, uid, theme, prev_hints=None):
+        prev = set(prev_hints or [])
+        hint = None
+        with self._lock:
+            spec = self._speculative.get(uid)
+            if spec and spec[0] == theme and spec[1].done():
+                del self._speculative[uid]
+                candidate = spec[1].result() if spec[1].exception() is None else None
+                if candidate and candidate not in prev:
+                    hint = candidate
+                    self.served_speculative += 1
+            if hint is None and theme in self._pools:
+                pool = self._pools[theme]
+                for candidate in list(pool):
+                    if candidate not in prev:
+                        pool.remove(candidate)
+                        hint = candidate
+                        self.served_pool += 1
+                        break
+            if hint is None:
+                self.misses += 1
+        self._maybe_refill(theme)
+        return hint
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pool_sizes": {t: len(p) for t, p in self._pools.items()},
+                "speculative": len(self._speculative),
+                "served_pool": self.served_pool,
+                "served_speculative": self.served_speculative,
+                "misses": self.misses,
+                "generated": self.generated,
+            }
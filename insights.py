@@ -0,0 +1,145 @@
+import datetime
+import numpy as np
+
+# Reviewの履歴から「どんな日が良い日になりやすいか」を出す（相関分析）
+# ・履歴を日ごとの配列（★、感情タグ・価値観の 0/1 列）に並べ、欠けている日は NaN
+# ・「良い日」の目安 = その日の Value★ と Mission★ の平均
+# ・同じ日の相関と、前日の状態 → 翌日の★（lag）の相関を、列をまとめて一度に計算する
+# ・回答数が MIN_SAMPLES に満たない組み合わせは使わない
+
+MIN_SAMPLES = 5
+MIN_ABS_R = 0.2
+LAGS = (1,)
+
+
+def build_matrix(history, star_keys=("ValueStar", "MissionStar"), emotion_key="EmotionTag",
+                 value_key="CoreValue"):
+    # history = [(日付 "YYYY-MM-DD", {key: value}), ...] → (日付の配列, ★の配列, 特徴の行列, 列名)
+    if not history:
+        return None
+    ordinals = np.array([datetime.date.fromisoformat(day).toordinal() for day, _ in history])
+    start = ordinals.min()
+    n_days = int(ordinals.max() - start + 1)
+    idx = ordinals - start
+
+    stars = np.full((len(history), len(star_keys)), np.nan)
+    for i, (_, answers) in enumerate(history):
+        for j, key in enumerate(star_keys):
+            v = answers.get(key, "")
+            if v.isdigit():
+                stars[i, j] = float(v)
+    # 同じ日に複数回あれば平均
+    sums = np.zeros((n_days, len(star_keys)))
+    counts = np.zeros((n_days, len(star_keys)))
+    ok = ~np.isnan(stars)
+    np.add.at(sums, idx, np.where(ok, stars, 0.0))
+    np.add.at(counts, idx, ok)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        daily_stars = np.where(counts > 0, sums / counts, np.nan)
+
+    names, columns = [], []
+    for key, prefix in ((emotion_key, "感情"), (value_key, "価値観")):
+        labels = sorted({a[key] for _, a in history if a.get(key)})
+        if not labels:
+            continue
+        answered = np.zeros(n_days, dtype=bool)
+        hot = np.zeros((n_days, len(labels)))
+        pos = {label: k for k, label in enumerate(labels)}
+        rows = [(idx[i], pos[a[key]]) for i, (_, a) in enumerate(history) if a.get(key)]
+        r = np.array(rows)
+        hot[r[:, 0], r[:, 1]] = 1.0
+        answered[r[:, 0]] = True
+        hot[~answered] = np.nan  # 答えていない日は「0」ではなく「不明」
+        columns.append(hot)
+        names += [f"{prefix}「{label}」" for label in labels]
+    features = np.hstack(columns) if columns else np.empty((n_days, 0))
+    return start, daily_stars, features, names
+
+
+def masked_corr(y, X):
+    # y: (n,), X: (n, k)。NaN を除いた組ごとのピアソン相関と件数をまとめて計算
+    mask = ~np.isnan(X) & ~np.isnan(y)[:, None]
+    n = mask.sum(axis=0)
+    safe_n = np.maximum(n, 1)
+    Xz = np.where(mask, X, 0.0)
+    Yz = np.where(mask, y[:, None], 0.0)
+    dx = np.where(mask, X - Xz.sum(axis=0) / safe_n, 0.0)
+    dy = np.where(mask, y[:, None] - Yz.sum(axis=0) / safe_n, 0.0)
+    denom = np.sqrt((dx * dx).sum(axis=0) * (dy * dy).sum(axis=0))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        r = np.where(denom > 0, (dx * dy).sum(axis=0) / denom, np.nan)
+    return r, n
+
+
+def shift(a, lag):
+    # lag 日前の値を今日の行に並べる（先頭は NaN）
+    out = np.full_like(a, np.nan)
+    out[lag:] = a[:-lag]
+    return out
+
+
+def analyze(history, star_keys=("ValueStar", "MissionStar")):
+    built = build_matrix(history, star_keys)
+    if built is None:
+        return {"days": 0, "findings": []}
+    _, daily_stars, features, names = built
+    answered = (~np.isnan(daily_stars)).sum(axis=1)
+    score = np.where(answered > 0, np.nansum(daily_stars, axis=1) / np.maximum(answered, 1), np.nan)
+    findings = []
+
+    # 同じ日：感情・価値観と★
+    if features.shape[1]:
+        r, n = masked_corr(score, features)
+        findings += [{"feature": names[k], "lag": 0, "r": float(r[k]), "n": int(n[k])}
+                     for k in range(len(names))]
+
+    # 前日の状態（★・感情・価値観）→ 今日の★
+    lagged_names = [f"{key.replace('Star', '★')}" for key in star_keys] + names
+    lagged_all = np.hstack([daily_stars, features])
+    for lag in LAGS:
+        if len(score) <= lag:
+            continue
+        r, n = masked_corr(score, shift(lagged_all, lag))
+        findings += [{"feature": lagged_names[k], "lag": lag, "r": float(r[k]), "n": int(n[k])}
+                     for k in range(len(lagged_names))]
+
+    # Value★ と Mission★ の関係（同じ日）
+    if daily_stars.shape[1] == 2:
+        r, n = masked_corr(daily_stars[:, 0], daily_stars[:, 1:])
+        pair = {"r": float(r[0]), "n": int(n[0])}
+    else:
+        pair = None
+
+    findings = [f for f in findings if f["n"] >= MIN_SAMPLES and not np.isnan(f["r"]) and abs(f["r"]) >= MIN_ABS_R]
+    findings.sort(key=lambda f: -abs(f["r"]))
+    return {
+        "days": int(np.count_nonzero(~np.isnan(score))),
+        "mean": float(np.nanmean(score)) if np.any(~np.isnan(score)) else None,
+        "value_mission": pair,
+        "findings": findings,
+    }
+
+
+def insight_text(result, top=3):
+    if result["days"] < MIN_SAMPLES:
+        return f"まだデータが少ないです（{result['days']}日分）。Reviewを{MIN_SAMPLES}日以上続けると傾向が見えてきます。"
+    lines = [f"🔍 {result['days']}日分のReviewから（★平均 {result['mean']:.1f}）"]
+    good = [f for f in result["findings"] if f["r"] > 0][:top]
+    bad = [f for f in result["findings"] if f["r"] < 0][:top]
+
+    def label(f):
+        when = "前日に" if f["lag"] else "その日に"
+        return f"・{when}{f['feature']}（r={f['r']:+.2f}, {f['n']}日）"
+
+    if good:
+        lines.append("良い日になりやすい：")
+        lines += [label(f) for f in good]
+    if bad:
+        lines.append("★が下がりやすい：")
+        lines += [label(f) for f in bad]
+    if not good and not bad:
+        lines.append("はっきりした傾向はまだ見つかりませんでした。")
+    pair = result.get("value_mission")
+    if pair and pair["n"] >= MIN_SAMPLES and not np.isnan(pair["r"]):
+        lines.append(f"Value★とMission★の相関：r={pair['r']:+.2f}")
+    return "\n".join(lines)
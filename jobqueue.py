@@ -0,0 +1,164 @@
+import json, os, queue, sqlite3, threading, time, uuid
+
+# /callback で受けたイベントをバックグラウンドで処理するためのジョブキュー
+# path を渡すと SQLite に書いてから処理するので、再起動しても未処理分が残る
+# key_func を渡すと同じキー（ユーザー）のジョブは同じワーカーに入り、順番が入れ替わらない
+# 複数プロセス（gunicorn のワーカー）で同じ DB を使うときのため、ジョブには持ち主（owner）と
+# 期限（lease_until）を付ける。持ち主は lease の 1/3 ごとに期限を延ばし、
+# 期限が切れたジョブ（持ち主のプロセスが落ちた）だけを他のプロセスが引き取って処理し直す
+# 持ち主の名前はプロセスごと（gunicorn --preload で fork されたワーカーは別の持ち主になる）
+
+
+class JobQueue:
+    def __init__(self, func, workers=4, path=None, name="jobs", key_func=None, lease=60.0):
+        self.func = func
+        self.workers = max(1, workers)
+        self.path = path
+        self.name = name
+        self.key_func = key_func
+        self.lease = lease
+        self._owner = None
+        self._queues = [queue.Queue() for _ in range(self.workers)]
+        self._lock = threading.Lock()
+        self._threads = []
+        self._db = None
+        # 統計（/queue/stats で確認）
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0
+        self.started = 0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+        self.total_wait = 0.0
+        self.taken_over = 0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " payload TEXT NOT NULL,"
+                " enqueued_at REAL NOT NULL)"
+            )
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+            if "owner" not in columns:
+                # 古いDB：持ち主なし・期限切れ扱い（次に起動したプロセスが引き取る）
+                self._db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+                self._db.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL NOT NULL DEFAULT 0")
+
+    @property
+    def owner(self):
+        if self._owner is None or not self._owner.startswith(f"{os.getpid()}-"):
+            self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        return self._owner
+
+    def start(self):
+        # fork されたプロセスでは親のスレッドは動いていないので、もう一度起動する
+        if any(t.is_alive() for t in self._threads):
+            return
+        self._threads = []
+        if self._db is not None:
+            # 落ちたプロセスが処理しきれなかったジョブを引き取る（生きている他のプロセスの分は触らない）
+            self.take_over()
+            t = threading.Thread(target=self._keep_lease, name=f"{self.name}-lease", daemon=True)
+            t.start()
+            self._threads.append(t)
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, args=(self._queues[i],),
+                                 name=f"{self.name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def take_over(self):
+        now = time.time()
+        with self._lock:
+            rows = self._db.execute(
+                "UPDATE jobs SET owner = ?, lease_until = ? WHERE lease_until < ? AND owner IS NOT ?"
+                " RETURNING id, payload, enqueued_at",
+                (self.owner, now + self.lease, now, self.owner)).fetchall()
+            self.taken_over += len(rows)
+        for job_id, payload, enqueued_at in sorted(rows):
+            payload = json.loads(payload)
+            self._queue_for(payload).put((job_id, payload, enqueued_at))
+        if rows:
+            print(f"[{self.name}] 未処理ジョブを引き取って再投入: {len(rows)}件")
+        return len(rows)
+
+    def _keep_lease(self):
+        while True:
+            time.sleep(self.lease / 3)
+            try:
+                with self._lock:
+                    self._db.execute("UPDATE jobs SET lease_until = ? WHERE owner = ?",
+                                     (time.time() + self.lease, self.owner))
+                self.take_over()
+            except sqlite3.Error as e:
+                print(f"[{self.name}] lease の更新に失敗:", e)
+
+    def _queue_for(self, payload):
+        if self.key_func is None:
+            # キー指定なしは一番空いているキューへ
+            return min(self._queues, key=lambda q: q.qsize())
+        key = self.key_func(payload)
+        return self._queues[hash(key) % self.workers]
+
+    def put(self, payload):
+        now = time.time()
+        job_id = None
+        if self._db is not None:
+            with self._lock:
+                cur = self._db.execute(
+                    "INSERT INTO jobs (payload, enqueued_at, owner, lease_until) VALUES (?, ?, ?, ?)",
+                    (json.dumps(payload, ensure_ascii=False), now, self.owner, now + self.lease))
+                job_id = cur.lastrowid
+        with self._lock:
+            self.enqueued += 1
+        self._queue_for(payload).put((job_id, payload, now))
+
+    def _worker(self, q):
+        while True:
+            job_id, payload, enqueued_at = q.get()
+            wait = time.time() - enqueued_at
+            with self._lock:
+                self.busy += 1
+                self.started += 1
+                self.last_wait = wait
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                self.func(payload)
+                ok = True
+            except Exception as e:
+                print(f"[{self.name}] ジョブ処理エラー:", e)
+                ok = False
+            finally:
+                if job_id is not None:
+                    with self._lock:
+                        self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+                with self._lock:
+                    self.busy -= 1
+                    if ok:
+                        self.processed += 1
+                    else:
+                        self.failed += 1
+                q.task_done()
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "depth": self.depth(),
+                "busy": self.busy,
+                "workers": self.workers,
+                "enqueued": self.enqueued,
+                "processed": self.processed,
+                "failed": self.failed,
+                "wait_last_ms": round(self.last_wait * 1000, 1),
+                "wait_avg_ms": round(self.total_wait / self.started * 1000, 1) if self.started else 0.0,
+                "wait_max_ms": round(self.max_wait * 1000, 1),
+                "persistent": self._db is not None,
+                "taken_over": self.taken_over,
+            }
@@ -0,0 +1,37 @@
+import threading
+
+# 外部サービスのクライアント（OpenAI・LINE・Notion）を、最初に使うときに作る
+# ・Lazy(factory) は属性を読んだ時点で factory() を1回だけ呼び、以降はそのオブジェクトに転送する
+#   （import のたびに重いライブラリを読み込んだり、接続の準備をしたりしない）
+# ・複数のスレッドから同時に使われても作るのは1回だけ
+# ・Lazy 自身に属性を代入したとき（テストで差し替えるなど）は、そちらが優先される
+
+
+class Lazy:
+    def __init__(self, factory, name=None):
+        self._lazy_factory = factory
+        self._lazy_name = name or getattr(factory, "__name__", "lazy")
+        self._lazy_obj = None
+        self._lazy_lock = threading.Lock()
+
+    def build(self):
+        obj = self._lazy_obj
+        if obj is None:
+            with self._lazy_lock:
+                obj = self._lazy_obj
+                if obj is None:
+                    obj = self._lazy_obj = self._lazy_factory()
+        return obj
+
+    @property
+    def built(self):
+        return self._lazy_obj is not None
+
+    def __getattr__(self, item):
+        # 自分の属性に無いものだけここに来る
+        if item.startswith("_lazy_"):
+            raise AttributeError(item)
+        return getattr(self.build(), item)
+
+    def __repr__(self):
+        return f"<Lazy {self._lazy_name} {'built' if self.built else 'pending'}>"
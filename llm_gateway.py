@@ -0,0 +1,253 @@
+import threading, time
+from collections import deque
+
+# OpenAI 呼び出しの窓口（要約・ヒント・Whisper）
+# ・全体の同時実行数と、ユーザーごとの同時実行数をセマフォで制限。空かなければ queue_timeout 秒で諦める
+#   （待てる時間は種類ごとに queue_timeouts で変えられる。文字起こしのように待ってでも結果が欲しいもの用）
+#   per_user_kinds に書いた種類は、ユーザーごとの枠を他の種類と分けて持つ
+#   （長い音声の区間を並行に文字起こししても、要約・ヒントの枠を食わない）
+# ・呼び出しごとに時間の上限（budget 秒）をつける（SDK の自動リトライは使わない）
+# ・種類ごとのサーキットブレーカー：直近の失敗率が高いと open にして、しばらく即座に失敗させる
+#   （呼び出し側は今まで通り except で代わりの返事を出す。OpenAI の復旧待ちで Webhook を止めない）
+# ・待ち時間・処理時間・ブレーカーの状態は stats() で見る
+#   observer(kind, 秒, 結果) を渡すと1回ごとに知らせる（結果 = ok / error / timeout / busy / open）
+# ・openai は例外の種類を見るときに読み込む（import を軽くするため。例外が出る時点では読み込み済み）
+
+
+class LLMUnavailable(Exception):
+    # 混雑（reason="busy"）・ブレーカー open（reason="open"）で呼ばなかったとき
+    def __init__(self, message, reason="busy"):
+        super().__init__(message)
+        self.reason = reason
+
+
+class CircuitBreaker:
+    def __init__(self, window=20, window_sec=60.0, failure_rate=0.5, min_calls=5, cooldown=30.0):
+        self.window_sec = window_sec
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self._results = deque(maxlen=window)   # (時刻, 成功したか)
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.opens = 0
+        self._probing = False
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probing:
+                # 様子見で1件だけ通す
+                self._probing = True
+                return True
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "half_open":
+                self._probing = False
+                if ok:
+                    self.state = "closed"
+                    self._results.clear()
+                else:
+                    self._open(now)
+                return
+            self._results.append((now, ok))
+            while self._results and now - self._results[0][0] > self.window_sec:
+                self._results.popleft()
+            failures = sum(1 for _, r in self._results if not r)
+            if (self.state == "closed" and len(self._results) >= self.min_calls
+                    and failures / len(self._results) >= self.failure_rate):
+                self._open(now)
+
+    def release(self):
+        # 様子見の1件が成功・失敗のどちらとも言えずに終わったとき
+        with self._lock:
+            self._probing = False
+
+    def _open(self, now):
+        self.state = "open"
+        self.opened_at = now
+        self.opens += 1
+        print(f"[llm] ブレーカー open（{self.cooldown:.0f}秒）")
+
+
+def is_timeout(e):
+    import openai
+    return isinstance(e, openai.APITimeoutError)
+
+
+def is_upstream_failure(e):
+    # OpenAI 側の不調とみなすエラー（こちらの入力ミスの 400 などはブレーカーに数えない）
+    import openai
+    if isinstance(e, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code == 429 or e.status_code >= 500
+    return False
+
+
+class LLMGateway:
+    def __init__(self, client, max_concurrency=8, per_user=2, queue_timeout=2.0, budgets=None,
+                 default_budget=30.0, breaker_options=None, observer=None, queue_timeouts=None,
+                 per_user_kinds=None):
+        self.client = client
+        self.observer = observer
+        self.per_user = per_user
+        self.per_user_kinds = dict(per_user_kinds or {})   # 種類 → その種類だけの1ユーザーの同時実行数
+        self.queue_timeout = queue_timeout
+        self.queue_timeouts = dict(queue_timeouts or {})   # 種類 → 秒
+        self.budgets = dict(budgets or {})     # 種類 → 秒
+        self.default_budget = default_budget
+        self.breaker_options = breaker_options or {}
+        self._global = threading.BoundedSemaphore(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self._users = {}                       # uid か (uid, 種類) → [セマフォ, 使用中の数]
+        self._breakers = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def _breaker(self, kind):
+        with self._lock:
+            b = self._breakers.get(kind)
+            if b is None:
+                b = self._breakers[kind] = CircuitBreaker(**self.breaker_options)
+            return b
+
+    def _count(self, kind, **deltas):
+        with self._lock:
+            s = self._stats.setdefault(kind, {
+                "calls": 0, "ok": 0, "failures": 0, "timeouts": 0, "busy": 0, "open": 0,
+                "latency_ms_total": 0.0, "latency_ms_max": 0.0, "queue_ms_total": 0.0, "queue_ms_max": 0.0})
+            for key, value in deltas.items():
+                if key.endswith("_max"):
+                    s[key] = max(s[key], value)
+                else:
+                    s[key] += value
+
+    def per_user_limit(self, kind):
+        return self.per_user_kinds.get(kind, self.per_user)
+
+    def _user_key(self, uid, kind):
+        return (uid, kind) if kind in self.per_user_kinds else uid
+
+    def _user_slot(self, key, size):
+        with self._lock:
+            slot = self._users.get(key)
+            if slot is None:
+                slot = self._users[key] = [threading.BoundedSemaphore(size), 0]
+            slot[1] += 1
+            return slot[0]
+
+    def _user_done(self, key):
+        with self._lock:
+            slot = self._users.get(key)
+            if slot is not None:
+                slot[1] -= 1
+                if slot[1] <= 0:
+                    del self._users[key]
+
+    # ---------- 呼び出し ----------
+    def call(self, kind, func, uid=None, budget=None):
+        # func(client) を制限つきで実行。client にはタイムアウト設定済みのものを渡す
+        if self.observer is None:
+            return self._call(kind, func, uid, budget)
+        t0 = time.perf_counter()
+        outcome = "error"
+        try:
+            result = self._call(kind, func, uid, budget)
+            outcome = "ok"
+            return result
+        except LLMUnavailable as e:
+            outcome = e.reason
+            raise
+        except Exception as e:
+            if is_timeout(e):
+                outcome = "timeout"
+            raise
+        finally:
+            self.observer(kind, time.perf_counter() - t0, outcome)
+
+    def _call(self, kind, func, uid, budget):
+        breaker = self._breaker(kind)
+        if not breaker.allow():
+            self._count(kind, open=1)
+            raise LLMUnavailable(f"{kind}: ブレーカー open", reason="open")
+        budget = budget or self.budgets.get(kind, self.default_budget)
+        queue_timeout = self.queue_timeouts.get(kind, self.queue_timeout)
+        t0 = time.monotonic()
+        user_key = self._user_key(uid, kind) if uid else None
+        user_sem = self._user_slot(user_key, self.per_user_limit(kind)) if uid else None
+        acquired_user = acquired_global = False
+        try:
+            if user_sem is not None:
+                acquired_user = user_sem.acquire(timeout=queue_timeout)
+            if user_sem is None or acquired_user:
+                acquired_global = self._global.acquire(timeout=max(0.0, queue_timeout - (time.monotonic() - t0)))
+            waited = (time.monotonic() - t0) * 1000
+            self._count(kind, queue_ms_total=waited, queue_ms_max=waited)
+            if not acquired_global:
+                breaker.release()
+                self._count(kind, busy=1)
+                raise LLMUnavailable(f"{kind}: 混雑のため {queue_timeout:.0f}秒待っても空きがありません")
+            with self._lock:
+                self.in_flight += 1
+            t1 = time.monotonic()
+            try:
+                result = func(self.client.with_options(timeout=budget, max_retries=0))
+            except Exception as e:
+                upstream = is_upstream_failure(e)
+                if upstream:
+                    breaker.record(False)
+                else:
+                    breaker.release()
+                self._count(kind, calls=1, failures=1,
+                            timeouts=1 if is_timeout(e) else 0)
+                raise
+            finally:
+                elapsed = (time.monotonic() - t1) * 1000
+                self._count(kind, latency_ms_total=elapsed, latency_ms_max=elapsed)
+                with self._lock:
+                    self.in_flight -= 1
+            breaker.record(True)
+            self._count(kind, calls=1, ok=1)
+            return result
+        finally:
+            if acquired_global:
+                self._global.release()
+            if acquired_user:
+                user_sem.release()
+            if uid:
+                self._user_done(user_key)
+
+    def chat(self, kind, uid=None, budget=None, **kwargs):
+        # chat.completions.create の結果の本文
+        res = self.call(kind, lambda c: c.chat.completions.create(**kwargs), uid=uid, budget=budget)
+        return res.choices[0].message.content.strip()
+
+    def stats(self):
+        with self._lock:
+            kinds = {}
+            for kind, s in self._stats.items():
+                done = s["calls"] or 1
+                waits = s["calls"] + s["busy"] or 1
+                breaker = self._breakers.get(kind)
+                kinds[kind] = {
+                    "calls": s["calls"], "ok": s["ok"], "failures": s["failures"], "timeouts": s["timeouts"],
+                    "rejected_busy": s["busy"], "rejected_open": s["open"],
+                    "avg_ms": round(s["latency_ms_total"] / done, 1), "max_ms": round(s["latency_ms_max"], 1),
+                    "avg_queue_ms": round(s["queue_ms_total"] / waits, 1), "max_queue_ms": round(s["queue_ms_max"], 1),
+                    "breaker": breaker.state if breaker else "closed",
+                    "breaker_opens": breaker.opens if breaker else 0,
+                    "budget_sec": self.budgets.get(kind, self.default_budget),
+                    "queue_timeout_sec": self.queue_timeouts.get(kind, self.queue_timeout),
+                    "per_user": self.per_user_limit(kind),
+                }
+            return {"in_flight": self.in_flight, "max_concurrency": self.max_concurrency,
+                    "per_user": self.per_user, "users_waiting_or_running": len(self._users), "kinds": kinds}
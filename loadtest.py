@@ -0,0 +1,385 @@
+import base64, contextlib, hashlib, hmac, json, logging, math, os, random, shutil, socket, subprocess, sys
+import tempfile, threading, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import requests
+
+# Webhook の負荷試験（python loadtest.py --users 50 --concurrency 10）
+# ・LINE の署名つき Webhook を作り、memo・/life5・/review の会話を最後までたくさんのユーザーで流す
+#   （返信のクイックリプライから次に送るものを選ぶので、ペアワイズの回数などが違っても最後まで進む）
+# ・app はこのプロセスの中で起動し（werkzeug のスレッドサーバー）、LINE・Notion・OpenAI は
+#   fake_services.py を別プロセスで立ててそこに向ける（遅延・エラー率はサービスごとに指定）
+# ・結果はフローのステップごとの件数・エラー数・p50/p95/p99
+#   （返信までの時間と、StateMachine の observer で測った処理関数の時間）と、全体のスループット
+# ・DB は一時ディレクトリに作って終わったら消す。Notion のレート制限などは普段と同じ環境変数で変えられる
+
+SECRET = "loadtest-channel-secret"
+MAX_TURNS = 80
+UNHANDLED = "その操作は現在のステップでは使えません"
+FLOWS = {
+    # 最初に送るもの、終わったと判断する返信
+    "memo":   {"start": ["memo", "メモ"], "done": "メモを保存しました"},
+    "life5":  {"start": ["/life5"], "done": "すべて回答しました"},
+    "review": {"start": ["/review"], "done": "入力が完了しました"},
+}
+SENTENCES = [
+    "家族とゆっくり話す時間をもっと取りたい。", "朝に散歩をすると一日の調子がいい。",
+    "新しい仕事に挑戦してみたいけれど、まだ一歩が出ない。", "友人と久しぶりに会って元気をもらった。",
+    "健康診断の結果を見て、食事を見直そうと思った。", "やりたかった楽器をもう一度始めたい。",
+    "締め切りに追われて、大事なことを後回しにしていた気がする。", "子どもの頃の夢を思い出してみた。",
+    "感謝を伝えそびれた人に手紙を書こうと思う。", "週末は何もせずに休むことも大事だと感じた。",
+    "計画を小さく分けたら、思ったより進んだ。", "人の意見を聞いて考え方が少し変わった。",
+]
+
+
+# ---------- Webhook の組み立て ----------
+def sign(secret, body):
+    return base64.b64encode(hmac.new(secret.encode(), body.encode(), hashlib.sha256).digest()).decode()
+
+
+def webhook_body(uid, message, reply_token):
+    return json.dumps({
+        "destination": "Uloadtest",
+        "events": [{
+            "type": "message", "mode": "active", "timestamp": int(time.time() * 1000),
+            "webhookEventId": uuid.uuid4().hex.upper(),
+            "deliveryContext": {"isRedelivery": False},
+            "source": {"type": "user", "userId": uid},
+            "replyToken": reply_token,
+            "message": message,
+        }],
+    }, ensure_ascii=False)
+
+
+def text_message(text):
+    return {"type": "text", "id": str(random.randrange(10 ** 17, 10 ** 18)), "text": text}
+
+
+def audio_message(duration_ms):
+    return {"type": "audio", "id": str(random.randrange(10 ** 17, 10 ** 18)), "duration": duration_ms,
+            "contentProvider": {"type": "line"}}
+
+
+def answer_text(rng, long_rate):
+    # たまに長文（SUMMARY_LOCAL_MAX_CHARS を超えて LLM の要約に回るもの）を混ぜる
+    if rng.random() < long_rate:
+        out = ""
+        while len(out) < 700:
+            out += rng.choice(SENTENCES)
+        return out
+    return "".join(rng.sample(SENTENCES, rng.randint(1, 3)))
+
+
+def quick_texts(messages):
+    items = ((messages or [{}])[-1].get("quickReply") or {}).get("items") or []
+    return [i["action"]["text"] for i in items if i.get("action", {}).get("type") == "message"]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+# ---------- 記録 ----------
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = threading.local()
+        self.steps = {}       # replyToken → (flow, step)
+        self.handler = {}     # (flow, step) → [秒, ...]（処理関数）
+        self.samples = []     # (replyToken, 返信までの秒 or None, 失敗したか)
+        self.conversations = {"done": 0, "failed": 0}
+
+    # app 側に差し込む：dispatch_event の間だけ replyToken を覚え、observer でステップと結びつける
+    def wrap_dispatch(self, dispatch):
+        def wrapped(event):
+            self._current.token = getattr(event, "reply_token", None)
+            try:
+                return dispatch(event)
+            finally:
+                self._current.token = None
+        return wrapped
+
+    def wrap_observer(self, observer):
+        def wrapped(flow, step, seconds, failed):
+            token = getattr(self._current, "token", None)
+            with self._lock:
+                self.handler.setdefault((flow, step), []).append(seconds)
+                if token:
+                    self.steps[token] = (flow, step)
+            if observer is not None:
+                observer(flow, step, seconds, failed)
+        return wrapped
+
+    def record(self, token, seconds=None, failed=False):
+        # ステップとの結びつけは最後にまとめて（非同期モードでは返信が observer より先に届くことがある）
+        with self._lock:
+            self.samples.append((token, seconds, failed))
+
+    def finish(self, ok):
+        with self._lock:
+            self.conversations["done" if ok else "failed"] += 1
+
+    def report(self, elapsed):
+        with self._lock:
+            replies, errors = {}, {}
+            for token, seconds, failed in self.samples:
+                label = self.steps.get(token, ("-", "outside_flow"))  # フローに入らなかったもの（文字起こし失敗など）
+                if failed:
+                    errors[label] = errors.get(label, 0) + 1
+                if seconds is not None:
+                    replies.setdefault(label, []).append(seconds)
+            rows = []
+            for label in sorted(set(replies) | set(self.handler) | set(errors)):
+                reply, handler = replies.get(label, []), self.handler.get(label, [])
+                rows.append({
+                    "flow": label[0], "step": label[1], "count": len(reply), "errors": errors.get(label, 0),
+                    **{f"reply_p{p}_ms": _ms(percentile(reply, p)) for p in (50, 95, 99)},
+                    **{f"handler_p{p}_ms": _ms(percentile(handler, p)) for p in (50, 95, 99)},
+                })
+            every = [s for values in replies.values() for s in values]
+            total = {
+                "messages": len(every), "errors": sum(errors.values()), "elapsed_sec": round(elapsed, 2),
+                "messages_per_sec": round(len(every) / elapsed, 1) if elapsed else None,
+                "conversations": dict(self.conversations),
+                "conversations_per_sec": round(self.conversations["done"] / elapsed, 2) if elapsed else None,
+                **{f"reply_p{p}_ms": _ms(percentile(every, p)) for p in (50, 95, 99)},
+            }
+        return {"steps": rows, "total": total}
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+# ---------- 会話を流す ----------
+class Runner:
+    def __init__(self, app_url, services_url, recorder, think=0.0, long_rate=0.1, audio_rate=0.0,
+                 hint_rate=0.3, reply_timeout=30.0):
+        self.app_url = app_url
+        self.services_url = services_url
+        self.recorder = recorder
+        self.think = think
+        self.long_rate = long_rate
+        self.audio_rate = audio_rate
+        self.hint_rate = hint_rate
+        self.reply_timeout = reply_timeout
+        self._local = threading.local()
+
+    def session(self):
+        s = getattr(self._local, "session", None)
+        if s is None:
+            s = self._local.session = requests.Session()
+        return s
+
+    def send(self, uid, message):
+        # 返信（messages）を返す。失敗したら None
+        token = uuid.uuid4().hex
+        body = webhook_body(uid, message, token)
+        t0 = time.perf_counter()
+        try:
+            r = self.session().post(f"{self.app_url}/callback", data=body.encode(),
+                                    headers={"Content-Type": "application/json", "X-Line-Signature": sign(SECRET, body)},
+                                    timeout=self.reply_timeout)
+        except requests.RequestException:
+            self.recorder.record(token, failed=True)
+            return None
+        if r.status_code != 200:
+            self.recorder.record(token, failed=True)
+            return None
+        # 同期モードなら返信はもう届いている。非同期モードは届くまで待つ
+        done = time.perf_counter()
+        wait = 0.005
+        while True:
+            got = self.session().get(f"{self.services_url}/line/_replies/{token}", timeout=5)
+            if got.status_code == 200:
+                self.recorder.record(token, done - t0)
+                return got.json()["messages"]
+            if time.perf_counter() - t0 > self.reply_timeout:
+                self.recorder.record(token, failed=True)
+                return None
+            time.sleep(wait)
+            wait = min(wait * 2, 0.1)
+            done = time.perf_counter()
+
+    def next_message(self, reply, last, rng):
+        choices = quick_texts(reply)
+        if choices:
+            return text_message(rng.choice(choices))
+        if last.startswith("テーマ:") and rng.random() < self.hint_rate:
+            return text_message("ヒント")
+        if rng.random() < self.audio_rate:
+            return audio_message(rng.randint(3, 40) * 1000)
+        return text_message(answer_text(rng, self.long_rate))
+
+    def conversation(self, uid, flow, rng):
+        spec = FLOWS[flow]
+        queue = list(spec["start"])
+        reply, last = None, ""
+        for _ in range(MAX_TURNS):
+            message = text_message(queue.pop(0)) if queue else self.next_message(reply, last, rng)
+            last = message.get("text", "")
+            reply = self.send(uid, message)
+            if reply is None:
+                return False
+            texts = [m.get("text") or "" for m in reply]
+            if any(spec["done"] in t for t in texts):
+                return True
+            if any(UNHANDLED in t for t in texts):
+                print(f"[loadtest] {flow}: 想定外の返信で中断（{last[:20]}）", file=sys.stderr)
+                return False
+            if self.think:
+                time.sleep(rng.uniform(0, self.think * 2))
+        return False
+
+    def user(self, index, flows, conversations, seed):
+        rng = random.Random(seed * 100003 + index)
+        uid = "U" + hashlib.md5(f"loadtest-{seed}-{index}".encode()).hexdigest()
+        for _ in range(conversations):
+            self.recorder.finish(self.conversation(uid, rng.choice(flows), rng))
+
+
+# ---------- 起動 ----------
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_services(latency, jitter, error_rate):
+    port = free_port()
+    args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_services.py"),
+            "--port", str(port)]
+    for name, values in (("--latency", latency), ("--jitter", jitter), ("--error-rate", error_rate)):
+        for value in values:
+            args += [name, value]
+    proc = subprocess.Popen(args, stdout=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(f"{url}/_stats", timeout=1)
+            return proc, url
+        except requests.ConnectionError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.05)
+    proc.kill()
+    raise click.ClickException("fake_services.py が起動しませんでした")
+
+
+def start_app(services_url, data_dir, mode, recorder):
+    # app は import した時点で設定を読むので、先に接続先と保存先を環境変数で渡す
+    os.environ.update({
+        "LINE_CHANNEL_SECRET": SECRET, "LINE_CHANNEL_ACCESS_TOKEN": "loadtest",
+        "LINE_API_ENDPOINT": f"{services_url}/line", "LINE_API_DATA_ENDPOINT": f"{services_url}/line",
+        "NOTION_API_BASE": f"{services_url}/notion/v1", "OPENAI_BASE_URL": f"{services_url}/openai/v1",
+        "OPENAI_API_KEY": "loadtest", "NOTION_TOKEN": "loadtest", "NOTION_MEMO_SECRET": "loadtest-memo",
+        "NOTION_DBID": "loadtest-life5-db", "NOTION_REVIEW_DBID": "loadtest-review-db",
+        "CALLBACK_MODE": mode,
+    })
+    for name, filename in (("NOTION_OUTBOX_DB", "notion_outbox.db"), ("MEMO_INDEX_DB", "memo_index.db"),
+                           ("TIMER_DB", "timers.db"), ("ACTIVITY_DB", "activity.db"),
+                           ("REVIEW_STATS_DB", "review_stats.db"), ("CHART_CACHE_DIR", "chart_cache"),
+                           ("EXPORT_DIR", "exports")):
+        os.environ[name] = os.path.join(data_dir, filename)
+    os.environ.pop("JOB_QUEUE_DB", None)
+    os.environ.pop("DEDUPE_DB", None)
+    import app as bot
+    from werkzeug.serving import make_server
+    bot.flows.observer = recorder.wrap_observer(bot.flows.observer)
+    bot.dispatch_event = recorder.wrap_dispatch(bot.dispatch_event)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, bot.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="loadtest-app", daemon=True).start()
+    return bot, server, f"http://127.0.0.1:{server.server_port}"
+
+
+def print_report(result, services):
+    click.echo(f"{'flow/step':<28}{'count':>7}{'err':>5}  {'返信 p50/p95/p99 ms':>24}  {'処理 p50/p95/p99 ms':>24}")
+    for row in result["steps"]:
+        reply = "/".join(_fmt(row[f"reply_p{p}_ms"]) for p in (50, 95, 99))
+        handler = "/".join(_fmt(row[f"handler_p{p}_ms"]) for p in (50, 95, 99))
+        click.echo(f"{row['flow'] + '/' + row['step']:<28}{row['count']:>7}{row['errors']:>5}  {reply:>24}  {handler:>24}")
+    t = result["total"]
+    click.echo(f"\nメッセージ {t['messages']}件（エラー {t['errors']}）/ {t['elapsed_sec']}秒 = {t['messages_per_sec']} msg/s")
+    click.echo(f"会話 完了 {t['conversations']['done']} / 失敗 {t['conversations']['failed']}"
+               f"（{t['conversations_per_sec']} 会話/s）")
+    click.echo("返信 p50/p95/p99: " + " / ".join(_fmt(t[f"reply_p{p}_ms"]) for p in (50, 95, 99)) + " ms")
+    click.echo(f"Notion送信箱: 未送信 {result['outbox']['pending']} / 保留 {result['outbox']['dead']}"
+               f"（終了後 {result['outbox_drain_sec']}秒待機）")
+    calls = {}
+    for row in services:
+        key = (row["service"], "ok" if row["status"] < 400 else "error")
+        calls[key] = calls.get(key, 0) + row["count"]
+    click.echo("ダミーサーバーへの呼び出し: " + ", ".join(f"{s} {k}={n}" for (s, k), n in sorted(calls.items())))
+
+
+def _fmt(value):
+    return "-" if value is None else f"{value:.0f}" if value >= 10 else f"{value:.1f}"
+
+
+@click.command()
+@click.option("--users", default=20, show_default=True, help="ユーザー数")
+@click.option("--conversations", default=3, show_default=True, help="1ユーザーあたりの会話数")
+@click.option("--concurrency", default=8, show_default=True, help="同時に会話するユーザー数")
+@click.option("--flows", "flow_names", default="memo,life5,review", show_default=True)
+@click.option("--mode", type=click.Choice(["sync", "async"]), default="sync", show_default=True,
+              help="CALLBACK_MODE")
+@click.option("--think", default=0.0, show_default=True, help="メッセージの間の平均の待ち秒数")
+@click.option("--long-rate", default=0.1, show_default=True, help="自由入力を長文にする割合")
+@click.option("--audio-rate", default=0.0, show_default=True, help="自由入力を音声メッセージにする割合")
+@click.option("--hint-rate", default=0.3, show_default=True, help="life5 で「ヒント」を押す割合")
+@click.option("--latency", multiple=True, help="ダミーサーバーの遅延 サービス=秒（例: notion=0.3）")
+@click.option("--jitter", multiple=True, help="遅延に足すばらつき サービス=秒")
+@click.option("--error-rate", multiple=True, help="ダミーサーバーのエラー率 サービス=割合")
+@click.option("--reply-timeout", default=10.0, show_default=True, help="返信が届かないとエラーにする秒数")
+@click.option("--drain", default=30.0, show_default=True, help="終了後に Notion 送信箱が空になるのを待つ秒数")
+@click.option("--seed", default=1, show_default=True)
+@click.option("--json", "json_path", default=None, help="結果を JSON でも書き出す")
+@click.option("--verbose", is_flag=True, help="app のログも表示する")
+def main(users, conversations, concurrency, flow_names, mode, think, long_rate, audio_rate, hint_rate,
+         latency, jitter, error_rate, reply_timeout, drain, seed, json_path, verbose):
+    flows = [f.strip() for f in flow_names.split(",") if f.strip()]
+    unknown = [f for f in flows if f not in FLOWS]
+    if unknown:
+        raise click.BadParameter(f"{', '.join(unknown)}（{', '.join(FLOWS)} から選ぶ）", param_hint="--flows")
+    random.seed(seed)
+    proc, services_url = start_services(latency, jitter, error_rate)
+    data_dir = tempfile.mkdtemp(prefix="loadtest-")
+    recorder = Recorder()
+    quiet = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    try:
+        with quiet:
+            bot, server, app_url = start_app(services_url, data_dir, mode, recorder)
+            runner = Runner(app_url, services_url, recorder, think=think, long_rate=long_rate,
+                            audio_rate=audio_rate, hint_rate=hint_rate, reply_timeout=reply_timeout)
+            click.echo(f"[loadtest] {users}人 × {conversations}会話（同時 {concurrency}）を開始", err=True)
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="user") as pool:
+                list(pool.map(lambda i: runner.user(i, flows, conversations, seed), range(users)))
+            elapsed = time.perf_counter() - t0
+            # Notion への書き込みは送信箱から後で送られるので、空になるまで（drain 秒まで）待つ
+            t1 = time.perf_counter()
+            while bot.outbox.stats()["pending"] and time.perf_counter() - t1 < drain:
+                time.sleep(0.2)
+            result = recorder.report(elapsed)
+            result["outbox"] = bot.outbox.stats()
+            result["outbox_drain_sec"] = round(time.perf_counter() - t1, 1)
+            services = requests.get(f"{services_url}/_stats", timeout=5).json()
+            server.shutdown()
+            bot.outbox.stop()
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+        shutil.rmtree(data_dir, ignore_errors=True)
+    print_report(result, services)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump({**result, "services": services}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
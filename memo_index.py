@@ -0,0 +1,169 @@
+import datetime, re, sqlite3, threading, time, unicodedata
+
+# メモのローカル索引（「呼び出し」用）
+# Notion に書いたメモを SQLite にも同時に記録し、キーワード・カテゴリ・期間で即検索する。
+# ・キーワードは FTS5 の trigram（日本語でも分かち書き不要）。3文字未満は LIKE で探す
+# ・全角/半角・大文字/小文字は NFKC＋小文字化でそろえてから索引する
+# ・trigram が使えない SQLite では LIKE のみ
+# ・既存の Notion ブロックは backfill() で取り込む（block_id で重複しない）
+
+PERIODS = {"今日": 0, "昨日": 1, "今週": 6, "今月": 30}
+
+
+def normalize(text):
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+def parse_notion_time(value):
+    # "2024-06-01T12:34:00.000Z" → epoch秒
+    if not value:
+        return None
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def block_text(block):
+    body = block.get(block.get("type"), {}) or {}
+    return "".join(rt.get("plain_text") or rt.get("text", {}).get("content", "")
+                   for rt in body.get("rich_text", []))
+
+
+def parse_query(text, categories, subcategories=(), now=None):
+    # "仕事 会議 今週" → カテゴリ・サブカテゴリ・期間・キーワードに分ける
+    now = now or time.time()
+    query = {"keyword": None, "category": None, "subcategory": None, "since": None}
+    words = []
+    for word in (text or "").split():
+        if word in ("すべて", "全部"):
+            continue
+        if word in categories:
+            query["category"] = word
+        elif word in subcategories:
+            query["subcategory"] = word
+        elif word in PERIODS or re.fullmatch(r"\d+日", word):
+            days = PERIODS[word] if word in PERIODS else int(word[:-1]) - 1
+            start = datetime.datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+            query["since"] = (start - datetime.timedelta(days=max(days, 0))).timestamp()
+        else:
+            words.append(word)
+    if words:
+        query["keyword"] = " ".join(words)
+    return query
+
+
+class MemoIndex:
+    def __init__(self, path=":memory:"):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS memos ("
+            " id INTEGER PRIMARY KEY, block_id TEXT UNIQUE,"
+            " category TEXT, subcategory TEXT, content TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS memos_cat ON memos (category, subcategory, created_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS memos_at ON memos (created_at)")
+        try:
+            self._db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS memos_fts USING fts5(content, tokenize='trigram')")
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            print("[memo_index] FTS5(trigram) が使えないため LIKE で検索します:", e)
+            self.fts = False
+        self.searches = 0
+        self.search_ms_total = 0.0
+
+    def add(self, category, content, subcategory=None, block_id=None, created_at=None):
+        # 追加したら True（同じ block_id が登録済みなら False）
+        created_at = created_at or time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                cur = self._db.execute(
+                    "INSERT OR IGNORE INTO memos (block_id, category, subcategory, content, created_at)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (block_id, category, subcategory, content, created_at))
+                added = cur.rowcount == 1
+                if added and self.fts:
+                    self._db.execute("INSERT INTO memos_fts (rowid, content) VALUES (?, ?)",
+                                     (cur.lastrowid, normalize(content)))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return added
+
+    def rename_block(self, old_id, new_id):
+        # 送信箱の仮IDで登録したメモを、Notionで作られた本物のブロックIDに付け替える
+        with self._lock:
+            return self._db.execute("UPDATE OR IGNORE memos SET block_id = ? WHERE block_id = ?",
+                                    (new_id, old_id)).rowcount
+
+    def search(self, keyword=None, category=None, subcategory=None, since=None, until=None, limit=10):
+        t0 = time.perf_counter()
+        where, args = [], []
+        # スペース区切りのキーワードはすべて含むもの（AND）
+        for word in normalize(keyword).split():
+            if self.fts and len(word) >= 3:
+                where.append("m.id IN (SELECT rowid FROM memos_fts WHERE memos_fts MATCH ?)")
+                args.append('"' + word.replace('"', '""') + '"')
+            else:
+                # trigram は3文字未満を引けないので、その場合は本文を直接なめる
+                column = "(SELECT content FROM memos_fts WHERE rowid = m.id)" if self.fts else "m.content"
+                where.append(f"{column} LIKE ? ESCAPE '\\'")
+                args.append("%" + re.sub(r"([%_\\])", r"\\\1", word) + "%")
+        if category:
+            where.append("m.category = ?")
+            args.append(category)
+        if subcategory:
+            where.append("m.subcategory = ?")
+            args.append(subcategory)
+        if since is not None:
+            where.append("m.created_at >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("m.created_at < ?")
+            args.append(until)
+        sql = "SELECT m.category, m.subcategory, m.content, m.created_at FROM memos m"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY m.created_at DESC LIMIT ?"
+        args.append(limit)
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+            self.searches += 1
+            self.search_ms_total += (time.perf_counter() - t0) * 1000
+        return [{"category": c, "subcategory": s, "content": text, "created_at": at}
+                for c, s, text, at in rows]
+
+    def backfill(self, gateway, category_blocks, token=None):
+        # Notion の既存メモをカテゴリごとにストリームで取り込む。戻り値はカテゴリ→追加件数
+        added = {}
+        for category, block in category_blocks.items():
+            targets = block.items() if isinstance(block, dict) else [(None, block)]
+            for subcategory, block_id in targets:
+                n = 0
+                for child in gateway.iter_children(block_id, token=token):
+                    text = block_text(child)
+                    if not text:
+                        continue
+                    if self.add(category, text, subcategory, block_id=child.get("id"),
+                                created_at=parse_notion_time(child.get("created_time"))):
+                        n += 1
+                label = f"{category}/{subcategory}" if subcategory else category
+                added[label] = n
+                print(f"[memo_index] backfill {label}: {n}件")
+        return added
+
+    def stats(self):
+        with self._lock:
+            total = self._db.execute("SELECT COUNT(*) FROM memos").fetchone()[0]
+            per_category = dict(self._db.execute(
+                "SELECT category, COUNT(*) FROM memos GROUP BY category").fetchall())
+            return {
+                "memos": total,
+                "categories": per_category,
+                "fts": self.fts,
+                "searches": self.searches,
+                "avg_search_ms": round(self.search_ms_total / self.searches, 2) if self.searches else 0.0,
+            }
@@ -0,0 +1,202 @@
+import random, re, threading, time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+# Notion API への呼び出しをまとめる窓口
+# ・keep-alive セッションを使い回す（毎回TLSを張り直さない）
+# ・トークンごとのトークンバケットで ~3req/s に抑える
+# ・429 / 5xx は Retry-After を見てリトライ、全呼び出しにタイムアウト
+# ・ページ作成・ブロック追加（やり直すと二重にできる）は、接続できなかったと確実に言えるときだけリトライ。
+#   それ以外の通信エラーは None を返し、再送は呼び出し側（送信箱）に任せる
+# ・observer(method, route, status, 秒) を渡すと、呼び出しごと（リトライ込み）に時間を知らせる
+
+NOTION_API_BASE = "https://api.notion.com/v1"
+NOTION_VERSION  = "2022-06-28"
+RETRY_STATUS    = (429, 500, 502, 503, 504)
+_ID_SEGMENT     = re.compile(r"^[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}$")
+
+
+def is_idempotent(method, path):
+    # 同じ呼び出しを2回送っても結果が変わらないか（PATCH pages は同じ値の上書き、children の PATCH は追記）
+    if method in ("GET", "DELETE"):
+        return True
+    return method == "PATCH" and not path.rstrip("/").endswith("/children")
+
+
+def not_sent(e):
+    # 接続の確立に失敗した（リクエストは送られていない）と言えるエラー
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    cause = e.args[0] if e.args else None
+    return isinstance(getattr(cause, "reason", cause), NewConnectionError)
+
+
+def route_label(path):
+    # "pages/215476...c00" → "pages/:id"（メトリクスのラベルがIDの数だけ増えないように）
+    return "/".join(":id" if _ID_SEGMENT.match(part) else part for part in path.strip("/").split("/"))
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class NotionGateway:
+    def __init__(self, token, rate=3.0, burst=3, timeout=10.0, max_retries=4,
+                 base_url=NOTION_API_BASE, version=NOTION_VERSION, observer=None):
+        self.token = token
+        self.observer = observer
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.base_url = base_url.rstrip("/")
+        self.version = version
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Content-Type":   "application/json",
+            "Notion-Version": version,
+        })
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, token):
+        with self._lock:
+            b = self._buckets.get(token)
+            if b is None:
+                b = self._buckets[token] = TokenBucket(self.rate, self.burst)
+            return b
+
+    def request(self, method, path, json=None, params=None, token=None, timeout=None):
+        if self.observer is None:
+            return self._request(method, path, json, params, token, timeout)
+        t0 = time.perf_counter()
+        r = None
+        try:
+            r = self._request(method, path, json, params, token, timeout)
+            return r
+        finally:
+            self.observer(method, route_label(path), r.status_code if r is not None else "error",
+                          time.perf_counter() - t0)
+
+    def _request(self, method, path, json=None, params=None, token=None, timeout=None):
+        token = token or self.token
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        headers = {"Authorization": f"Bearer {token}"}
+        bucket = self._bucket(token)
+        idempotent = is_idempotent(method, path)
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+            try:
+                r = self.session.request(method, url, json=json, params=params, headers=headers,
+                                         timeout=timeout or self.timeout)
+            except requests.ConnectionError as e:
+                # 送った後に切られた場合もここに来るので、二重にできる呼び出しは未送信と確実なときだけ
+                if attempt >= self.max_retries or not (idempotent or not_sent(e)):
+                    print(f"[Notion {method} {path}] 接続エラー:", e)
+                    return None
+                time.sleep(self._backoff(attempt))
+                continue
+            except requests.Timeout as e:
+                # 送信済みかもしれないので、二重にできる呼び出しはリトライしない
+                if not idempotent or attempt >= self.max_retries:
+                    print(f"[Notion {method} {path}] タイムアウト:", e)
+                    return None
+                time.sleep(self._backoff(attempt))
+                continue
+            if r.status_code in RETRY_STATUS and attempt < self.max_retries:
+                wait = self._retry_after(r) or self._backoff(attempt)
+                print(f"[Notion {method} {path}] {r.status_code} → {wait:.1f}s後にリトライ")
+                time.sleep(wait)
+                continue
+            if not r.ok:
+                print(f"[Notion {method} {path}]", r.status_code, r.text[:300])
+            return r
+        return None
+
+    @staticmethod
+    def _retry_after(r):
+        try:
+            return float(r.headers.get("Retry-After", ""))
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _backoff(attempt):
+        return min(8.0, 0.5 * (2 ** attempt)) * (0.5 + random.random() / 2)
+
+    # ---------- よく使う呼び出し ----------
+    def create_page(self, database_id, properties, token=None):
+        r = self.request("POST", "pages", json={
+            "parent": {"database_id": database_id},
+            "properties": properties,
+        }, token=token)
+        return r.json().get("id") if r is not None and r.ok else None
+
+    def update_page(self, page_id, properties, token=None):
+        r = self.request("PATCH", f"pages/{page_id}", json={"properties": properties}, token=token)
+        return r is not None and r.ok
+
+    def append_children(self, block_id, children, token=None):
+        # 成功したら追加されたブロックのIDのリスト、失敗したら None
+        r = self.request("PATCH", f"blocks/{block_id}/children", json={"children": children}, token=token)
+        if r is None or not r.ok:
+            return None
+        return [b.get("id") for b in r.json().get("results", [])]
+
+    def iter_pages(self, method, path, body=None, token=None, page_size=100, cursor=None):
+        # ページ送りのある一覧APIを1ページずつ (results, next_cursor) で返す
+        # next_cursor が None なら最後のページ。cursor を渡すとそこから再開できる
+        while True:
+            if method == "GET":
+                params, json_body = {"page_size": page_size, **(body or {})}, None
+                if cursor:
+                    params["start_cursor"] = cursor
+            else:
+                params, json_body = None, {"page_size": page_size, **(body or {})}
+                if cursor:
+                    json_body["start_cursor"] = cursor
+            r = self.request(method, path, json=json_body, params=params, token=token)
+            if r is None or not r.ok:
+                raise RuntimeError(f"Notion {path} の取得に失敗しました")
+            data = r.json()
+            cursor = data.get("next_cursor") if data.get("has_more") else None
+            yield data.get("results", []), cursor
+            if cursor is None:
+                return
+
+    def iter_children(self, block_id, token=None, page_size=100):
+        # 子ブロックを1件ずつ返す（全件をメモリに溜めない）
+        for results, _ in self.iter_pages("GET", f"blocks/{block_id}/children", token=token, page_size=page_size):
+            yield from results
+
+    def iter_query(self, database_id, token=None, page_size=100, filter=None, sorts=None):
+        # データベースのページを1件ずつ返す（ページ送りは内部で）
+        body = {}
+        if filter:
+            body["filter"] = filter
+        if sorts:
+            body["sorts"] = sorts
+        for results, _ in self.iter_pages("POST", f"databases/{database_id}/query", body,
+                                          token=token, page_size=page_size):
+            yield from results
@@ -0,0 +1,334 @@
+import json, random, sqlite3, threading, time, uuid
+
+from notion_gateway import RETRY_STATUS
+
+# Notion への書き込み（ページ作成・プロパティ更新・ブロック追加）を先にローカルの SQLite に
+# 書いておき、専用スレッドが順番に Notion へ送る（write-ahead の送信箱）
+# ・create_page / update_page / append_children は NotionGateway と同じ形で呼べて、すぐ返る
+#   （作成系は "tmp-..." の仮IDを返す。後続の更新はその仮IDに向けて積めばよい）
+# ・送る直前に仮ID → 本物のIDに置き換える。作成が終わるまで、その仮IDへの更新は待つ
+# ・同じ宛先（ページ・ブロック）への書き込みは積んだ順に送る。失敗したら指数バックオフで再送
+# ・400 など再送しても直らないエラーは dead にして残す（outbox-retry で戻せる）
+# ・トークンそのものはDBに書かない（tokens={"memo": ...} の名前だけを保存する）
+# ・送る前に next_at を lease 秒先にして取り合うので、複数プロセスで同じDBを使っても二重に送らない
+#   （送信中に落ちたら lease 切れで再送）
+# ・仮ID → 本物のIDの対応は id_retention 秒たったら消す（まだ積まれている書き込みが指す仮IDは残す）
+# ・同じページへの update_page が続けて積まれていたら、プロパティをまとめて1回のPATCHで送る
+#   （後から積んだ値が勝つ。間に同じ宛先への別の書き込みがあればそこで区切る）
+#   update_page(..., hold=秒) で積むと、その秒数だけ後続の回答を待ってからまとめて送る。
+#   待っている間もDBには書いてあるので、再起動・別プロセスでも失われない（flush_target で即送り）
+
+TEMP_PREFIX = "tmp-"
+
+
+def is_temp_id(value):
+    return isinstance(value, str) and value.startswith(TEMP_PREFIX)
+
+
+class NotionOutbox:
+    def __init__(self, gateway, path="notion_outbox.db", tokens=None, poll_interval=5.0,
+                 base_backoff=2.0, max_backoff=300.0, max_attempts=50, lease=120.0, on_resolved=None,
+                 id_retention=7 * 86400, prune_interval=3600.0):
+        self.gateway = gateway
+        self.tokens = {name: token for name, token in (tokens or {}).items() if token}
+        self._token_names = {token: name for name, token in self.tokens.items()}
+        self.poll_interval = poll_interval
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.id_retention = id_retention
+        self.prune_interval = prune_interval
+        self.on_resolved = on_resolved      # on_resolved(仮ID, 本物のID)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL, target TEXT NOT NULL,"
+            " ref TEXT, payload TEXT NOT NULL, token TEXT, status TEXT NOT NULL DEFAULT 'pending',"
+            " attempts INTEGER NOT NULL DEFAULT 0, next_at REAL NOT NULL, last_error TEXT,"
+            " created_at REAL NOT NULL, hold_until REAL NOT NULL DEFAULT 0);"
+            "CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, id);"
+            "CREATE TABLE IF NOT EXISTS outbox_ids ("
+            " temp_id TEXT PRIMARY KEY, real_id TEXT NOT NULL, resolved_at REAL NOT NULL);"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(outbox)")}
+        if "hold_until" not in columns:
+            # 古いDB（まとめ送りの前）に列を足す
+            self._db.execute("ALTER TABLE outbox ADD COLUMN hold_until REAL NOT NULL DEFAULT 0")
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._next_prune = 0.0
+        self.enqueued = 0
+        self.applied = 0
+        self.retries = 0
+        self.dead = 0
+        self.pruned = 0
+        self.coalesced = 0
+        self.last_error = None
+
+    # ---------- 積む（NotionGateway と同じ呼び方） ----------
+    def create_page(self, database_id, properties, token=None):
+        ref = TEMP_PREFIX + uuid.uuid4().hex
+        return ref if self._enqueue("create_page", database_id, properties, token, ref) else None
+
+    def update_page(self, page_id, properties, token=None, hold=0.0):
+        # hold 秒のあいだは、同じページへの後続の update_page を待ってまとめて送る
+        return self._enqueue("update_page", page_id, properties, token, hold=hold) is not None
+
+    def append_children(self, block_id, children, token=None):
+        # 追加されるブロックのうち先頭だけ仮IDを返す（索引などの紐付け用）
+        ref = TEMP_PREFIX + uuid.uuid4().hex
+        return [ref] if self._enqueue("append_children", block_id, children, token, ref) else None
+
+    def _enqueue(self, op, target, payload, token, ref=None, hold=0.0):
+        # 積んだ行のIDを返す
+        if not target:
+            # 書き込み先の設定漏れ（DBIDが未設定など）は積んでも送れないので、失敗として返す
+            print(f"[outbox] {op}: 書き込み先が未設定です")
+            return None
+        if token and token not in self._token_names:
+            raise ValueError("NotionOutbox: tokens に登録されていないトークンです")
+        now = time.time()
+        with self._lock:
+            op_id = self._db.execute(
+                "INSERT INTO outbox (op, target, ref, payload, token, next_at, created_at, hold_until)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (op, target, ref, json.dumps(payload, ensure_ascii=False),
+                 self._token_names.get(token), now, now, now + hold if hold else 0)).lastrowid
+            self.enqueued += 1
+        self._wake.set()
+        return op_id
+
+    def flush_target(self, target):
+        # hold で待たせている書き込みを今すぐ送る（フロー完了時など）
+        with self._lock:
+            n = self._db.execute("UPDATE outbox SET hold_until = 0 WHERE target = ? AND status = 'pending'"
+                                 " AND hold_until > 0", (target,)).rowcount
+        self._wake.set()
+        return n
+
+    def resolve(self, value):
+        # 仮IDなら本物のID（まだ作成されていなければ None）、それ以外はそのまま
+        if not is_temp_id(value):
+            return value
+        with self._lock:
+            row = self._db.execute("SELECT real_id FROM outbox_ids WHERE temp_id = ?", (value,)).fetchone()
+        return row[0] if row else None
+
+    # ---------- 送る ----------
+    def start(self):
+        # fork されたプロセスでは親のスレッドは動いていないので、もう一度起動する
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            n = self._db.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+        if n:
+            print(f"[outbox] 未送信の書き込み {n}件を再送します")
+        self._thread = threading.Thread(target=self._run, name="notion-outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                if time.time() >= self._next_prune:
+                    self.prune_ids()
+                    self._next_prune = time.time() + self.prune_interval
+                sent = self.flush_once()
+            except Exception as e:
+                print("[outbox] エラー:", e)
+                sent = 0
+            if not sent:
+                self._wake.wait(self._next_wait())
+                self._wake.clear()
+
+    def _next_wait(self):
+        with self._lock:
+            row = self._db.execute("SELECT MIN(MAX(next_at, hold_until)) FROM outbox"
+                                   " WHERE status = 'pending'").fetchone()
+        if row[0] is None:
+            return self.poll_interval
+        return min(self.poll_interval, max(0.05, row[0] - time.time()))
+
+    def flush_once(self, limit=500):
+        # 送れるものを積んだ順に送る。送った件数を返す
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, op, target, ref, payload, token, attempts, next_at, hold_until FROM outbox"
+                " WHERE status = 'pending' ORDER BY id LIMIT ?", (limit,)).fetchall()
+        blocked = set()  # 先に積まれた書き込みが終わっていない宛先
+        merged = set()   # 前の update_page にまとめた行
+        sent = 0
+        now = time.time()
+        for i, (op_id, op, target, ref, payload, token, attempts, next_at, hold_until) in enumerate(rows):
+            key = ref if op == "create_page" else target
+            if key in blocked or op_id in merged:
+                continue
+            run = self._update_run(rows, i) if op == "update_page" else []
+            if hold_until > now and all(row[8] > now for row in run):
+                # 後続の回答を待っている（同じページへの続きのどれかが即送りなら待たない）
+                blocked.add(key)
+                continue
+            real = self.resolve(target) if op != "create_page" else target
+            if real is None:
+                if self._creator_failed(target):
+                    self._bury(op_id, "作成が失敗したページへの書き込み")
+                blocked.add(key)
+                continue
+            if next_at > now or not self._claim(op_id, next_at):
+                blocked.add(key)
+                continue
+            if run:
+                payload, ids = self._coalesce(op_id, payload, run, now)
+                merged.update(ids)
+            status, result = self._apply(op, real, json.loads(payload), self.tokens.get(token) if token else None)
+            if status == "ok":
+                self._done(op_id, ref, result)
+                sent += 1
+            elif status == "retry" and attempts + 1 < self.max_attempts:
+                self._retry(op_id, attempts + 1, result)
+                blocked.add(key)
+            else:
+                self._bury(op_id, result)
+                blocked.add(key)
+        return sent
+
+    @staticmethod
+    def _update_run(rows, i):
+        # rows[i] の後に続く、同じ宛先・同じトークンへの update_page（同じ宛先への別の書き込みで区切る）
+        _, _, target, _, _, token, *_ = rows[i]
+        run = []
+        for row in rows[i + 1:]:
+            if row[2] != target or row[1] == "create_page":
+                continue
+            if row[1] != "update_page" or row[5] != token:
+                break
+            run.append(row)
+        return run
+
+    def _coalesce(self, op_id, payload, run, now):
+        # 後続の update_page を先頭の行にまとめる（予約した先頭の行に書き戻してから送るので、
+        # 送信中に落ちても lease 切れでまとめた内容ごと再送される）
+        properties = json.loads(payload)
+        ids = []
+        with self._lock:
+            self._db.execute("BEGIN")
+            for row_id, _, _, _, row_payload, _, _, row_next_at, _ in run:
+                # 別プロセスが予約済み（送信中）の行はまとめない（そこから先は次の回に回す）
+                if row_next_at > now or self._db.execute("DELETE FROM outbox WHERE id = ? AND next_at = ? AND status = 'pending'",
+                                    (row_id, row_next_at)).rowcount != 1:
+                    break
+                properties.update(json.loads(row_payload))
+                ids.append(row_id)
+            payload = json.dumps(properties, ensure_ascii=False)
+            if ids:
+                self._db.execute("UPDATE outbox SET payload = ? WHERE id = ?", (payload, op_id))
+            self._db.execute("COMMIT")
+            self.coalesced += len(ids)
+        return payload, ids
+
+    def _claim(self, op_id, next_at):
+        with self._lock:
+            return self._db.execute("UPDATE outbox SET next_at = ? WHERE id = ? AND next_at = ? AND status = 'pending'",
+                                    (time.time() + self.lease, op_id, next_at)).rowcount == 1
+
+    def _apply(self, op, target, payload, token):
+        if op == "create_page":
+            r = self.gateway.request("POST", "pages", json={"parent": {"database_id": target},
+                                                            "properties": payload}, token=token)
+        elif op == "update_page":
+            r = self.gateway.request("PATCH", f"pages/{target}", json={"properties": payload}, token=token)
+        else:
+            r = self.gateway.request("PATCH", f"blocks/{target}/children", json={"children": payload}, token=token)
+        if r is None:
+            return "retry", "接続エラー／タイムアウト"
+        if r.ok:
+            data = r.json()
+            if op == "append_children":
+                results = data.get("results") or [{}]
+                return "ok", results[0].get("id")
+            return "ok", data.get("id")
+        error = f"{r.status_code} {r.text[:200]}"
+        return ("retry" if r.status_code in RETRY_STATUS or r.status_code == 409 else "dead"), error
+
+    def _done(self, op_id, ref, real_id):
+        with self._lock:
+            self._db.execute("BEGIN")
+            if ref and real_id:
+                self._db.execute("INSERT OR REPLACE INTO outbox_ids (temp_id, real_id, resolved_at) VALUES (?, ?, ?)",
+                                 (ref, real_id, time.time()))
+            self._db.execute("DELETE FROM outbox WHERE id = ?", (op_id,))
+            self._db.execute("COMMIT")
+            self.applied += 1
+        if ref and real_id and self.on_resolved is not None:
+            try:
+                self.on_resolved(ref, real_id)
+            except Exception as e:
+                print("[outbox] on_resolved エラー:", e)
+
+    def _retry(self, op_id, attempts, error):
+        wait = min(self.max_backoff, self.base_backoff * (2 ** (attempts - 1))) * (0.5 + random.random() / 2)
+        with self._lock:
+            self._db.execute("UPDATE outbox SET attempts = ?, next_at = ?, last_error = ? WHERE id = ?",
+                             (attempts, time.time() + wait, error, op_id))
+            self.retries += 1
+            self.last_error = error
+        print(f"[outbox] #{op_id} 失敗（{attempts}回目）→ {wait:.0f}秒後に再送: {error}")
+
+    def _bury(self, op_id, error):
+        with self._lock:
+            self._db.execute("UPDATE outbox SET status = 'dead', last_error = ? WHERE id = ?", (error, op_id))
+            self.dead += 1
+            self.last_error = error
+        print(f"[outbox] #{op_id} を保留（dead）にしました: {error}")
+
+    def _creator_failed(self, temp_id):
+        # 仮IDを作るはずだった書き込みが dead になっている／どこにも無い
+        with self._lock:
+            row = self._db.execute("SELECT status FROM outbox WHERE ref = ?", (temp_id,)).fetchone()
+        return row is None or row[0] == "dead"
+
+    def prune_ids(self, now=None):
+        # 古い仮IDの対応を消す。dead で残っている書き込みなどがまだ指している仮IDは残す
+        before = (now or time.time()) - self.id_retention
+        with self._lock:
+            n = self._db.execute(
+                "DELETE FROM outbox_ids WHERE resolved_at < ?"
+                " AND temp_id NOT IN (SELECT target FROM outbox)", (before,)).rowcount
+            self.pruned += n
+        if n:
+            print(f"[outbox] 古い仮IDの対応 {n}件を削除しました")
+        return n
+
+    def retry_dead(self):
+        # dead にしたものを送り直す（原因を直してから）
+        with self._lock:
+            n = self._db.execute("UPDATE outbox SET status = 'pending', attempts = 0, next_at = ?"
+                                 " WHERE status = 'dead'", (time.time(),)).rowcount
+        self._wake.set()
+        return n
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+            oldest = self._db.execute("SELECT MIN(created_at) FROM outbox WHERE status = 'pending'").fetchone()[0]
+            return {
+                "pending": counts.get("pending", 0),
+                "dead": counts.get("dead", 0),
+                "oldest_pending_sec": round(time.time() - oldest, 1) if oldest else 0.0,
+                "enqueued": self.enqueued,
+                "applied": self.applied,
+                "retries": self.retries,
+                "pruned_ids": self.pruned,
+                "coalesced": self.coalesced,
+                "last_error": self.last_error,
+            }
@@ -0,0 +1,242 @@
+import datetime, sqlite3, threading
+
+# Reviewの回答を週・月ごとに集計しておく（ダッシュボード用）
+# ・回答が記録されるたびに差分だけ足し引きする（同じ質問の答え直しは古い値を引いてから足す）
+# ・★の平均、感情タグの分布、連続日数（ストリーク）を保持。参照は決まった数の行を引くだけ
+# ・ユーザーごとの version は更新のたびに +1（グラフのキャッシュキーなどに使う）
+# ・rebuild 用に reset() と、Notion のページから取り込む record(..., at=...) を用意
+#   CoreValue は Notion に書いていないので、reset() でも消さずに残す（取り込み後もそのまま使う）
+
+STAR_KEYS = ("ValueStar", "MissionStar")
+EMOTION_KEY = "EmotionTag"
+CORE_VALUE_KEY = "CoreValue"  # その日のLife5で選んだ最重要価値観（集計には足さず、分析用に残すだけ）
+
+
+def periods(day):
+    year, week, _ = day.isocalendar()
+    return f"w:{year}-W{week:02d}", f"m:{day:%Y-%m}"
+
+
+def week_key(day):
+    return periods(day)[0]
+
+
+def month_key(day):
+    return periods(day)[1]
+
+
+class ReviewStats:
+    def __init__(self, path=":memory:"):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS review_answers ("
+            " review_id TEXT NOT NULL, key TEXT NOT NULL, uid TEXT NOT NULL, day TEXT NOT NULL,"
+            " value TEXT NOT NULL, PRIMARY KEY (review_id, key));"
+            "CREATE TABLE IF NOT EXISTS review_aggregates ("
+            " uid TEXT NOT NULL, period TEXT NOT NULL, metric TEXT NOT NULL,"
+            " count INTEGER NOT NULL, total REAL NOT NULL, PRIMARY KEY (uid, period, metric));"
+            "CREATE TABLE IF NOT EXISTS review_days (uid TEXT NOT NULL, day TEXT NOT NULL, PRIMARY KEY (uid, day));"
+            "CREATE TABLE IF NOT EXISTS review_streaks ("
+            " uid TEXT PRIMARY KEY, last_day TEXT NOT NULL, current INTEGER NOT NULL, best INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS review_versions (uid TEXT PRIMARY KEY, version INTEGER NOT NULL);"
+        )
+        self.updates = 0
+
+    # ---------- 更新 ----------
+    def record(self, uid, review_id, answers, at=None):
+        day = (at or datetime.datetime.now()).date()
+        tracked = {k: v for k, v in answers.items() if k in STAR_KEYS or k in (EMOTION_KEY, CORE_VALUE_KEY)}
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                first = self._db.execute(
+                    "SELECT 1 FROM review_answers WHERE review_id = ? AND key = ''", (review_id,)).fetchone() is None
+                if first:
+                    # そのReviewの最初の回答で「回答した日」として数える
+                    self._db.execute("INSERT INTO review_answers (review_id, key, uid, day, value)"
+                                     " VALUES (?, '', ?, ?, '')", (review_id, uid, day.isoformat()))
+                    self._add(uid, day, "reviews", 1, 0)
+                    self._mark_day(uid, day)
+                else:
+                    day = datetime.date.fromisoformat(self._db.execute(
+                        "SELECT day FROM review_answers WHERE review_id = ? AND key = ''",
+                        (review_id,)).fetchone()[0])
+                for key, value in tracked.items():
+                    self._apply(uid, review_id, day, key, str(value))
+                self._db.execute(
+                    "INSERT INTO review_versions (uid, version) VALUES (?, 1)"
+                    " ON CONFLICT (uid) DO UPDATE SET version = version + 1", (uid,))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self.updates += 1
+
+    def _apply(self, uid, review_id, day, key, value):
+        row = self._db.execute("SELECT value FROM review_answers WHERE review_id = ? AND key = ?",
+                               (review_id, key)).fetchone()
+        if row is not None:
+            if row[0] == value:
+                return
+            self._contribute(uid, day, key, row[0], -1)
+        self._db.execute(
+            "INSERT INTO review_answers (review_id, key, uid, day, value) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (review_id, key) DO UPDATE SET value = excluded.value",
+            (review_id, key, uid, day.isoformat(), value))
+        self._contribute(uid, day, key, value, 1)
+
+    def _contribute(self, uid, day, key, value, sign):
+        if key in STAR_KEYS:
+            if value.isdigit() and 1 <= int(value) <= 5:
+                self._add(uid, day, key, sign, sign * int(value))
+        elif key == EMOTION_KEY and value:
+            self._add(uid, day, f"emotion:{value}", sign, 0)
+
+    def _add(self, uid, day, metric, count, total):
+        for period in periods(day):
+            self._db.execute(
+                "INSERT INTO review_aggregates (uid, period, metric, count, total) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (uid, period, metric) DO UPDATE SET"
+                " count = count + excluded.count, total = total + excluded.total",
+                (uid, period, metric, count, total))
+
+    def _mark_day(self, uid, day):
+        cur = self._db.execute("INSERT OR IGNORE INTO review_days (uid, day) VALUES (?, ?)",
+                                (uid, day.isoformat()))
+        if cur.rowcount == 0:
+            return
+        row = self._db.execute("SELECT last_day, current, best FROM review_streaks WHERE uid = ?",
+                               (uid,)).fetchone()
+        if row is None:
+            current, best, last = 1, 1, day
+        else:
+            last = datetime.date.fromisoformat(row[0])
+            if day == last + datetime.timedelta(days=1):
+                current, best, last = row[1] + 1, max(row[2], row[1] + 1), day
+            elif day > last:
+                current, best, last = 1, row[2], day
+            else:
+                # 取り込み（rebuild）で過去の日が後から来たときだけ数え直す
+                current, best, last = self._recount(uid)
+        self._db.execute(
+            "INSERT INTO review_streaks (uid, last_day, current, best) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (uid) DO UPDATE SET last_day = excluded.last_day,"
+            " current = excluded.current, best = excluded.best",
+            (uid, last.isoformat(), current, best))
+
+    def _recount(self, uid):
+        days = [datetime.date.fromisoformat(d) for (d,) in self._db.execute(
+            "SELECT day FROM review_days WHERE uid = ? ORDER BY day", (uid,))]
+        current = best = 0
+        prev = None
+        for d in days:
+            current = current + 1 if prev is not None and d == prev + datetime.timedelta(days=1) else 1
+            best = max(best, current)
+            prev = d
+        return current, best, prev
+
+    def reset(self, uid=None):
+        with self._lock:
+            self._db.execute("DELETE FROM review_answers WHERE key != ?"
+                             + ("" if uid is None else " AND uid = ?"),
+                             (CORE_VALUE_KEY,) if uid is None else (CORE_VALUE_KEY, uid))
+            for table in ("review_aggregates", "review_days", "review_streaks"):
+                if uid is None:
+                    self._db.execute(f"DELETE FROM {table}")
+                else:
+                    self._db.execute(f"DELETE FROM {table} WHERE uid = ?", (uid,))
+            # version は消さずに進める（古いキャッシュを使わないように）
+            self._db.execute("UPDATE review_versions SET version = version + 1"
+                             + ("" if uid is None else " WHERE uid = ?"), () if uid is None else (uid,))
+
+    # ---------- 参照 ----------
+    def version(self, uid):
+        with self._lock:
+            row = self._db.execute("SELECT version FROM review_versions WHERE uid = ?", (uid,)).fetchone()
+        return row[0] if row else 0
+
+    def period(self, uid, key):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT metric, count, total FROM review_aggregates WHERE uid = ? AND period = ?",
+                (uid, key)).fetchall()
+        return self._shape(rows)
+
+    @staticmethod
+    def _shape(rows):
+        out = {"reviews": 0, "emotions": {}}
+        for key in STAR_KEYS:
+            out[key] = None
+        for metric, count, total in rows:
+            if metric == "reviews":
+                out["reviews"] = count
+            elif metric in STAR_KEYS:
+                out[metric] = round(total / count, 2) if count else None
+            elif metric.startswith("emotion:") and count > 0:
+                out["emotions"][metric[len("emotion:"):]] = count
+        return out
+
+    def series(self, uid, kind="w", n=8, today=None):
+        # 直近 n 週（kind="w"）または n か月（kind="m"）の集計を古い順に
+        today = today or datetime.date.today()
+        keys = []
+        for i in range(n - 1, -1, -1):
+            if kind == "w":
+                keys.append(week_key(today - datetime.timedelta(weeks=i)))
+            else:
+                y, m = divmod(today.year * 12 + today.month - 1 - i, 12)
+                keys.append(f"m:{y}-{m + 1:02d}")
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT period, metric, count, total FROM review_aggregates"
+                f" WHERE uid = ? AND period IN ({','.join('?' * len(keys))})", (uid, *keys)).fetchall()
+        grouped = {k: [] for k in keys}
+        for period, metric, count, total in rows:
+            grouped[period].append((metric, count, total))
+        return [(k[2:], self._shape(grouped[k])) for k in keys]
+
+    def streak(self, uid, today=None):
+        today = today or datetime.date.today()
+        with self._lock:
+            row = self._db.execute("SELECT last_day, current, best FROM review_streaks WHERE uid = ?",
+                                   (uid,)).fetchone()
+        if row is None:
+            return 0, 0
+        last = datetime.date.fromisoformat(row[0])
+        # 昨日までに途切れていれば 0
+        current = row[1] if (today - last).days <= 1 else 0
+        return current, row[2]
+
+    def summary(self, uid, today=None):
+        today = today or datetime.date.today()
+        current, best = self.streak(uid, today)
+        week, month = periods(today)
+        return {
+            "week": self.period(uid, week),
+            "month": self.period(uid, month),
+            "streak": current,
+            "best_streak": best,
+            "version": self.version(uid),
+        }
+
+    def history(self, uid):
+        # 分析用：Reviewごとの回答を日付順に [(日付, {key: value}), ...]
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT review_id, day, key, value FROM review_answers WHERE uid = ? ORDER BY day, review_id",
+                (uid,)).fetchall()
+        out = {}
+        for review_id, day, key, value in rows:
+            entry = out.setdefault(review_id, (day, {}))
+            if key:
+                entry[1][key] = value
+        return list(out.values())
+
+    def stats(self):
+        with self._lock:
+            users = self._db.execute("SELECT COUNT(*) FROM review_versions").fetchone()[0]
+            reviews = self._db.execute("SELECT COUNT(*) FROM review_answers WHERE key = ''").fetchone()[0]
+        return {"users": users, "reviews": reviews, "updates": self.updates}
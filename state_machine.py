@@ -0,0 +1,151 @@
+import threading, time
+
+# メッセージの振り分け表（(フロー, ステップ, 入力の種類) → 処理関数）
+# 毎回 if を上から順に文字列比較していく代わりに、辞書を数回引くだけで行き先が決まる。
+#
+# 入力の種類（kind）:
+#   "audio"            音声（文字起こし後のテキストが ctx.text に入る）
+#   "text"             ふつうのテキスト
+#   words に登録した語   完全一致（例: "ヒント" → "hint"）
+#   prefixes に登録した接頭辞  例: "ペア:創造性" → kind="pair", ctx.arg="創造性"
+#
+# 探す順番（フローごと）:
+#   (flow, step, kind) → (flow, "*", kind) → (flow, step, "text") → (flow, "*", "text")
+#   音声は "audio" で登録されたルートにしか入らない
+# command(kind) はどのステップでも最優先。command(kind, after_flows=True) はフローの途中なら
+# フロー側（自由入力のステップなど）を先に試し、どのフローも扱わなかったときだけ呼ばれる
+#
+# observer(flow, step, 秒, 例外が出たか) を渡すと、処理関数を1回呼ぶごとに知らせる（メトリクス用）
+
+
+class Context:
+    __slots__ = ("uid", "text", "event", "is_audio", "kind", "arg", "flow", "step")
+
+    def __init__(self, uid, text, event, is_audio, kind, arg):
+        self.uid = uid
+        self.text = text
+        self.event = event
+        self.is_audio = is_audio
+        self.kind = kind
+        self.arg = arg
+        self.flow = None
+        self.step = None
+
+
+class StateMachine:
+    def __init__(self, words=None, prefixes=None, observer=None):
+        self.observer = observer
+        self.words = dict(words or {})          # 完全一致の語 → kind
+        self.prefixes = dict(prefixes or {})    # "ペア" → "pair"
+        self.commands = {}                      # kind → 処理（どのステップでも最優先）
+        self.after_flows = set()                # フローの後に回す command の kind
+        self.routes = {}
+        self.flows = []                         # (name, step_func) 優先順
+        self._lock = threading.Lock()
+        self.messages = 0
+        self.probes = 0
+        self.unhandled = 0
+        self.timings = {}                       # "flow/step" → [回数, 合計秒, 最大秒]
+
+    # ---------- 登録 ----------
+    def flow(self, name, step_func):
+        # step_func(uid) は現在のステップを返す。None ならこのフローは対象外
+        self.flows.append((name, step_func))
+
+    def route(self, flow, steps, kinds=("text",)):
+        steps = (steps,) if isinstance(steps, str) else steps
+        kinds = (kinds,) if isinstance(kinds, str) else kinds
+
+        def deco(func):
+            for step in steps:
+                for kind in kinds:
+                    self.routes[(flow, step, kind)] = func
+            return func
+        return deco
+
+    def command(self, kind, after_flows=False):
+        def deco(func):
+            self.commands[kind] = func
+            if after_flows:
+                self.after_flows.add(kind)
+            return func
+        return deco
+
+    # ---------- 振り分け ----------
+    def classify(self, text, is_audio):
+        if is_audio:
+            return "audio", None
+        kind = self.words.get(text) or self.words.get(text.lower())
+        if kind:
+            return kind, None
+        head, sep, rest = text.partition(":")
+        if sep and head in self.prefixes:
+            return self.prefixes[head], rest
+        return "text", None
+
+    def dispatch(self, uid, text, event, is_audio=False):
+        kind, arg = self.classify(text, is_audio)
+        ctx = Context(uid, text, event, is_audio, kind, arg)
+        probes = 1
+        handled = False
+        command = self.commands.get(kind)
+        if command is not None and kind not in self.after_flows:
+            ctx.flow, ctx.step = "command", kind
+            handled = self._run(command, ctx)
+        else:
+            for name, step_func in self.flows:
+                step = step_func(uid)
+                if step is None:
+                    continue
+                keys = ((name, step, kind), (name, "*", kind)) if is_audio else \
+                       ((name, step, kind), (name, "*", kind), (name, step, "text"), (name, "*", "text"))
+                for key in keys:
+                    probes += 1
+                    func = self.routes.get(key)
+                    if func is not None:
+                        ctx.flow, ctx.step = name, step
+                        handled = self._run(func, ctx)
+                        break
+                if handled:
+                    break
+            if not handled and command is not None:
+                ctx.flow, ctx.step = "command", kind
+                handled = self._run(command, ctx)
+        with self._lock:
+            self.messages += 1
+            self.probes += probes
+            if not handled:
+                self.unhandled += 1
+        return handled
+
+    def _run(self, func, ctx):
+        # 処理関数が False を返したら「このフローでは扱わない」として次のフローへ
+        t0 = time.perf_counter()
+        failed = True
+        try:
+            handled = func(ctx) is not False
+            failed = False
+            return handled
+        finally:
+            elapsed = time.perf_counter() - t0
+            if self.observer is not None:
+                self.observer(ctx.flow, ctx.step, elapsed, failed)
+            label = f"{ctx.flow}/{ctx.step}"
+            with self._lock:
+                t = self.timings.setdefault(label, [0, 0.0, 0.0])
+                t[0] += 1
+                t[1] += elapsed
+                t[2] = max(t[2], elapsed)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "messages": self.messages,
+                "routes": len(self.routes) + len(self.commands),
+                "avg_probes": round(self.probes / self.messages, 2) if self.messages else 0.0,
+                "unhandled": self.unhandled,
+                "steps": {
+                    label: {"count": n, "avg_ms": round(total / n * 1000, 2), "max_ms": round(mx * 1000, 2)}
+                    for label, (n, total, mx) in self.timings.items()
+                },
+            }
@@ -0,0 +1,382 @@
+import json, os, sqlite3, threading, time, uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+# 会話の進行状態（memo / life5 / review）の保存先
+# ・MemoryStateBackend: 従来通りプロセス内の辞書（1ワーカー専用）
+# ・SQLiteStateBackend: WALモードのSQLite。複数プロセス（gunicorn複数ワーカー）で共有でき、再起動でも消えない
+# 1メッセージの処理中は user_session(uid) でそのユーザーをロックし、
+# 読み込み→変更→書き戻しをまとめて行う（同じユーザーの処理が別プロセスと混ざらない）
+# SQLite のロックは lease 秒のリースで、持っている間は裏のスレッドが延長し続ける
+# （長い音声の文字起こしなどで lease を超えても、別プロセスに横取りされない）。
+# 待っても取れなければ StateLockTimeout を投げる（イベントは失敗扱いになり、LINE の再送で処理し直す）
+
+
+class StateLockTimeout(Exception):
+    pass
+
+
+class MemoryStateBackend:
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def load(self, ns, uid):
+        with self._lock:
+            item = self._data.get((ns, uid))
+        if item is None:
+            return None, 0
+        data, version, expires_at = item
+        if expires_at and expires_at < time.time():
+            self.delete(ns, uid)
+            return None, 0
+        return json.loads(data), version
+
+    def version(self, ns, uid):
+        with self._lock:
+            item = self._data.get((ns, uid))
+        if item is None or (item[2] and item[2] < time.time()):
+            return 0
+        return item[1]
+
+    def save(self, ns, uid, data, ttl=None):
+        with self._lock:
+            old = self._data.get((ns, uid))
+            version = (old[1] if old else 0) + 1
+            expires_at = time.time() + ttl if ttl else None
+            self._data[(ns, uid)] = (json.dumps(data, ensure_ascii=False), version, expires_at)
+        return version
+
+    def delete(self, ns, uid):
+        with self._lock:
+            self._data.pop((ns, uid), None)
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            dead = [k for k, (_, _, exp) in self._data.items() if exp and exp < now]
+            for k in dead:
+                del self._data[k]
+        return len(dead)
+
+    @contextmanager
+    def lock(self, uid, timeout=30.0):
+        # プロセス内だけなのでスレッドロックで十分
+        yield
+
+
+class SQLiteStateBackend:
+    def __init__(self, path, lease=120.0, heartbeat=None):
+        self.path = path
+        self.lease = lease
+        self.heartbeat = heartbeat or lease / 3
+        self._owner = None
+        self._local = threading.local()
+        self._held = {}                  # uid → このプロセスで持っている数（延長の対象）
+        self._held_lock = threading.Lock()
+        self._heartbeat_pid = None
+        db = self._conn()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " ns TEXT NOT NULL, uid TEXT NOT NULL, data TEXT NOT NULL,"
+            " version INTEGER NOT NULL, expires_at REAL,"
+            " PRIMARY KEY (ns, uid))"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS state_locks ("
+            " uid TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    @property
+    def owner(self):
+        # プロセスごとの持ち主名（gunicorn --preload で fork されたワーカー同士を区別する）
+        if self._owner is None or not self._owner.startswith(f"{os.getpid()}-"):
+            self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        return self._owner
+
+    def _conn(self):
+        # 接続はスレッドごと。fork 前に親プロセスで開いた接続は使わない
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def load(self, ns, uid):
+        row = self._conn().execute(
+            "SELECT data, version, expires_at FROM state WHERE ns = ? AND uid = ?",
+            (ns, uid)).fetchone()
+        if row is None or (row[2] and row[2] < time.time()):
+            return None, 0
+        return json.loads(row[0]), row[1]
+
+    def version(self, ns, uid):
+        row = self._conn().execute(
+            "SELECT version, expires_at FROM state WHERE ns = ? AND uid = ?", (ns, uid)).fetchone()
+        if row is None or (row[1] and row[1] < time.time()):
+            return 0
+        return row[0]
+
+    def save(self, ns, uid, data, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        row = self._conn().execute(
+            "INSERT INTO state (ns, uid, data, version, expires_at) VALUES (?, ?, ?, 1, ?)"
+            " ON CONFLICT (ns, uid) DO UPDATE SET"
+            " data = excluded.data, version = state.version + 1, expires_at = excluded.expires_at"
+            " RETURNING version",
+            (ns, uid, json.dumps(data, ensure_ascii=False), expires_at)).fetchone()
+        return row[0]
+
+    def delete(self, ns, uid):
+        self._conn().execute("DELETE FROM state WHERE ns = ? AND uid = ?", (ns, uid))
+
+    def purge_expired(self):
+        now = time.time()
+        db = self._conn()
+        n = db.execute("DELETE FROM state WHERE expires_at IS NOT NULL AND expires_at < ?",
+                       (now,)).rowcount
+        db.execute("DELETE FROM state_locks WHERE expires_at < ?", (now,))
+        return n
+
+    @contextmanager
+    def lock(self, uid, timeout=30.0):
+        # 他プロセスと共有するリース型ロック（落ちたプロセスのロックは lease 秒で切れる）
+        db = self._conn()
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT owner, expires_at FROM state_locks WHERE uid = ?",
+                                 (uid,)).fetchone()
+                if row is None or row[1] < now or row[0] == self.owner:
+                    db.execute("INSERT OR REPLACE INTO state_locks (uid, owner, expires_at)"
+                               " VALUES (?, ?, ?)", (uid, self.owner, now + self.lease))
+                    db.execute("COMMIT")
+                    break
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            if now > deadline:
+                print(f"[state] ロック待ちタイムアウト uid={uid}")
+                raise StateLockTimeout(f"uid={uid} のロックが {timeout:.0f}秒待っても取れません")
+            time.sleep(0.02)
+        self._hold(uid, 1)
+        try:
+            yield
+        finally:
+            self._hold(uid, -1)
+            db.execute("DELETE FROM state_locks WHERE uid = ? AND owner = ?", (uid, self.owner))
+
+    def _hold(self, uid, delta):
+        with self._held_lock:
+            n = self._held.get(uid, 0) + delta
+            if n > 0:
+                self._held[uid] = n
+            else:
+                self._held.pop(uid, None)
+            # fork されたワーカーでは親の延長スレッドは動いていないので、もう一度起動する
+            if delta > 0 and self._heartbeat_pid != os.getpid():
+                self._heartbeat_pid = os.getpid()
+                threading.Thread(target=self._renew_loop, name="state-lock-heartbeat", daemon=True).start()
+
+    def _renew_loop(self):
+        while True:
+            time.sleep(self.heartbeat)
+            with self._held_lock:
+                uids = list(self._held)
+            for uid in uids:
+                try:
+                    n = self._conn().execute("UPDATE state_locks SET expires_at = ? WHERE uid = ? AND owner = ?",
+                                             (time.time() + self.lease, uid, self.owner)).rowcount
+                except Exception as e:
+                    print(f"[state] ロックの延長に失敗 uid={uid}:", e)
+                    continue
+                if not n and uid in self._held:
+                    print(f"[state] ロックを失いました uid={uid}")
+
+
+class StateMap:
+    # 1つの名前空間を dict と同じ感覚で使えるようにするビュー
+    # user_session 中はそのユーザーの作業コピーを返し、終了時にまとめて書き戻す
+    _MISSING = object()
+
+    def __init__(self, store, ns):
+        self.store = store
+        self.ns = ns
+
+    def _ws(self, uid):
+        return self.store._working_set(uid)
+
+    def _load(self, uid):
+        ws = self._ws(uid)
+        if ws is None:
+            return self.store.read(self.ns, uid)
+        data, orig = ws
+        if self.ns not in data:
+            data[self.ns] = self.store.read(self.ns, uid)
+            orig[self.ns] = json.dumps(data[self.ns], ensure_ascii=False, sort_keys=True)
+        return data[self.ns]
+
+    def get(self, uid, default=None):
+        data = self._load(uid)
+        return default if data is None else data
+
+    def __getitem__(self, uid):
+        data = self._load(uid)
+        if data is None:
+            raise KeyError(uid)
+        return data
+
+    def __contains__(self, uid):
+        return self._load(uid) is not None
+
+    def __setitem__(self, uid, value):
+        ws = self._ws(uid)
+        if ws is None:
+            self.store.write(self.ns, uid, value)
+        else:
+            ws[0][self.ns] = value
+
+    def setdefault(self, uid, default=None):
+        data = self._load(uid)
+        if data is None:
+            self[uid] = data = default if default is not None else {}
+        return data
+
+    def pop(self, uid, default=_MISSING):
+        data = self._load(uid)
+        ws = self._ws(uid)
+        if ws is None:
+            self.store.delete(self.ns, uid)
+        else:
+            ws[0][self.ns] = None
+        if data is None:
+            if default is StateMap._MISSING:
+                raise KeyError(uid)
+            return default
+        return data
+
+
+class StateStore:
+    def __init__(self, backend=None, ttl=6 * 3600, ttls=None, cache_size=1024, purge_every=500):
+        self.backend = backend or MemoryStateBackend()
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.cache_size = cache_size
+        self.purge_every = purge_every
+        self._cache = OrderedDict()          # (ns, uid) → (version, json文字列)
+        self._cache_lock = threading.Lock()
+        self._user_locks = {}
+        self._user_locks_lock = threading.Lock()
+        self._local = threading.local()
+        self._writes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def map(self, ns):
+        return StateMap(self, ns)
+
+    def ttl_for(self, ns):
+        return self.ttls.get(ns, self.ttl)
+
+    # ---------- 読み書き（キャッシュ付き） ----------
+    def read(self, ns, uid):
+        key = (ns, uid)
+        with self._cache_lock:
+            cached = self._cache.get(key)
+        if cached is not None:
+            # バージョンだけ確認して一致すればJSONを読み直さない
+            if self.backend.version(ns, uid) == cached[0]:
+                with self._cache_lock:
+                    self._cache.move_to_end(key)
+                    self.cache_hits += 1
+                return json.loads(cached[1])
+        data, version = self.backend.load(ns, uid)
+        with self._cache_lock:
+            self.cache_misses += 1
+        if data is not None:
+            self._remember(key, version, data)
+        return data
+
+    def write(self, ns, uid, data):
+        version = self.backend.save(ns, uid, data, ttl=self.ttl_for(ns))
+        self._remember((ns, uid), version, data)
+        self._writes += 1
+        if self.purge_every and self._writes % self.purge_every == 0:
+            self.backend.purge_expired()
+
+    def delete(self, ns, uid):
+        self.backend.delete(ns, uid)
+        with self._cache_lock:
+            self._cache.pop((ns, uid), None)
+
+    def _remember(self, key, version, data):
+        with self._cache_lock:
+            self._cache[key] = (version, json.dumps(data, ensure_ascii=False))
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    # ---------- ユーザー単位のセッション ----------
+    def _working_set(self, uid):
+        sessions = getattr(self._local, "sessions", None)
+        return sessions.get(uid) if sessions else None
+
+    def _user_lock(self, uid):
+        with self._user_locks_lock:
+            lock = self._user_locks.get(uid)
+            if lock is None:
+                lock = self._user_locks[uid] = threading.RLock()
+            return lock
+
+    @contextmanager
+    def session(self, uid):
+        sessions = self._local.__dict__.setdefault("sessions", {})
+        if uid in sessions:
+            # 入れ子のときは外側のセッションにまとめる
+            yield
+            return
+        with self._user_lock(uid), self.backend.lock(uid):
+            ws = sessions[uid] = ({}, {})     # (作業コピー, 読み込み時のJSON)
+            try:
+                yield
+            finally:
+                sessions.pop(uid, None)
+                self._commit(uid, *ws)
+
+    def _commit(self, uid, data, orig):
+        # 変わった名前空間だけ書き戻す（空になったものは削除）
+        for ns, value in data.items():
+            if not value:
+                if orig.get(ns) != "null":
+                    self.delete(ns, uid)
+                continue
+            if json.dumps(value, ensure_ascii=False, sort_keys=True) != orig.get(ns):
+                self.write(ns, uid, value)
+
+    def user_session(self, func):
+        # LINEイベントを受け取るハンドラ用デコレータ
+        # （linebot は引数の数で destination を渡すか決めるので event だけ受け取る）
+        @wraps(func)
+        def wrapper(event):
+            uid = getattr(event.source, "user_id", None)
+            if uid is None:
+                return func(event)
+            with self.session(uid):
+                return func(event)
+        return wrapper
+
+    def stats(self):
+        with self._cache_lock:
+            return {
+                "backend": type(self.backend).__name__,
+                "cache_entries": len(self._cache),
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+            }
@@ -0,0 +1,108 @@
+import math, re, threading
+from collections import Counter
+
+# summarize() のローカル処理（LLM を呼ばない要約）と、段（tier）ごとの集計
+# ・文の区切り（。！？ と改行。カッコの中は除く）で切るので、文の途中でぶつ切りにしない
+# ・複数の文があって長さを超えるときは、重要そうな文（文中の2文字の並びが全体でよく出てくる文。
+#   先頭の文は少し優先）を選び、元の順番で並べる
+# ・1文だけで長すぎるときは読点で切り、それも無理なら文字数で切って「…」を付ける
+
+ELLIPSIS = "…"
+_ENDS = "。！？!?"
+_OPEN, _CLOSE = "「『（(【", "」』）)】"
+_CLAUSE_BREAKS = "、，,　 "
+
+
+def split_sentences(text):
+    # カッコの中の「！」などでは切らない
+    out, buf, depth, ending = [], [], 0, False
+    for ch in text or "":
+        if ending and ch not in _ENDS:
+            out.append("".join(buf))
+            buf, ending = [], False
+        if ch == "\n":
+            out.append("".join(buf))
+            buf = []
+            continue
+        buf.append(ch)
+        if ch in _OPEN:
+            depth += 1
+        elif ch in _CLOSE:
+            depth = max(0, depth - 1)
+        elif ch in _ENDS and depth == 0:
+            ending = True
+    out.append("".join(buf))
+    return [s.strip() for s in out if s.strip()]
+
+
+def trim_sentences(text, limit):
+    # 先頭から、入るところまで文単位で残す
+    text = (text or "").strip()
+    if len(text) <= limit:
+        return text
+    out = ""
+    for s in split_sentences(text):
+        if len(out) + len(s) > limit:
+            break
+        out += s
+    return out or cut_clause(text, limit)
+
+
+def cut_clause(text, limit):
+    # 1文が長すぎるとき：limit 以内で最後の読点まで、無ければ文字数で切る
+    head = text[:max(0, limit - 1)]
+    pos = max(head.rfind(c) for c in _CLAUSE_BREAKS)
+    if pos >= limit // 2:
+        head = head[:pos]
+    return head.rstrip(_CLAUSE_BREAKS) + ELLIPSIS
+
+
+def _bigrams(s):
+    s = re.sub(r"\s+", "", s)
+    return [s[i:i + 2] for i in range(len(s) - 1)]
+
+
+def extractive_summary(text, limit):
+    text = (text or "").strip()
+    if len(text) <= limit:
+        return text
+    sentences = split_sentences(text)
+    if len(sentences) <= 1:
+        return cut_clause(text, limit)
+    freq = Counter(g for s in sentences for g in set(_bigrams(s)))
+    scores = []
+    for i, s in enumerate(sentences):
+        grams = _bigrams(s)
+        score = sum(freq[g] - 1 for g in grams) / math.sqrt(len(grams) or 1)
+        if i == 0:
+            score *= 1.5
+        scores.append(score)
+    chosen, used = set(), 0
+    for i in sorted(range(len(sentences)), key=lambda i: (-scores[i], i)):
+        if used + len(sentences[i]) <= limit:
+            chosen.add(i)
+            used += len(sentences[i])
+    if not chosen:
+        return cut_clause(text, limit)
+    return "".join(sentences[i] for i in sorted(chosen))
+
+
+class TierStats:
+    # 段ごとの件数と処理時間（/cache/stats で見る）
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tiers = {}
+
+    def record(self, tier, ms):
+        with self._lock:
+            t = self._tiers.setdefault(tier, [0, 0.0, 0.0])
+            t[0] += 1
+            t[1] += ms
+            t[2] = max(t[2], ms)
+
+    def stats(self):
+        with self._lock:
+            total = sum(t[0] for t in self._tiers.values()) or 1
+            return {tier: {"count": n, "share": round(n / total, 3), "avg_ms": round(ms / n, 2),
+                           "max_ms": round(mx, 2)}
+                    for tier, (n, ms, mx) in self._tiers.items()}
@@ -0,0 +1,111 @@
+import hashlib, re, sqlite3, threading, time, unicodedata
+from collections import OrderedDict
+
+# summarize() の結果キャッシュ
+# キー = 正規化したテキスト + プロンプト版 + モデル名 のハッシュ
+# ・メモリ上のLRU（1段目）
+# ・SQLiteファイル（2段目、合計サイズが上限を超えたら古い順に削除）
+
+
+def normalize_text(text):
+    text = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def cache_key(text, prompt_version, model):
+    raw = f"{prompt_version}\x00{model}\x00{normalize_text(text)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SummaryCache:
+    def __init__(self, path=None, memory_size=512, disk_max_bytes=50 * 1024 * 1024):
+        self.memory_size = memory_size
+        self.disk_max_bytes = disk_max_bytes
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_bytes = 0
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.passthrough = 0
+        self.evictions = 0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS summaries ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " size INTEGER NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS summaries_used ON summaries (used_at)")
+            self._disk_bytes = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM summaries").fetchone()[0]
+
+    def get(self, key):
+        with self._lock:
+            value = self._mem.get(key)
+            if value is not None:
+                self._mem.move_to_end(key)
+                self.hits_memory += 1
+                return value
+            if self._db is not None:
+                row = self._db.execute("SELECT value FROM summaries WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE summaries SET used_at = ? WHERE key = ?",
+                                     (time.time(), key))
+                    self.hits_disk += 1
+                    self._remember(key, row[0])
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+            if self._db is None:
+                return
+            size = len(key) + len(value.encode("utf-8"))
+            old = self._db.execute("SELECT size FROM summaries WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO summaries (key, value, size, used_at) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()))
+            self._disk_bytes += size - (old[0] if old else 0)
+            if self._disk_bytes > self.disk_max_bytes:
+                self._evict_disk()
+
+    def _remember(self, key, value):
+        self._mem[key] = value
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.memory_size:
+            self._mem.popitem(last=False)
+
+    def _evict_disk(self):
+        # 上限の9割まで、最後に使われたのが古いものから消す
+        target = self.disk_max_bytes * 0.9
+        dead = []
+        for key, size in self._db.execute("SELECT key, size FROM summaries ORDER BY used_at"):
+            if self._disk_bytes <= target:
+                break
+            dead.append((key,))
+            self._disk_bytes -= size
+        self._db.executemany("DELETE FROM summaries WHERE key = ?", dead)
+        self.evictions += len(dead)
+
+    def count_passthrough(self):
+        with self._lock:
+            self.passthrough += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits_memory + self.hits_disk + self.misses
+            return {
+                "hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "passthrough": self.passthrough,
+                "hit_rate": round((self.hits_memory + self.hits_disk) / lookups, 3) if lookups else 0.0,
+                "memory_entries": len(self._mem),
+                "disk_bytes": self._disk_bytes,
+                "evictions": self.evictions,
+            }
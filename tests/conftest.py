@@ -0,0 +1,45 @@
+import os, sys
+
+import pytest
+
+# リポジトリ直下のモジュールを import できるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, data=None):
+        self.status_code = status_code
+        self.ok = 200 <= status_code < 300
+        self._data = data or {}
+        self.text = str(self._data)
+
+    def json(self):
+        return self._data
+
+
+class FakeGateway:
+    # NotionGateway.request の代わり。呼ばれた順に calls に残し、replies に積んだ応答を先頭から返す
+    # （replies が空なら 200。None を積むと接続エラー扱い）
+    def __init__(self):
+        self.calls = []
+        self.replies = []
+        self._seq = 0
+
+    def request(self, method, path, json=None, params=None, token=None, timeout=None):
+        self.calls.append((method, path, json, token))
+        if self.replies:
+            reply = self.replies.pop(0)
+            if reply is None or isinstance(reply, FakeResponse):
+                return reply
+            return FakeResponse(reply)
+        self._seq += 1
+        if method == "PATCH" and path.endswith("/children"):
+            return FakeResponse(200, {"results": [{"id": f"block-{self._seq}"}]})
+        if method == "PATCH":
+            return FakeResponse(200, {"id": path.split("/")[1]})
+        return FakeResponse(200, {"id": f"page-{self._seq}"})
+
+
+@pytest.fixture
+def gateway():
+    return FakeGateway()
@@ -0,0 +1,62 @@
+import threading, time
+
+from activity_ledger import ActivityLedger, LedgerSync
+
+
+def add_sessions(ledger, n):
+    for i in range(n):
+        ledger.start("u1", f"task{i}", at=1000 + i)
+        ledger.stop("u1", f"task{i}", at=2000 + i)
+
+
+def test_stop_records_totals_and_caps_forgotten_sessions():
+    ledger = ActivityLedger(max_session=3600)
+    ledger.start("u1", "読書", at=1000)
+    assert ledger.start("u1", "読書", at=1100) == "running"
+    done = ledger.stop("u1", at=1600)
+    assert done["task"] == "読書" and done["seconds"] == 600 and not done["capped"]
+    assert ledger.stop("u1", at=1700) is None
+
+    ledger.start("u1", "読書", at=10000)
+    assert ledger.stop("u1", at=30000)["capped"]
+
+
+def test_processes_sharing_the_db_send_each_session_once(tmp_path):
+    path = str(tmp_path / "activity.db")
+    a, b = ActivityLedger(path), ActivityLedger(path)
+    add_sessions(a, 30)
+    sent, lock = [], threading.Lock()
+
+    def send(sessions):
+        time.sleep(0.02)
+        with lock:
+            sent.extend(s["id"] for s in sessions)
+        return True
+
+    syncs = [LedgerSync(a, send, batch=7), LedgerSync(b, send, batch=7)]
+    threads = [threading.Thread(target=s.flush) for s in syncs]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(sent) == list(range(1, 31))
+    assert a.stats()["unsynced"] == 0
+
+
+def test_failed_batch_is_released_for_the_next_run():
+    ledger = ActivityLedger()
+    add_sessions(ledger, 2)
+    assert LedgerSync(ledger, lambda sessions: False).flush() is False
+
+    sent = []
+    assert LedgerSync(ledger, lambda sessions: sent.extend(sessions) or True).flush()
+    assert [s["task"] for s in sent] == ["task0", "task1"]
+
+
+def test_claim_of_a_crashed_sender_expires():
+    ledger = ActivityLedger()
+    add_sessions(ledger, 1)
+    assert len(ledger.claim(lease=0.1)) == 1      # 送信中に落ちた
+    assert ledger.claim() == []
+    time.sleep(0.15)
+    assert len(ledger.claim()) == 1
@@ -0,0 +1,49 @@
+import os, threading, time
+
+from charts import ChartService, chart_key
+
+SERIES = [("w1", {"ValueStar": 3, "MissionStar": 4, "emotions": {"喜び": 2}, "reviews": 2})]
+
+
+def test_prerender_returns_before_the_series_is_read(tmp_path):
+    charts = ChartService(cache_dir=str(tmp_path))
+    release = threading.Event()
+
+    def series():
+        release.wait(5)
+        return SERIES
+
+    t0 = time.perf_counter()
+    key = charts.prerender("u1", "w", 1, "t", series)
+    assert time.perf_counter() - t0 < 0.5
+    assert key == chart_key("u1", "w", 1)
+    release.set()
+    assert charts.get(key)[:4] == b"\x89PNG"
+    for _ in range(50):             # ディスクへの書き出しは描画完了の直後
+        if not os.path.exists(tmp_path / f"{key}.pending"):
+            break
+        time.sleep(0.02)
+    assert os.path.exists(tmp_path / f"{key}.png")
+    assert not os.path.exists(tmp_path / f"{key}.pending")
+
+
+def test_other_worker_waits_for_the_png_on_the_shared_disk(tmp_path):
+    # 別のワーカー（描画を依頼したのとは別の ChartService）に画像のリクエストが来た
+    other = ChartService(cache_dir=str(tmp_path), timeout=5)
+    key = chart_key("u1", "w", 1)
+    (tmp_path / f"{key}.pending").touch()
+
+    def finish():
+        time.sleep(0.2)
+        (tmp_path / f"{key}.png").write_bytes(b"png")
+        os.remove(tmp_path / f"{key}.pending")
+
+    threading.Thread(target=finish).start()
+    assert other.get(key) == b"png"
+
+
+def test_unknown_key_is_not_waited_for(tmp_path):
+    charts = ChartService(cache_dir=str(tmp_path), timeout=5)
+    t0 = time.perf_counter()
+    assert charts.get("0" * 32) is None
+    assert time.perf_counter() - t0 < 0.5
@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+# app はimport時に設定を読むので、DBはメモリ上・外部サービスの鍵はダミーにしておく
+for _name in ("NOTION_OUTBOX_DB", "MEMO_INDEX_DB", "TIMER_DB", "ACTIVITY_DB", "REVIEW_STATS_DB"):
+    os.environ.setdefault(_name, ":memory:")
+for _name in ("LINE_CHANNEL_SECRET", "LINE_CHANNEL_ACCESS_TOKEN", "OPENAI_API_KEY"):
+    os.environ.setdefault(_name, "dummy")
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    os.environ.setdefault("CHART_CACHE_DIR", str(tmp_path / "charts"))
+    import app as app_module
+    monkeypatch.setattr(app_module, "on_worker_start", lambda: None)  # バックグラウンドは起動しない
+    monkeypatch.setattr(app_module, "EXPORT_TOKEN", "s3cret")
+    return app_module.app.test_client()
+
+
+def test_missing_token_is_rejected(client):
+    assert client.get("/export/unknown").status_code == 403
+
+
+def test_wrong_token_is_rejected(client):
+    r = client.get("/export/unknown", headers={"Authorization": "Bearer wrong"})
+    assert r.status_code == 403
+
+
+def test_query_string_token_is_not_accepted(client):
+    assert client.get("/export/unknown?token=s3cret").status_code == 403
+
+
+def test_bearer_token_passes_auth(client):
+    # 認証を通れば未知のソースとして 404 になる
+    r = client.get("/export/unknown", headers={"Authorization": "Bearer s3cret"})
+    assert r.status_code == 404
+
+
+def test_disabled_without_export_token(client, monkeypatch):
+    import app as app_module
+    monkeypatch.setattr(app_module, "EXPORT_TOKEN", None)
+    r = client.get("/export/unknown", headers={"Authorization": "Bearer s3cret"})
+    assert r.status_code == 403
@@ -0,0 +1,47 @@
+import threading, time
+
+from jobqueue import JobQueue
+
+
+def wait_for(cond, timeout=3.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if cond():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_jobs_with_the_same_key_run_in_order():
+    done, lock = [], threading.Lock()
+
+    def func(payload):
+        time.sleep(0.01 if payload["n"] % 2 else 0)
+        with lock:
+            done.append((payload["uid"], payload["n"]))
+
+    jobs = JobQueue(func, workers=3, key_func=lambda p: p["uid"])
+    jobs.start()
+    for n in range(10):
+        for uid in ("a", "b"):
+            jobs.put({"uid": uid, "n": n})
+    assert wait_for(lambda: len(done) == 20)
+    for uid in ("a", "b"):
+        assert [n for u, n in done if u == uid] == list(range(10))
+
+
+def test_live_owner_keeps_its_jobs_and_expired_ones_are_taken_over(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    crashed = JobQueue(lambda p: None, path=path, lease=0.3)
+    crashed.put({"n": 1})                 # 積んだだけで処理しないまま落ちた
+    crashed.put({"n": 2})
+
+    handled = []
+    other = JobQueue(lambda p: handled.append(p["n"]), path=path, lease=0.3, workers=1)
+    assert other.take_over() == 0         # lease が生きている間は触らない
+    time.sleep(0.35)
+    other.start()
+    assert wait_for(lambda: handled == [1, 2])
+    assert other.stats()["taken_over"] == 2
+    assert wait_for(lambda: other._db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0] == 0)
+
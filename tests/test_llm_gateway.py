@@ -0,0 +1,77 @@
+import threading, time
+
+import pytest
+
+from llm_gateway import LLMGateway, LLMUnavailable
+
+
+class FakeClient:
+    def with_options(self, **kw):
+        return self
+
+
+def hold_slot(llm, uid, release):
+    # release が set されるまでユーザーの枠を1つ使い続ける
+    t = threading.Thread(target=llm.call, args=("summary", lambda c: release.wait(5)), kwargs={"uid": uid})
+    t.start()
+    time.sleep(0.05)
+    return t
+
+
+def test_busy_user_is_rejected_after_queue_timeout():
+    llm = LLMGateway(FakeClient(), per_user=1, queue_timeout=0.05)
+    release = threading.Event()
+    t = hold_slot(llm, "u1", release)
+    with pytest.raises(LLMUnavailable) as e:
+        llm.call("summary", lambda c: "x", uid="u1")
+    assert e.value.reason == "busy"
+    release.set()
+    t.join()
+    assert llm.stats()["kinds"]["summary"]["rejected_busy"] == 1
+
+
+def test_kind_specific_queue_timeout_waits_for_a_slot():
+    llm = LLMGateway(FakeClient(), per_user=1, queue_timeout=0.05, queue_timeouts={"transcription": 2.0})
+    release = threading.Event()
+    t = hold_slot(llm, "u1", release)
+    threading.Timer(0.2, release.set).start()
+    assert llm.call("transcription", lambda c: "text", uid="u1") == "text"
+    t.join()
+    assert llm.stats()["kinds"]["transcription"]["queue_timeout_sec"] == 2.0
+
+
+def test_transcription_segments_run_concurrently_with_their_own_budget():
+    # per_user=2 でも、文字起こしは別枠の3本が同時に走り、要約の枠も残る
+    llm = LLMGateway(FakeClient(), per_user=2, queue_timeout=0.05, per_user_kinds={"transcription": 3})
+    overlap = threading.Barrier(3, timeout=2)
+    release = threading.Event()
+    results = []
+
+    def segment(c):
+        overlap.wait()      # 3本が同時に中にいないと BrokenBarrierError
+        release.wait(2)
+        return "ok"
+
+    threads = [threading.Thread(target=lambda: results.append(llm.call("transcription", segment, uid="u1")))
+               for _ in range(3)]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    assert llm.call("summary", lambda c: "summary", uid="u1") == "summary"
+    release.set()
+    for t in threads:
+        t.join()
+    assert results == ["ok", "ok", "ok"]
+    assert llm.stats()["kinds"]["transcription"]["per_user"] == 3
+
+
+def test_transcription_budget_is_still_capped_per_user():
+    llm = LLMGateway(FakeClient(), per_user=2, queue_timeout=0.05, per_user_kinds={"transcription": 1})
+    release = threading.Event()
+    t = threading.Thread(target=llm.call, args=("transcription", lambda c: release.wait(5)), kwargs={"uid": "u1"})
+    t.start()
+    time.sleep(0.05)
+    with pytest.raises(LLMUnavailable):
+        llm.call("transcription", lambda c: "x", uid="u1")
+    release.set()
+    t.join()
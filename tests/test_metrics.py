@@ -0,0 +1,52 @@
+import pytest
+
+from metrics import Registry
+
+
+def test_histogram_buckets_are_cumulative():
+    reg = Registry(prefix="t_")
+    h = reg.histogram("latency_seconds", "遅延", labelnames=("route",), buckets=(0.1, 1.0))
+    for v in (0.05, 0.1, 0.5, 2.0):
+        h.observe(v, "/callback")
+    lines = h.render()
+    assert lines[:2] == ["# HELP t_latency_seconds 遅延", "# TYPE t_latency_seconds histogram"]
+    assert lines[2:] == [
+        't_latency_seconds_bucket{route="/callback",le="0.1"} 2',    # 境界ちょうどは含める（le）
+        't_latency_seconds_bucket{route="/callback",le="1.0"} 3',
+        't_latency_seconds_bucket{route="/callback",le="+Inf"} 4',
+        't_latency_seconds_sum{route="/callback"} 2.65',
+        't_latency_seconds_count{route="/callback"} 4',
+    ]
+
+
+def test_timer_counts_errors():
+    reg = Registry()
+    errors = reg.counter("errors_total", "エラー", labelnames=("step",))
+    h = reg.histogram("step_seconds", "処理時間", labelnames=("step",))
+    with h.time("ok", errors=errors):
+        pass
+    with pytest.raises(ValueError):
+        with h.time("ng", errors=errors):
+            raise ValueError
+    assert errors.render()[2:] == ['errors_total{step="ng"} 1']
+    assert 'step_seconds_count{step="ng"} 1' in h.render()
+    assert 'step_seconds_count{step="ok"} 1' in h.render()
+
+
+def test_label_values_are_escaped():
+    reg = Registry()
+    c = reg.counter("c_total", "c", labelnames=("name",))
+    c.inc('a"b\\c\nd', amount=2)
+    assert c.render()[2] == 'c_total{name="a\\"b\\\\c\\nd"} 2'
+
+
+def test_gauge_reads_the_function_and_skips_failures():
+    reg = Registry()
+    reg.gauge("pending", "待ち", lambda: 3)
+    reg.gauge("by_status", "状態別", lambda: {"ok": 1, "dead": None}, labelnames=("status",))
+    reg.gauge("broken", "壊れた", lambda: 1 / 0)
+    text = reg.render()
+    assert "pending 3\n" in text
+    assert 'by_status{status="ok"} 1\n' in text
+    assert "dead" not in text
+    assert "broken" not in text
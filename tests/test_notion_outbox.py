@@ -0,0 +1,204 @@
+import time
+
+from notion_outbox import NotionOutbox, is_temp_id
+
+
+def make(gateway, path=":memory:", **kw):
+    kw.setdefault("base_backoff", 0.0)
+    return NotionOutbox(gateway, path=path, **kw)
+
+
+def paths(gateway):
+    return [(method, path) for method, path, _, _ in gateway.calls]
+
+
+def test_create_returns_temp_id_and_updates_follow_the_real_id(gateway):
+    outbox = make(gateway)
+    temp = outbox.create_page("db1", {"Name": "a"})
+    assert is_temp_id(temp)
+    outbox.update_page(temp, {"Name": "b"})
+    outbox.append_children(temp, [{"type": "paragraph"}])
+
+    assert outbox.flush_once() == 3
+    assert paths(gateway) == [("POST", "pages"), ("PATCH", "pages/page-1"), ("PATCH", "blocks/page-1/children")]
+    assert outbox.resolve(temp) == "page-1"
+
+
+def test_update_waits_while_its_create_is_being_retried(gateway):
+    outbox = make(gateway)
+    temp = outbox.create_page("db1", {})
+    outbox.update_page(temp, {"Name": "b"})
+    gateway.replies = [503]
+
+    assert outbox.flush_once() == 0
+    assert paths(gateway) == [("POST", "pages")]
+    assert outbox.resolve(temp) is None
+
+    time.sleep(0.01)
+    assert outbox.flush_once() == 2
+    assert paths(gateway)[1:] == [("POST", "pages"), ("PATCH", "pages/page-1")]
+
+
+def test_writes_to_the_same_target_keep_their_order(gateway):
+    outbox = make(gateway)
+    outbox.update_page("p1", {"n": 1})
+    outbox.append_children("p1", [{"type": "paragraph"}])
+    outbox.update_page("p1", {"n": 2})
+    outbox.update_page("p2", {"n": 3})
+    gateway.replies = [None]          # p1 の1件目だけ接続エラー
+
+    assert outbox.flush_once() == 1   # p1 の後続は追い越さない。p2 は別の宛先なので送る
+    assert paths(gateway) == [("PATCH", "pages/p1"), ("PATCH", "pages/p2")]
+
+    time.sleep(0.01)
+    assert outbox.flush_once() == 3   # 間にブロック追加があるので p1 の更新はまとめない
+    assert paths(gateway)[2:] == [("PATCH", "pages/p1"), ("PATCH", "blocks/p1/children"), ("PATCH", "pages/p1")]
+    assert [call[2]["properties"]["n"] for call in gateway.calls if call[1] == "pages/p1"] == [1, 1, 2]
+
+
+def test_pending_updates_to_the_same_page_are_sent_as_one_patch(gateway):
+    outbox = make(gateway)
+    outbox.update_page("p1", {"a": 1, "b": 1})
+    outbox.update_page("p2", {"x": 1})
+    outbox.update_page("p1", {"b": 2})
+    outbox.update_page("p1", {"c": 3})
+
+    assert outbox.flush_once() == 2
+    assert gateway.calls[0][1:3] == ("pages/p1", {"properties": {"a": 1, "b": 2, "c": 3}})
+    assert paths(gateway)[1] == ("PATCH", "pages/p2")
+    assert outbox.stats()["pending"] == 0
+    assert outbox.stats()["coalesced"] == 2
+
+
+def test_merged_update_is_retried_as_a_whole(gateway):
+    outbox = make(gateway)
+    outbox.update_page("p1", {"a": 1})
+    outbox.update_page("p1", {"b": 2})
+    gateway.replies = [503]
+
+    assert outbox.flush_once() == 0
+    assert outbox.stats()["pending"] == 1   # まとめた内容は先頭の行に残っている
+    time.sleep(0.01)
+    assert outbox.flush_once() == 1
+    assert gateway.calls[1][2] == {"properties": {"a": 1, "b": 2}}
+
+
+def test_held_updates_wait_for_more_answers_until_flushed(gateway, tmp_path):
+    path = str(tmp_path / "outbox.db")
+    outbox = make(gateway, path=path)
+    outbox.update_page("p1", {"a": 1}, hold=60)
+    outbox.update_page("p1", {"b": 2}, hold=60)
+    assert outbox.flush_once() == 0
+    assert gateway.calls == []
+
+    # 待っている回答は別プロセス（再起動後）からも見え、flush_target ですぐ送れる
+    other = make(gateway, path=path)
+    assert other.flush_target("p1") == 2
+    assert other.flush_once() == 1
+    assert gateway.calls[0][2] == {"properties": {"a": 1, "b": 2}}
+
+
+def test_update_without_hold_sends_the_held_ones_with_it(gateway):
+    outbox = make(gateway)
+    outbox.update_page("p1", {"a": 1}, hold=60)
+    outbox.update_page("p1", {"b": 2})
+    assert outbox.flush_once() == 1
+    assert gateway.calls[0][2] == {"properties": {"a": 1, "b": 2}}
+
+
+def test_rows_claimed_by_another_process_are_not_merged(gateway, tmp_path):
+    path = str(tmp_path / "outbox.db")
+    a, b = make(gateway, path=path), make(gateway, path=path)
+    a.update_page("p1", {"a": 1})
+    a.update_page("p1", {"b": 2})
+    rows = a._db.execute("SELECT id, next_at FROM outbox ORDER BY id").fetchall()
+    assert b._claim(*rows[1])         # 2件目は別プロセスが送信中
+
+    assert a.flush_once() == 1
+    assert gateway.calls[0][2] == {"properties": {"a": 1}}
+    assert a.stats()["pending"] == 1
+
+
+def test_writes_to_a_dead_creator_are_buried(gateway):
+    outbox = make(gateway)
+    temp = outbox.create_page("db1", {})
+    outbox.update_page(temp, {"Name": "b"})
+    gateway.replies = [400]
+
+    assert outbox.flush_once() == 0
+    assert outbox.flush_once() == 0   # 作成が dead になったので、その仮IDへの更新も dead にする
+    assert paths(gateway) == [("POST", "pages")]
+    stats = outbox.stats()
+    assert stats["dead"] == 2 and stats["pending"] == 0
+
+    # 原因を直して戻せば、作成 → 更新の順で送り直す
+    assert outbox.retry_dead() == 2
+    assert outbox.flush_once() == 2
+    assert paths(gateway)[1:] == [("POST", "pages"), ("PATCH", "pages/page-1")]
+
+
+def test_gives_up_after_max_attempts(gateway):
+    outbox = make(gateway, max_attempts=2)
+    outbox.update_page("p1", {})
+    gateway.replies = [503, 503]
+    outbox.flush_once()
+    time.sleep(0.01)
+    outbox.flush_once()
+    assert outbox.stats()["dead"] == 1
+
+
+def test_other_process_takes_over_after_the_lease_expires(gateway, tmp_path):
+    path = str(tmp_path / "outbox.db")
+    crashed = make(gateway, path=path, lease=0.2)
+    other = make(gateway, path=path, lease=0.2)
+    crashed.update_page("p1", {"n": 1})
+
+    # 送信中に落ちた（予約だけして送っていない）
+    op_id, next_at = crashed._db.execute("SELECT id, next_at FROM outbox").fetchone()
+    assert crashed._claim(op_id, next_at)
+
+    assert other.flush_once() == 0
+    assert gateway.calls == []
+
+    time.sleep(0.25)
+    assert other.flush_once() == 1
+    assert paths(gateway) == [("PATCH", "pages/p1")]
+    assert crashed.stats()["pending"] == 0
+
+
+def test_claim_is_won_by_one_process_only(gateway, tmp_path):
+    path = str(tmp_path / "outbox.db")
+    a, b = make(gateway, path=path), make(gateway, path=path)
+    a.update_page("p1", {})
+    op_id, next_at = a._db.execute("SELECT id, next_at FROM outbox").fetchone()
+    assert a._claim(op_id, next_at)
+    assert not b._claim(op_id, next_at)
+
+
+def test_on_resolved_is_called_with_the_real_id(gateway):
+    resolved = []
+    outbox = make(gateway, on_resolved=lambda temp, real: resolved.append((temp, real)))
+    refs = outbox.append_children("block1", [{}])
+    outbox.flush_once()
+    assert resolved == [(refs[0], "block-1")]
+
+
+def test_prune_keeps_ids_still_referenced_by_queued_writes(gateway):
+    outbox = make(gateway, id_retention=60)
+    old = outbox.create_page("db1", {})
+    kept = outbox.create_page("db1", {})
+    outbox.flush_once()
+    outbox.update_page(kept, {})
+    gateway.replies = [400]
+    outbox.flush_once()               # kept への更新は dead で残る
+
+    assert outbox.prune_ids(now=time.time() + 120) == 1
+    assert outbox.resolve(old) is None
+    assert outbox.resolve(kept) == "page-2"
+
+
+def test_unset_target_is_rejected(gateway):
+    outbox = make(gateway)
+    assert outbox.create_page(None, {}) is None
+    assert outbox.update_page("", {}) is False
+    assert outbox.stats()["pending"] == 0
@@ -0,0 +1,121 @@
+import threading, time
+
+import pytest
+
+from state_store import MemoryStateBackend, SQLiteStateBackend, StateLockTimeout, StateStore
+
+
+def test_session_writes_back_only_changed_namespaces():
+    store = StateStore(MemoryStateBackend())
+    memo, review = store.map("memo"), store.map("review")
+    memo["u1"] = {"step": "category"}
+    review["u1"] = {"step": 2}
+    before = store.backend.version("review", "u1")
+
+    with store.session("u1"):
+        memo["u1"]["step"] = "content_input"   # 作業コピーを直接書き換える
+        assert review.get("u1") == {"step": 2}
+
+    assert memo["u1"] == {"step": "content_input"}
+    assert store.backend.version("review", "u1") == before
+
+
+def test_session_pop_deletes_the_namespace():
+    store = StateStore(MemoryStateBackend())
+    memo = store.map("memo")
+    memo["u1"] = {"step": "x"}
+    with store.session("u1"):
+        assert memo.pop("u1") == {"step": "x"}
+        assert "u1" not in memo
+    assert memo.get("u1") is None
+
+
+def test_ttl_expiry():
+    store = StateStore(MemoryStateBackend(), ttls={"memo": -1})
+    store.map("memo")["u1"] = {"step": "x"}
+    assert store.map("memo").get("u1") is None
+    assert store.backend.purge_expired() == 0   # 読んだ時点で消えている
+
+
+def test_sqlite_cache_sees_writes_from_another_process(tmp_path):
+    path = str(tmp_path / "state.db")
+    a = StateStore(SQLiteStateBackend(path))
+    b = StateStore(SQLiteStateBackend(path))
+    a.map("life5")["u1"] = {"step": 1}
+    assert b.map("life5")["u1"] == {"step": 1}
+    assert b.map("life5")["u1"] == {"step": 1}
+    assert b.cache_hits == 1
+
+    a.map("life5")["u1"] = {"step": 2}
+    assert b.map("life5")["u1"] == {"step": 2}   # version が変わったので読み直す
+
+
+def test_sqlite_lock_excludes_other_owner_until_released(tmp_path):
+    path = str(tmp_path / "state.db")
+    a, b = SQLiteStateBackend(path), SQLiteStateBackend(path)
+    order = []
+
+    def other():
+        with b.lock("u1"):
+            order.append("b")
+
+    with a.lock("u1"):
+        t = threading.Thread(target=other)
+        t.start()
+        time.sleep(0.1)
+        order.append("a")
+    t.join(timeout=5)
+    assert order == ["a", "b"]
+
+
+def test_sqlite_lock_of_a_crashed_owner_expires(tmp_path):
+    path = str(tmp_path / "state.db")
+    crashed = SQLiteStateBackend(path, lease=0.1)
+    other = SQLiteStateBackend(path)
+    # 解放しないまま落ちた（延長するスレッドも止まっている）
+    crashed._conn().execute("INSERT INTO state_locks (uid, owner, expires_at) VALUES ('u1', ?, ?)",
+                            (crashed.owner, time.time() + 0.1))
+
+    t0 = time.time()
+    with other.lock("u1", timeout=5):
+        owner = other._conn().execute("SELECT owner FROM state_locks WHERE uid = 'u1'").fetchone()[0]
+    assert owner == other.owner
+    assert time.time() - t0 < 2
+
+
+def test_sqlite_lock_wait_times_out_instead_of_continuing(tmp_path):
+    path = str(tmp_path / "state.db")
+    a, b = SQLiteStateBackend(path), SQLiteStateBackend(path)
+    entered = []
+    with a.lock("u1"):
+        with pytest.raises(StateLockTimeout):
+            with b.lock("u1", timeout=0.1):
+                entered.append("b")
+    assert entered == []
+    with b.lock("u1", timeout=0.1):   # 解放されれば取れる
+        entered.append("b")
+    assert entered == ["b"]
+
+
+def test_sqlite_lock_is_renewed_while_held(tmp_path):
+    # lease を過ぎても持っている間は延長され、別の持ち主には渡らない
+    path = str(tmp_path / "state.db")
+    a = SQLiteStateBackend(path, lease=0.3, heartbeat=0.05)
+    b = SQLiteStateBackend(path, lease=0.3)
+    with a.lock("u1"):
+        time.sleep(0.6)
+        with pytest.raises(StateLockTimeout):
+            with b.lock("u1", timeout=0.3):
+                pass
+    with b.lock("u1", timeout=0.3):
+        owner = b._conn().execute("SELECT owner FROM state_locks WHERE uid = 'u1'").fetchone()[0]
+    assert owner == b.owner
+
+
+def test_sqlite_version_increments_on_save(tmp_path):
+    backend = SQLiteStateBackend(str(tmp_path / "state.db"))
+    assert backend.save("memo", "u1", {"a": 1}) == 1
+    assert backend.save("memo", "u1", {"a": 2}) == 2
+    assert backend.load("memo", "u1") == ({"a": 2}, 2)
+    backend.delete("memo", "u1")
+    assert backend.load("memo", "u1") == (None, 0)
@@ -0,0 +1,53 @@
+from summarizer import ELLIPSIS, TierStats, cut_clause, extractive_summary, split_sentences, trim_sentences
+
+
+def test_split_sentences_keeps_brackets_together():
+    text = "彼は「すごい！本当に？」と言った。次の日\n晴れた"
+    assert split_sentences(text) == ["彼は「すごい！本当に？」と言った。", "次の日", "晴れた"]
+
+
+def test_split_sentences_keeps_repeated_marks_on_one_sentence():
+    assert split_sentences("やった！！よし") == ["やった！！", "よし"]
+
+
+def test_short_text_is_returned_as_is():
+    assert extractive_summary(" 短い文。 ", 10) == "短い文。"
+    assert trim_sentences("短い文。", 10) == "短い文。"
+
+
+def test_extractive_summary_fits_the_limit_and_keeps_order():
+    text = ("今日は散歩をした。散歩の途中で友達に会った。昼ごはんはカレーだった。"
+            "夕方も散歩をして、友達と話した。")
+    out = extractive_summary(text, 30)
+    assert 0 < len(out) <= 30
+    picked = [s for s in split_sentences(text) if s in out]
+    assert "".join(picked) == out               # 元の順番のまま、文の途中で切らない
+    assert text.startswith(picked[0]) or "散歩" in out
+
+
+def test_single_long_sentence_is_cut_at_a_comma():
+    text = "あ" * 12 + "、" + "い" * 30
+    assert extractive_summary(text, 20) == "あ" * 12 + ELLIPSIS
+    # 読点が前の方（半分より手前）にしか無いときは文字数で切る
+    text = "あ" * 5 + "、" + "い" * 30
+    assert extractive_summary(text, 20) == text[:19] + ELLIPSIS
+
+
+def test_cut_clause_falls_back_to_characters():
+    out = cut_clause("あ" * 50, 10)
+    assert out == "あ" * 9 + ELLIPSIS
+    assert len(out) == 10
+
+
+def test_trim_sentences_keeps_leading_sentences():
+    assert trim_sentences("一つ目。二つ目。三つ目。", 8) == "一つ目。二つ目。"
+
+
+def test_tier_stats():
+    stats = TierStats()
+    stats.record("local", 1.0)
+    stats.record("local", 3.0)
+    stats.record("llm", 100.0)
+    out = stats.stats()
+    assert out["local"] == {"count": 2, "share": 0.667, "avg_ms": 2.0, "max_ms": 3.0}
+    assert out["llm"]["share"] == 0.333
@@ -0,0 +1,77 @@
+import time
+
+from timer_scheduler import TimerScheduler, format_duration, parse_timer
+
+
+def wait_for(cond, timeout=3.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if cond():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_parse_timer():
+    assert parse_timer("読書15分") == ("読書", 900)
+    assert parse_timer("1時間30分") == ("", 5400)
+    assert parse_timer("15分読書") is None
+    assert format_duration(5400) == "1時間30分"
+
+
+def test_failed_push_is_retried_and_fired_once(tmp_path):
+    path = str(tmp_path / "timers.db")
+    calls, failures = [], [2]
+
+    def fire(uid, items):
+        if failures[0]:
+            failures[0] -= 1
+            raise RuntimeError("push failed")
+        calls.append((uid, [t["id"] for t in items]))
+
+    a = TimerScheduler(fire, path=path, retry_backoff=0.1, poll_interval=0.1)
+    b = TimerScheduler(fire, path=path, retry_backoff=0.1, poll_interval=0.1)
+    timer_id, _ = a.add("u1", "読書", 0)
+    a.start()
+    b.start()
+    try:
+        assert wait_for(lambda: calls)
+        time.sleep(0.3)
+        assert calls == [("u1", [timer_id])]
+        fired_at = a._db.execute("SELECT fired_at FROM timers WHERE id = ?", (timer_id,)).fetchone()[0]
+        assert fired_at is not None
+    finally:
+        a.stop()
+        b.stop()
+
+
+def test_gives_up_after_max_attempts():
+    def fire(uid, items):
+        raise RuntimeError("push failed")
+
+    timers = TimerScheduler(fire, retry_backoff=0.02, max_attempts=3)
+    timers.add("u1", "", 0)
+    timers.start()
+    try:
+        assert wait_for(lambda: timers.stats()["dropped"] == 1)
+        assert timers.stats()["failures"] == 3
+        assert timers.stats()["pending"] == 0
+    finally:
+        timers.stop()
+
+
+def test_claim_of_a_crashed_process_expires(tmp_path):
+    path = str(tmp_path / "timers.db")
+    calls = []
+    crashed = TimerScheduler(lambda uid, items: None, path=path)
+    timer_id, _ = crashed.add("u1", "", 0)
+    crashed._db.execute("UPDATE timers SET claimed_until = ? WHERE id = ?", (time.time() + 0.3, timer_id))
+
+    other = TimerScheduler(lambda uid, items: calls.append(uid), path=path, poll_interval=0.1)
+    other.start()
+    try:
+        time.sleep(0.1)
+        assert calls == []
+        assert wait_for(lambda: calls == ["u1"])
+    finally:
+        other.stop()
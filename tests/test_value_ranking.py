@@ -0,0 +1,80 @@
+import random
+
+import value_ranking as vr
+
+VALUES = [f"v{i}" for i in range(12)]
+
+
+def run_session(strength, prior=None, top_k=3, budget=40):
+    state = vr.new_session(VALUES, prior=prior, top_k=top_k, budget=budget)
+    while not vr.is_done(state):
+        a, b = vr.next_pair(state)
+        winner, loser = (a, b) if strength[a] > strength[b] else (b, a)
+        vr.record(state, winner, loser)
+    return state
+
+
+def test_win_probability_is_symmetric():
+    assert vr.win_probability(0, 0) == 0.5
+    assert abs(vr.win_probability(100, 0) + vr.win_probability(0, 100) - 1) < 1e-12
+    assert vr.win_probability(400, 0) > 0.9
+
+
+def test_record_moves_ratings_and_counts():
+    state = vr.new_session(["a", "b"], top_k=1)
+    vr.record(state, "a", "b")
+    assert state["ratings"]["a"] > 0 > state["ratings"]["b"]
+    assert state["counts"] == {"a": 1, "b": 1}
+    assert state["asked_pairs"] == [["a", "b"]]
+
+
+def test_later_comparisons_move_ratings_less():
+    state = vr.new_session(["a", "b"], top_k=1)
+    vr.record(state, "a", "b")
+    first = state["ratings"]["a"]
+    vr.record(state, "b", "a")
+    vr.record(state, "a", "b")
+    assert state["ratings"]["a"] - state["ratings"]["b"] < 2 * first
+
+
+def test_next_pair_does_not_repeat_an_asked_pair():
+    random.seed(1)
+    state = vr.new_session(VALUES, top_k=3, budget=40)
+    seen = set()
+    for _ in range(8):
+        pair = vr.next_pair(state)
+        assert frozenset(pair) not in seen
+        seen.add(frozenset(pair))
+        vr.record(state, *pair)
+
+
+def test_consistent_answers_find_the_strongest_values():
+    random.seed(7)
+    strength = {v: i for i, v in enumerate(VALUES)}
+    state = run_session(strength)
+    assert "v11" in vr.top_k(state)
+    assert state["asked"] <= state["budget"]
+
+
+def test_budget_ends_the_session():
+    state = vr.new_session(VALUES, top_k=3, budget=2)
+    vr.record(state, *vr.next_pair(state))
+    assert not vr.is_done(state)
+    vr.record(state, *vr.next_pair(state))
+    assert vr.is_done(state)
+
+
+def test_prior_is_shrunk_and_carried_over():
+    state = vr.new_session(["a", "b", "c"], prior={"a": 100.0})
+    assert state["ratings"] == {"a": 100.0 * vr.PRIOR_SHRINK, "b": 0.0, "c": 0.0}
+    assert state["counts"]["a"] == 1
+
+
+def test_update_prior_blends_only_compared_values():
+    state = vr.new_session(["a", "b", "c"], prior={"a": 100.0, "c": 10.0})
+    vr.record(state, "a", "b")
+    prior = vr.update_prior({"a": 100.0, "c": 10.0}, state, chosen="b")
+    expected_a = round((1 - vr.PRIOR_WEIGHT) * 100.0 + vr.PRIOR_WEIGHT * state["ratings"]["a"], 1)
+    assert prior["a"] == expected_a
+    assert prior["c"] == 10.0                    # 比べていない価値観はそのまま
+    assert prior["b"] == round(state["ratings"]["b"] + vr.CHOSEN_BONUS, 1)
@@ -0,0 +1,257 @@
+import heapq, re, sqlite3, threading, time
+
+# 「タイマー」機能（"読書15分" → 15分後にLINEで通知）
+# ・期限順のヒープ1本＋専用スレッド1本。何千個あっても待ちは先頭の1件だけ見ればよい
+# ・path を渡すとSQLiteに保存し、再起動しても残りのタイマーを読み直す（期限切れは即通知）
+# ・同じタイミング（batch_window 秒以内）に鳴るタイマーはユーザーごとに1通にまとめる
+# ・複数プロセスで同じDBを使っても、鳴らす前に claimed_until（期限つきの予約）を取り合うので二重通知しない
+#   fired_at は通知が届いてから書く。予約したプロセスが落ちても、期限が切れれば他のプロセスが鳴らす
+# ・通知に失敗したタイマーは retry_backoff 秒（回数ごとに倍）後に鳴らし直し、max_attempts 回で諦める
+
+UNITS = {"時間": 3600, "h": 3600, "分": 60, "m": 60, "min": 60, "秒": 1, "s": 1, "sec": 1}
+_DURATION = re.compile(r"(\d+)\s*(時間|min|sec|分|秒|h|m|s)", re.IGNORECASE)
+
+
+def parse_timer(text):
+    # "読書15分" → ("読書", 900) / "1時間30分" → ("", 5400) / 解釈できなければ None
+    text = (text or "").strip()
+    seconds, start = 0, None
+    for m in _DURATION.finditer(text):
+        if start is not None and m.start() != end:
+            return None  # 数字の後ろにまた文章が続くような入力は受け付けない
+        if start is None:
+            start = m.start()
+        seconds += int(m.group(1)) * UNITS[m.group(2).lower()]
+        end = m.end()
+    if start is None or text[end:].strip() or seconds <= 0:
+        return None
+    return text[:start].strip(), seconds
+
+
+def format_duration(seconds):
+    h, rest = divmod(int(seconds), 3600)
+    m, s = divmod(rest, 60)
+    parts = [f"{h}時間" if h else "", f"{m}分" if m else "", f"{s}秒" if s else ""]
+    return "".join(parts) or "0秒"
+
+
+class TimerScheduler:
+    def __init__(self, fire, path=None, batch_window=1.0, poll_interval=30.0, claim_lease=60.0,
+                 retry_backoff=30.0, max_attempts=5):
+        self.fire = fire                    # fire(uid, [timer, ...])
+        self.batch_window = batch_window
+        self.poll_interval = poll_interval
+        self.claim_lease = claim_lease
+        self.retry_backoff = retry_backoff
+        self.max_attempts = max_attempts
+        self._heap = []                     # (due_at, id)
+        self._timers = {}                   # id → dict
+        self._cond = threading.Condition()
+        self._db = None
+        self._next_id = 1
+        self._last_loaded = 0
+        self._thread = None
+        self._stopping = False
+        self.fired = 0
+        self.batches = 0
+        self.pushes = 0
+        self.failures = 0
+        self.retries = 0
+        self.dropped = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS timers ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, uid TEXT NOT NULL, label TEXT NOT NULL,"
+                " seconds INTEGER NOT NULL, due_at REAL NOT NULL, fired_at REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS timers_pending ON timers (fired_at, due_at)")
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(timers)")}
+            if "claimed_until" not in columns:
+                self._db.execute("ALTER TABLE timers ADD COLUMN claimed_until REAL NOT NULL DEFAULT 0")
+                self._db.execute("ALTER TABLE timers ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+    # ---------- 登録 ----------
+    def add(self, uid, label, seconds):
+        due_at = time.time() + seconds
+        with self._cond:
+            if self._db is not None:
+                timer_id = self._db.execute(
+                    "INSERT INTO timers (uid, label, seconds, due_at) VALUES (?, ?, ?, ?)",
+                    (uid, label, seconds, due_at)).lastrowid
+            else:
+                timer_id = self._next_id
+                self._next_id += 1
+            self._push({"id": timer_id, "uid": uid, "label": label, "seconds": seconds, "due_at": due_at,
+                        "attempts": 0})
+            self._cond.notify()
+        return timer_id, due_at
+
+    def pending(self, uid):
+        with self._cond:
+            return sorted((t for t in self._timers.values() if t["uid"] == uid), key=lambda t: t["due_at"])
+
+    def _push(self, timer):
+        if timer["id"] in self._timers:
+            return
+        self._timers[timer["id"]] = timer
+        heapq.heappush(self._heap, (timer["due_at"], timer["id"]))
+        self._last_loaded = max(self._last_loaded, timer["id"])
+
+    def _load(self):
+        # 保存済み（＝再起動前や他プロセスで登録された）未通知のタイマーを読み込む
+        rows = self._db.execute(
+            "SELECT id, uid, label, seconds, due_at, attempts FROM timers WHERE fired_at IS NULL AND id > ?",
+            (self._last_loaded,)).fetchall()
+        for timer_id, uid, label, seconds, due_at, attempts in rows:
+            self._push({"id": timer_id, "uid": uid, "label": label, "seconds": seconds, "due_at": due_at,
+                        "attempts": attempts})
+        return len(rows)
+
+    # ---------- 実行 ----------
+    def start(self):
+        # fork されたプロセスでは親のスレッドは動いていないので、もう一度起動する
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._db is not None:
+                n = self._load()
+                if n:
+                    print(f"[timer] 未通知のタイマー {n}件を読み込みました")
+        self._thread = threading.Thread(target=self._run, name="timer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        next_poll = time.time() + self.poll_interval
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    now = time.time()
+                    if self._db is not None and now >= next_poll:
+                        self._load()
+                        next_poll = now + self.poll_interval
+                    wait = next_poll - now if self._db is not None else None
+                    if self._heap:
+                        due = self._heap[0][0] - now
+                        if due <= 0:
+                            break
+                        wait = due if wait is None else min(wait, due)
+                    self._cond.wait(wait)
+                if self._stopping:
+                    return
+                # 先頭が期限を迎えたら、batch_window 以内に鳴るものもまとめて取り出す
+                limit = time.time() + self.batch_window
+                batch = []
+                while self._heap and self._heap[0][0] <= limit:
+                    _, timer_id = heapq.heappop(self._heap)
+                    timer = self._timers.pop(timer_id, None)
+                    if timer is not None:
+                        batch.append(timer)
+            self._fire_batch(batch)
+
+    def _claim(self, batch):
+        if self._db is None:
+            return batch
+        now = time.time()
+        claimed = []
+        with self._cond:
+            for timer in batch:
+                cur = self._db.execute(
+                    "UPDATE timers SET claimed_until = ? WHERE id = ? AND fired_at IS NULL AND claimed_until < ?",
+                    (now + self.claim_lease, timer["id"], now))
+                if cur.rowcount == 1:
+                    claimed.append(timer)
+                    continue
+                # 他のプロセスが予約中（または鳴らし直しの予定を入れた）→ 予約が切れる頃にもう一度見る
+                row = self._db.execute(
+                    "SELECT due_at, claimed_until, attempts FROM timers WHERE id = ? AND fired_at IS NULL",
+                    (timer["id"],)).fetchone()
+                if row is not None:
+                    timer.update(due_at=max(row[0], row[1]), attempts=row[2])
+                    self._push(timer)
+            self._cond.notify()
+        return claimed
+
+    def _done(self, timers, now):
+        if self._db is not None:
+            with self._cond:
+                self._db.executemany("UPDATE timers SET fired_at = ? WHERE id = ?",
+                                     [(now, t["id"]) for t in timers])
+
+    def _retry(self, timers):
+        # 通知に失敗したタイマーは、間隔を空けて鳴らし直す（回数の上限を超えたら諦める）
+        now = time.time()
+        with self._cond:
+            for timer in timers:
+                timer["attempts"] = timer.get("attempts", 0) + 1
+                if timer["attempts"] >= self.max_attempts:
+                    print(f"[timer] {timer['attempts']}回失敗したので諦めます:", timer["uid"], timer["label"])
+                    self.dropped += 1
+                    if self._db is not None:
+                        self._db.execute("UPDATE timers SET fired_at = ?, attempts = ? WHERE id = ?",
+                                         (now, timer["attempts"], timer["id"]))
+                    continue
+                timer["due_at"] = now + self.retry_backoff * 2 ** (timer["attempts"] - 1)
+                self.retries += 1
+                if self._db is not None:
+                    self._db.execute(
+                        "UPDATE timers SET due_at = ?, attempts = ?, claimed_until = 0 WHERE id = ?",
+                        (timer["due_at"], timer["attempts"], timer["id"]))
+                self._push(timer)
+            self._cond.notify()
+
+    def _fire_batch(self, batch):
+        batch = self._claim(batch)
+        if not batch:
+            return
+        by_user = {}
+        for timer in batch:
+            by_user.setdefault(timer["uid"], []).append(timer)
+        now = time.time()
+        for uid, timers in by_user.items():
+            try:
+                self.fire(uid, timers)
+            except Exception as e:
+                print("[timer] 通知に失敗:", uid, e)
+                with self._cond:
+                    self.failures += 1
+                self._retry(timers)
+                continue
+            self._done(timers, time.time())
+            with self._cond:
+                self.pushes += 1
+                for timer in timers:
+                    late = max(0.0, now - timer["due_at"])
+                    self.fired += 1
+                    self.latency_total += late
+                    self.latency_max = max(self.latency_max, late)
+        with self._cond:
+            self.batches += 1
+
+    def stats(self):
+        now = time.time()
+        with self._cond:
+            return {
+                "pending": len(self._timers),
+                "overdue": sum(1 for due, _ in self._heap if due <= now),
+                "next_in_sec": round(self._heap[0][0] - now, 1) if self._heap else None,
+                "fired": self.fired,
+                "batches": self.batches,
+                "pushes": self.pushes,
+                "failures": self.failures,
+                "retries": self.retries,
+                "dropped": self.dropped,
+                "latency_avg_ms": round(self.latency_total / self.fired * 1000, 1) if self.fired else 0.0,
+                "latency_max_ms": round(self.latency_max * 1000, 1),
+                "persistent": self._db is not None,
+            }
@@ -0,0 +1,113 @@
+import math, random
+
+# 価値観2択（ペアワイズ）のランキングエンジン
+# Elo（Bradley–Terry）のレーティングで強さを推定し、
+# 次の2択は「どちらが勝つか一番わからない」かつ「まだ比べた回数が少ない」ペアを選ぶ。
+# 候補はレーティング順に隣り合うペアだけ（O(n log n)）。上位k件が安定したら早めに終了する。
+# 前回までのセッションの結果を prior として引き継ぐ（価値観2択の精度を上げる：履歴参照）
+#
+# 状態はすべて JSON にできる dict（state_store にそのまま保存できる）
+
+BASE_K         = 64.0    # 1回目の比較での変動幅（比較回数が増えるほど小さくする）
+PRIOR_SHRINK   = 0.5     # 履歴のレーティングをどれだけ割り引いて使うか
+PRIOR_WEIGHT   = 0.5     # セッション結果を履歴に混ぜる割合
+CHOSEN_BONUS   = 40.0    # カードソートで最重要に選ばれた価値観への加点
+MIN_COMPARISONS = 5
+STABLE_ROUNDS   = 3
+
+
+def win_probability(ra, rb):
+    return 1.0 / (1.0 + 10 ** ((rb - ra) / 400.0))
+
+
+def new_session(values, prior=None, top_k=9, budget=9):
+    prior = prior or {}
+    values = list(dict.fromkeys(values))
+    random.shuffle(values)  # 同点のときの並びを毎回変える
+    return {
+        "values":  values,
+        "ratings": {v: prior.get(v, 0.0) * PRIOR_SHRINK for v in values},
+        "counts":  {v: 1 if v in prior else 0 for v in values},
+        "top_k":   top_k,
+        "budget":  budget,
+        "asked":   0,
+        "stable":  0,
+        "asked_pairs": [],
+        "last_top": [],
+    }
+
+
+def ranked(state):
+    return sorted(state["values"], key=lambda v: state["ratings"][v], reverse=True)
+
+
+def top_k(state):
+    return ranked(state)[:state["top_k"]]
+
+
+def _uncertainty(state, v):
+    return 1.0 / math.sqrt(1.0 + state["counts"][v])
+
+
+def next_pair(state):
+    order = ranked(state)
+    if len(order) < 2:
+        return None
+    asked = {frozenset(p) for p in state["asked_pairs"]}
+    k = state["top_k"]
+    best, best_score = None, -1.0
+    for i in range(len(order) - 1):
+        a, b = order[i], order[i + 1]
+        if frozenset((a, b)) in asked:
+            # 隣が比較済みなら1つ飛ばした相手も候補にする
+            if i + 2 >= len(order) or frozenset((a, order[i + 2])) in asked:
+                continue
+            b = order[i + 2]
+        p = win_probability(state["ratings"][a], state["ratings"][b])
+        score = p * (1 - p) * (_uncertainty(state, a) + _uncertainty(state, b))
+        # 上位k件の境目付近の比較は結果に直結するので重視
+        if abs((i + 1) - k) <= 1:
+            score *= 2.0
+        if score > best_score:
+            best, best_score = (a, b), score
+    return best
+
+
+def record(state, winner, loser):
+    ra, rb = state["ratings"][winner], state["ratings"][loser]
+    expected = win_probability(ra, rb)
+    ka = BASE_K / (1.0 + 0.5 * state["counts"][winner])
+    kb = BASE_K / (1.0 + 0.5 * state["counts"][loser])
+    state["ratings"][winner] = ra + ka * (1 - expected)
+    state["ratings"][loser]  = rb - kb * (1 - expected)
+    state["counts"][winner] += 1
+    state["counts"][loser]  += 1
+    state["asked"] += 1
+    state["asked_pairs"].append([winner, loser])
+    current = sorted(top_k(state))
+    state["stable"] = state["stable"] + 1 if current == state["last_top"] else 0
+    state["last_top"] = current
+
+
+def is_done(state):
+    if state["asked"] >= state["budget"]:
+        return True
+    if len(state["values"]) <= state["top_k"]:
+        # 全部残るなら並び順の確認だけで十分
+        return state["asked"] >= min(MIN_COMPARISONS, len(state["values"]) - 1)
+    return state["asked"] >= MIN_COMPARISONS and state["stable"] >= STABLE_ROUNDS
+
+
+def update_prior(prior, state, chosen=None):
+    prior = dict(prior or {})
+    # このセッションで比べた価値観だけ混ぜる（counts は履歴のある価値観が 1 から始まるので使わない）
+    compared = {v for pair in state["asked_pairs"] for v in pair}
+    for v in state["values"]:
+        if v not in compared:
+            continue
+        old = prior.get(v)
+        now = state["ratings"][v]
+        prior[v] = now if old is None else (1 - PRIOR_WEIGHT) * old + PRIOR_WEIGHT * now
+    if chosen:
+        prior[chosen] = prior.get(chosen, 0.0) + CHOSEN_BONUS
+    return {v: round(r, 1) for v, r in prior.items()}